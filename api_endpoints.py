@@ -1,14 +1,33 @@
 import os
+import json
+import base64
+import datetime
+import shutil
 import tempfile
 import time
+import uuid
+import zipfile
 import urllib.parse
 from pathlib import Path
-from fastapi import FastAPI, File, UploadFile, BackgroundTasks, HTTPException
-from fastapi.responses import FileResponse
-from logger_config import logger
-from database import (db, get_dwg_files_from_database, record_conversion_to_database, 
-                      insert_jpg_to_attachment, update_conversion_status)
-from converter import converter_dwg_to_jpg
+from typing import List
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.responses import FileResponse, StreamingResponse, Response, PlainTextResponse
+from logger_config import logger, stop_logging
+from database import (db, resolve_dwg_path, run_db, db_executor,
+                      CLAIM_LEASE_SECONDS, CLAIM_BATCH_SIZE)
+from repository import get_repository, DB_BACKEND
+from worker_pool import run_conversion, shutdown_executor
+from pipeline import conversion_pipeline, convert_with_pipeline, remove_workspaces, remove_stale_workspaces
+from prefetch import prefetcher, PREFETCH_AHEAD
+from publisher import publisher
+from scheduler import poll_scheduler, cost_estimator, source_key, FairShareQueue, PRIORITY_WINDOW
+from complexity import cost_model, COMPLEXITY_PROFILE, COST_MODEL_HISTORY
+from batch_writer import (writer as batch_writer, queue_conversion_status, queue_conversion_failure,
+                          queue_conversion_record, queue_jpg_attachment)
+import image_store
+import metrics
+import progress
+import tracing
 
 # 创建FastAPI应用实例
 app = FastAPI(
@@ -17,6 +36,9 @@ app = FastAPI(
     version="1.0.0"
 )
 
+# 待转换DWG和转换结果的存储（按DB_BACKEND选择SQL Server或SQLite）
+repository = get_repository()
+
 # 从环境变量获取临时目录配置，如果不存在则使用默认值
 TEMP_DIR_PATH = os.getenv("TEMP_DIR", "temp")
 # 确保临时目录存在，使用绝对路径
@@ -24,228 +46,453 @@ TEMP_DIR = Path(os.path.abspath(TEMP_DIR_PATH))
 TEMP_DIR.mkdir(exist_ok=True)
 logger.info(f"使用临时目录: {TEMP_DIR}")
 
+# 应用关闭配置
+# 关闭时先停止认领新文件，在该时间（秒）内等待进行中的转换完成；超时后取消剩余的转换并释放其认领，
+# 其他工作进程可以立即接手（已经渲染完成的结果保存在图像存储中，重新转换时直接复用）
+SHUTDOWN_DRAIN_TIMEOUT = float(os.getenv("SHUTDOWN_DRAIN_TIMEOUT", "30"))
+# 上传接口返回后延迟清理临时文件的时间（秒），确保文件传输完成；应用关闭时立即清理
+UPLOAD_CLEANUP_DELAY = float(os.getenv("UPLOAD_CLEANUP_DELAY", "300"))
+
+# 应用正在关闭，定期任务和手动触发的数据库转换不再开始新的文件
+_draining = False
+# 后台服务任务（periodic：定期检查任务，renew：认领续约任务），关闭时停止
+_service_tasks = {}
+# 尚未执行的延迟清理: 任务 -> 清理函数
+_pending_cleanups = {}
+
+def schedule_cleanup(cleanup, delay=UPLOAD_CLEANUP_DELAY):
+    """delay秒后在线程中执行清理函数；等待期间不占用请求和线程，应用关闭时立即执行"""
+    async def run_later():
+        await asyncio.sleep(delay)
+        await asyncio.to_thread(cleanup)
+    
+    task = asyncio.ensure_future(run_later())
+    _pending_cleanups[task] = cleanup
+    task.add_done_callback(lambda done: _pending_cleanups.pop(done, None))
+
+async def run_pending_cleanups():
+    """立即执行全部尚未执行的延迟清理（应用关闭时调用）"""
+    pending = list(_pending_cleanups.items())
+    for task, _ in pending:
+        task.cancel()
+    await asyncio.gather(*(task for task, _ in pending), return_exceptions=True)
+    for _, cleanup in pending:
+        try:
+            await asyncio.to_thread(cleanup)
+        except Exception as e:
+            logger.error(f"清理临时文件失败: {str(e)}")
+    if pending:
+        logger.info(f"已执行 {len(pending)} 个延迟清理任务")
+
+# 分页认领待转换的DWG文件
+async def iter_claimed_pages(page_size=CLAIM_BATCH_SIZE):
+    """分页认领待转换的DWG文件，逐页产出
+    
+    每页按优先级和订单轮转的顺序认领（见claim_dwg_files），已认领的行持有租约，下一页自然跳过它们，
+    因此不按附件Id分页（按Id分页会跳过Id较小、排在后面的订单的文件）。
+    在调用方转换当前页的同时预取（认领）下一页，数据库往返与转换重叠；
+    调用方提前结束遍历时，释放已预取但尚未处理的那一页的认领
+    """
+    pending = asyncio.ensure_future(run_db(repository.claim, page_size))
+    try:
+        while True:
+            page = await pending
+            pending = None
+            if not page:
+                return
+            pending = asyncio.ensure_future(run_db(repository.claim, page_size))
+            yield page
+    finally:
+        if pending is not None:
+            try:
+                unprocessed = await pending
+                await run_db(repository.release_claims, attachment_ids=[row['AttachmentId'] for row in unprocessed])
+            except Exception as e:
+                logger.error(f"释放预取的认领失败: {str(e)}")
+
+async def _convert_claimed_file(dwg_files, priority="normal", queued_at=None):
+    """转换定期任务认领到的一个转换任务
+    
+    参数:
+    - dwg_files: 指向同一个源文件的附件记录（可能属于不同订单），源文件只转换一次，结果写入每一条记录
+    - priority: 调度时的优先级名称，用于按优先级统计从认领到完成的耗时
+    - queued_at: 进入候选窗口的时间（time.monotonic()）
+    """
+    started = time.monotonic()
+    try:
+        await asyncio.gather(*(_convert_claimed_row(dwg_file) for dwg_file in dwg_files))
+    finally:
+        finished = time.monotonic()
+        # 转换耗时用于估算后续文件的转换时间，从认领到完成的耗时按优先级统计
+        cost_estimator.observe(dwg_files[0].get('FileSize'), finished - started)
+        if queued_at is not None:
+            metrics.SCHEDULE_LATENCY.observe(finished - queued_at, priority=priority)
+
+async def _convert_claimed_row(dwg_file):
+    """转换一条认领到的附件记录，失败时记录到转换历史（同一源文件的多条记录共享正在进行的转换）"""
+    order_id = dwg_file.get('id')
+    # 直接使用数据库中的FilePath作为相对路径
+    relative_dwg_path = dwg_file.get('FilePath')
+
+    if not (order_id and relative_dwg_path):
+        logger.warning("找到无效的DWG文件记录: %s", dwg_file)
+        return
+
+    logger.info(f"开始转换订单ID: {order_id} 的DWG文件: {relative_dwg_path} (相对路径)")
+    try:
+        # 传递相对路径而不是绝对路径
+        await convert_dwg_from_database(order_id, relative_dwg_path, attachment=dwg_file)
+    except Exception as e:
+        error_msg = str(e)
+        logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
+        # 记录转换失败信息到数据库，使用相对路径
+        queue_conversion_record(Path(relative_dwg_path).name, relative_dwg_path, "", "失败", 0, error_msg)
+        queue_conversion_failure(order_id, relative_dwg_path, error_msg, "exception", dwg_file)
+
 # 定期检查和转换任务
 async def periodic_check_and_convert():
-    """定期从数据库检查需要转换的DWG文件并执行转换"""
-    # 从环境变量获取检查间隔，如果不存在则使用默认值
-    check_interval = int(os.getenv("CHECK_INTERVAL", "60"))
+    """定期从数据库检查需要转换的DWG文件并执行转换
+    
+    认领到的文件先进入最多PRIORITY_WINDOW个文件的候选窗口，按优先级和订单轮转派发到转换流水线
+    （最多为流水线的容量），转换的同时继续认领下一页补充窗口；
+    一轮认领到文件后立即再次轮询，空闲时按指数退避等待，可通过/poll/wake或检测到待转换文件变化提前唤醒
+    """
+    logger.info(f"启动定期检查任务，空闲时轮询间隔: {poll_scheduler.min_interval}-{poll_scheduler.max_interval} 秒")
     
-    logger.info(f"启动定期检查任务，检查间隔: {check_interval} 秒")
+    # 限制同时进行的转换数，与流水线的容量一致（各阶段都有文件在处理）；
+    # 等待空位时认领暂停，避免认领过多导致租约过期，剩余文件留在候选窗口中参与优先级排序
+    slots = asyncio.Semaphore(conversion_pipeline.max_in_flight)
+    trigger = "timeout"
     
-    while True:
+    while not _draining:
+        metrics.POLL_CYCLES.inc(trigger=trigger)
+        claimed_total = 0
         try:
             logger.info("开始检查数据库中的DWG文件")
             
-            # 从数据库获取需要转换的DWG文件
-            dwg_files = get_dwg_files_from_database()
-            
-            if dwg_files:
-                logger.info(f"找到 {len(dwg_files)} 个需要转换的DWG文件")
-                
-                # 逐一转换每个DWG文件
-                for dwg_file in dwg_files:
-                    order_id = dwg_file.get('id')
-                    # 直接使用数据库中的FilePath作为相对路径
-                    relative_dwg_path = dwg_file.get('FilePath')
-                    
-                    if order_id and relative_dwg_path:
-                        logger.info(f"开始转换订单ID: {order_id} 的DWG文件: {relative_dwg_path} (相对路径)")
+            # 分批认领需要转换的DWG文件，直到没有待转换的文件
+            # 认领是原子的，多个工作进程或多台服务器同时运行时不会重复转换同一个文件
+            in_flight = set()
+            queue = FairShareQueue(cost_estimator)
+            pages = iter_claimed_pages()
+            exhausted = False
+            try:
+                while True:
+                    # 补充候选窗口，使后认领的高优先级文件也能参与排序
+                    while not exhausted and not _draining and len(queue) < PRIORITY_WINDOW:
                         try:
-                            # 传递相对路径而不是绝对路径
-                            await convert_dwg_from_database(order_id, relative_dwg_path)
-                        except Exception as e:
-                            error_msg = str(e)
-                            logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
-                            # 记录转换失败信息到数据库，使用相对路径
-                            record_conversion_to_database(Path(relative_dwg_path).name, relative_dwg_path, "", "失败", 0, error_msg)
-                    else:
-                        logger.warning("找到无效的DWG文件记录: %s", dwg_file)
-            else:
+                            dwg_files = await pages.__anext__()
+                        except StopAsyncIteration:
+                            exhausted = True
+                            break
+                        claimed_total += len(dwg_files)
+                        logger.info(f"认领到 {len(dwg_files)} 个需要转换的DWG文件")
+                        queue.extend(dwg_files)
+                    
+                    if not len(queue):
+                        break
+                    # 等待转换空位期间，把接下来要转换的文件预取到本地
+                    prefetcher.prefetch(rows[0].get('FullPath') for rows in queue.peek(PREFETCH_AHEAD))
+                    await slots.acquire()
+                    if _draining:
+                        # 应用正在关闭，窗口中尚未派发的文件释放认领
+                        slots.release()
+                        break
+                    dwg_files, priority, queued_at = queue.pop()
+                    task = asyncio.ensure_future(_convert_claimed_file(dwg_files, priority, queued_at))
+                    in_flight.add(task)
+                    task.add_done_callback(in_flight.discard)
+                    task.add_done_callback(lambda _: slots.release())
+                    # 关闭时与手动触发的转换一起等待完成或取消
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+            finally:
+                # 提前结束时（例如应用关闭）释放已预取但尚未处理的认领，以及窗口中尚未派发的认领
+                await pages.aclose()
+                unscheduled = queue.drain()
+                if unscheduled:
+                    prefetcher.discard(row.get('FullPath') for row in unscheduled)
+                    await run_db(repository.release_claims,
+                                 attachment_ids=[row['AttachmentId'] for row in unscheduled])
+                # 等待本轮已提交的转换完成后再决定下一次轮询
+                if in_flight:
+                    await asyncio.gather(*in_flight, return_exceptions=True)
+            
+            if not claimed_total:
                 logger.info("未找到需要转换的DWG文件")
             
         except Exception as e:
             logger.error(f"定期检查和转换任务出错: {str(e)}")
         
-        # 等待指定的检查间隔
-        logger.info(f"等待 {check_interval} 秒后再次检查")
-        await asyncio.sleep(check_interval)
+        delay = poll_scheduler.next_delay(claimed_total > 0)
+        if delay:
+            logger.info(f"等待 {delay:g} 秒后再次检查")
+        trigger = await poll_scheduler.sleep(delay, watermark=lambda: run_db(repository.pending_watermark))
+
+# 认领租约续约任务
+async def renew_claims_periodically():
+    """定期为当前工作进程仍在处理的认领续约，防止长时间转换时租约过期被其他工作进程重复认领"""
+    renew_interval = max(CLAIM_LEASE_SECONDS // 3, 1)
+    while True:
+        await asyncio.sleep(renew_interval)
+        try:
+            renewed = await run_db(repository.renew_claims)
+            if renewed:
+                logger.info(f"已为 {renewed} 个进行中的认领续约")
+        except Exception as e:
+            logger.error(f"认领续约任务出错: {str(e)}")
 
 # 转换从数据库获取的DWG文件
-async def convert_dwg_from_database(order_id, relative_dwg_path, skip_exists_check=False):
-    """转换从数据库获取的DWG文件为JPG"""
-    try:
-        # 从环境变量中获取DWG文件路径前缀
-        dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
-        logger.info(f"DWG文件路径前缀: {dwg_file_prefix}")
-        
-        # 检查传入的relative_dwg_path是否已经是完整的绝对路径
-        # 判断条件: 以驱动器字母开头(如D:)或者已经包含完整路径
-        # 注意：在Windows上，os.path.isabs()会将以/或\开头的路径视为绝对路径，我们需要更精确的判断
-        is_full_path = False
-        if len(relative_dwg_path) >= 2 and relative_dwg_path[1] == ':' and relative_dwg_path[0].isalpha():
-            is_full_path = True
-        elif os.path.isabs(relative_dwg_path) and (len(relative_dwg_path) >= 2 and relative_dwg_path[1] == ':'):
-            is_full_path = True
-        
-        # 如果已经是完整路径，直接使用；否则进行拼接
-        if is_full_path:
-            full_dwg_path = relative_dwg_path
-            logger.info(f"DWG路径已包含完整路径，直接使用: {full_dwg_path}")
-        else:
-            # 拼接完整的DWG文件路径
-            # 确保路径分隔符的一致性，在Windows环境下统一处理
-            if dwg_file_prefix:
-                # 标准化路径分隔符，将所有/替换为\
-                normalized_prefix = dwg_file_prefix.replace('/', '\\')
-                normalized_dwg_path = relative_dwg_path.replace('/', '\\')
-                
-                # 确保prefix以\结尾
-                if not normalized_prefix.endswith('\\'):
-                    normalized_prefix += '\\'
-                
-                # 移除relative_dwg_path开头的\（如果有）
-                if normalized_dwg_path.startswith('\\'):
-                    normalized_dwg_path = normalized_dwg_path[1:]
-                
-                # 拼接路径
-                full_dwg_path = normalized_prefix + normalized_dwg_path
-            else:
-                # 如果没有设置前缀，直接使用原始路径
-                full_dwg_path = relative_dwg_path
-            
-        logger.info(f"原始DWG路径(相对路径): {relative_dwg_path}, 完整DWG路径: {full_dwg_path}")
-        
-        # 检查文件是否存在（除非跳过检查）
-        dwg_file_path = Path(full_dwg_path)
-        if not skip_exists_check and not dwg_file_path.exists():
-            logger.error(f"系统订单{order_id}DWG文件不存在: {full_dwg_path}")
-            logger.error(f"系统订单{order_id}DWG文件相对路径: {relative_dwg_path}")
-            # 更新数据库状态，表示文件不存在
-            update_conversion_status(order_id, relative_dwg_path, "失败", "文件不存在")
-            return
+# 正在转换的源文件: 规范化的完整路径 -> 转换任务，多条附件记录指向同一个文件时共享同一次转换
+_inflight_sources = {}
+
+async def _convert_source(dwg_file_path, jpg_path, skip_exists_check=False, job_id=None, file_label=None,
+                          attachment_id=None):
+    """转换一个源文件并验证生成的JPG
+    
+    返回:
+    - (错误信息, JPG文件大小, 失败原因)，成功时错误信息为None
+    """
+    # 检查文件是否存在（除非跳过检查）
+    if not skip_exists_check and not dwg_file_path.exists():
+        prefetcher.discard([dwg_file_path])
+        # 所在目录也无法访问时通常是共享目录暂时不可用，稍后重试
+        reason = "file_not_found" if dwg_file_path.parent.exists() else "share_unavailable"
+        metrics.record_conversion(False, reason)
+        progress.publish(job_id, "file_done", file=file_label, attachment_id=attachment_id, success=False,
+                         error="文件不存在")
+        return "文件不存在", 0, reason
+    
+    logger.debug("准备将DWG文件转换为JPG: %s -> %s", dwg_file_path, jpg_path)
+    
+    # 通过转换流水线执行转换：读取共享目录、ODA、渲染和写回分阶段并发进行，不阻塞事件循环
+    result = await convert_with_pipeline(dwg_file_path, jpg_path, job_id=job_id, file_label=file_label,
+                                         attachment_id=attachment_id)
+    if not result["success"]:
+        return result["error"] or "DWG到JPG转换失败", 0, result["reason"]
+    
+    # 验证JPG文件是否成功创建
+    if not jpg_path.exists():
+        return "JPG文件未创建", 0, "output_missing"
+    
+    # 获取文件大小
+    jpg_size = jpg_path.stat().st_size
+    if jpg_size == 0:
+        return "创建的JPG文件为空", 0, "empty_output"
+    return None, jpg_size, ""
+
+async def _shared_convert_source(dwg_file_path, jpg_path, skip_exists_check=False, job_id=None, file_label=None,
+                                 attachment_id=None):
+    """转换源文件；同一个文件（规范化后的完整路径相同）正在转换时等待并共享那一次转换的结果"""
+    key = source_key(dwg_file_path)
+    task = _inflight_sources.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_convert_source(dwg_file_path, jpg_path, skip_exists_check, job_id, file_label,
+                                                     attachment_id))
+        _inflight_sources[key] = task
+        task.add_done_callback(lambda _: _inflight_sources.pop(key, None))
+    else:
+        logger.info(f"DWG文件正在转换，共享同一次转换的结果: {dwg_file_path}")
+        metrics.CONVERSIONS_DEDUPLICATED.inc(kind="path")
+    # shield防止某个等待方被取消时取消其他附件记录共享的转换
+    return await asyncio.shield(task)
+
+async def convert_dwg_from_database(order_id, relative_dwg_path, skip_exists_check=False, job_id=None,
+                                    attachment=None):
+    """转换从数据库获取的DWG文件为JPG，提供job_id时发布进度事件
+
+    attachment为claim_dwg_files返回的附件记录，提供时状态更新按附件主键进行，
+    插入JPG附件时直接沿用其中的字段，不需要再查询原始DWG记录。
+    多个订单的附件指向同一个DWG文件时只转换一次，转换结果分别写入每一条附件记录；
+    转换失败时按重试策略决定稍后重试、标记失败或隔离
+    """
+    attachment_id = attachment.get('AttachmentId') if attachment else None
+    # 一个附件记录的转换是一条trace，流水线各阶段、工作进程和ODA输出的日志都带有相同的trace_id和关联字段
+    with tracing.span("convert_dwg_from_database", job_id=job_id, order_id=order_id, attachment_id=attachment_id,
+                      file=relative_dwg_path) as job_span:
+        try:
+            # 认领时已经解析好完整路径，其他调用方在这里解析
+            full_dwg_path = (attachment or {}).get('FullPath') or resolve_dwg_path(relative_dwg_path)
+            logger.debug("原始DWG路径(相对路径): %s, 完整DWG路径: %s", relative_dwg_path, full_dwg_path)
         
-        # 生成JPG输出路径（与源文件相同目录）
-        jpg_filename = f"{dwg_file_path.stem}.jpg"
-        jpg_path = dwg_file_path.parent / jpg_filename
+            dwg_file_path = Path(full_dwg_path)
+            # 生成JPG输出路径（与源文件相同目录）
+            jpg_filename = f"{dwg_file_path.stem}.jpg"
+            jpg_path = dwg_file_path.parent / jpg_filename
         
-        logger.info(f"准备将DWG文件转换为JPG: {dwg_file_path} -> {jpg_path}")
+            error_message, jpg_size, reason = await _shared_convert_source(dwg_file_path, jpg_path, skip_exists_check, job_id,
+                                                                   relative_dwg_path, attachment_id)
+            if error_message:
+                job_span.set_error(error_message)
+                job_span.set_attribute("reason", reason)
         
-        # 调用转换函数
-        success = converter_dwg_to_jpg(str(dwg_file_path), str(jpg_path))
+            if error_message == "文件不存在":
+                logger.error(f"系统订单{order_id}DWG文件不存在: {full_dwg_path}")
+                logger.error(f"系统订单{order_id}DWG文件相对路径: {relative_dwg_path}")
+                # 更新数据库状态：文件不存在时标记失败，共享目录暂时不可用时稍后重试
+                queue_conversion_failure(order_id, relative_dwg_path, error_message, reason, attachment)
+                return
+            if error_message:
+                logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_message}")
+                queue_conversion_failure(order_id, relative_dwg_path, error_message, reason, attachment)
+                return
+            
+            logger.info(f"成功将订单ID: {order_id} 的DWG文件转换为JPG，文件大小: {jpg_size} 字节")
         
-        if not success:
-            logger.error(f"转换订单ID: {order_id} 的DWG文件失败: DWG到JPG转换失败")
-            update_conversion_status(order_id, relative_dwg_path, "失败", "DWG到JPG转换失败")
-            return
+            # 更新转换状态为成功
+            queue_conversion_status(order_id, relative_dwg_path, "成功", attachment_id=attachment_id)
         
-        # 验证JPG文件是否成功创建
-        if not jpg_path.exists():
-            logger.error(f"转换订单ID: {order_id} 的DWG文件失败: JPG文件未创建")
-            update_conversion_status(order_id, relative_dwg_path, "失败", "JPG文件未创建")
-            return
-            
-        # 获取文件大小
-        jpg_size = jpg_path.stat().st_size
-        if jpg_size == 0:
-            logger.error(f"转换订单ID: {order_id} 的DWG文件失败: 创建的JPG文件为空")
-            update_conversion_status(order_id, relative_dwg_path, "失败", "创建的JPG文件为空")
-            return
-            
-        logger.info(f"成功将订单ID: {order_id} 的DWG文件转换为JPG，文件大小: {jpg_size} 字节")
+            # 记录转换成功信息到数据库，使用相对路径
+            queue_conversion_record(dwg_file_path.name, relative_dwg_path, str(jpg_path), "成功", jpg_size)
         
-        # 更新转换状态为成功
-        update_conversion_status(order_id, relative_dwg_path, "成功")
+            # 将生成的JPG文件插入到数据库附件表中
+            try:
+                # queue_jpg_attachment返回布尔值，表示JPG文件是否有效并已放入批量写入队列
+                success = queue_jpg_attachment(order_id, str(jpg_path), str(relative_dwg_path), attachment)
+                if success:
+                    logger.info(f"成功将JPG文件插入到数据库附件表，订单ID: {order_id}")
+                else:
+                    logger.warning(f"将JPG文件插入到数据库附件表失败，但不影响转换流程")
+            except Exception as db_error:
+                logger.error(f"插入JPG文件到数据库附件表失败: {str(db_error)}")
         
-        # 记录转换成功信息到数据库，使用相对路径
-        record_conversion_to_database(dwg_file_path.name, relative_dwg_path, str(jpg_path), "成功", jpg_size)
+        except Exception as e:
+            error_msg = str(e)
+            job_span.set_error(error_msg)
+            logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
         
-        # 将生成的JPG文件插入到数据库附件表中
-        try:
-            # insert_jpg_to_attachment返回布尔值，表示操作是否成功
-            success = insert_jpg_to_attachment(order_id, str(jpg_path), str(relative_dwg_path))
-            if success:
-                logger.info(f"成功将JPG文件插入到数据库附件表，订单ID: {order_id}")
+            # 记录转换失败信息到数据库，使用相对路径；按暂时性错误稍后重试，避免每一轮都重新认领
+            queue_conversion_record(dwg_file_path.name if 'dwg_file_path' in locals() else "未知", 
+                                    relative_dwg_path, "", "失败", 0, error_msg)
+            queue_conversion_failure(order_id, relative_dwg_path, error_msg, "exception", attachment)
+
+# 后台执行的数据库转换任务，包括定期任务派发的转换（保留引用，避免任务在完成前被垃圾回收；关闭时等待或取消）
+_background_tasks = set()
+
+async def _iter_claimed_files():
+    """按CLAIM_BATCH_SIZE分页认领，逐个产出待转换的DWG文件记录；应用关闭时停止"""
+    pages = iter_claimed_pages()
+    try:
+        async for page in pages:
+            for dwg_file in page:
+                if _draining:
+                    # 应用正在关闭，剩余文件的认领在关闭时释放
+                    logger.info("应用正在关闭，停止手动触发的数据库转换任务")
+                    return
+                yield dwg_file
+    finally:
+        # 提前结束时释放已预取但尚未处理的那一页的认领
+        await pages.aclose()
+
+async def _convert_database_files(skip_exists_check=False, job_id=None):
+    """分页认领并逐一转换待转换的DWG文件，并通过job_id发布进度事件
+
+    不一次认领全部待转换的文件：积压很多时一次认领会长时间锁定大量行，租约也可能在转换到之前过期
+
+    返回:
+    - 统计信息字典
+    """
+    stats = {
+        "total_files": 0,
+        "converted_files": 0,
+        "failed_files": 0,
+        "failed_files_details": []
+    }
+    dwg_files = _iter_claimed_files()
+    try:
+        # 逐一转换每个DWG文件
+        async for dwg_file in dwg_files:
+            stats["total_files"] += 1
+            order_id = dwg_file.get('id')
+            # 使用相对路径变量名，与periodic_check_and_convert函数保持一致
+            relative_dwg_path = dwg_file.get('FilePath')
+            
+            if order_id and relative_dwg_path:
+                logger.info(f"开始转换订单ID: {order_id} 的DWG文件: {relative_dwg_path} (相对路径)")
+                try:
+                    # 转换文件，传递skip_exists_check参数
+                    await convert_dwg_from_database(order_id, relative_dwg_path, skip_exists_check, job_id,
+                                                    attachment=dwg_file)
+                    stats["converted_files"] += 1
+                except Exception as e:
+                    error_msg = str(e)
+                    logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
+                    stats["failed_files"] += 1
+                    stats["failed_files_details"].append({
+                        "order_id": order_id,
+                        "file_path": relative_dwg_path,
+                        "error": error_msg
+                    })
             else:
-                logger.warning(f"将JPG文件插入到数据库附件表失败，但不影响转换流程")
-        except Exception as db_error:
-            logger.error(f"插入JPG文件到数据库附件表失败: {str(db_error)}")
-        
+                logger.warning(f"找到无效的DWG文件记录: {dwg_file}")
+                stats["failed_files"] += 1
     except Exception as e:
-        error_msg = str(e)
-        logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
-        
-        # 记录转换失败信息到数据库，使用相对路径
-        record_conversion_to_database(dwg_file_path.name if 'dwg_file_path' in locals() else "未知", 
-                                     relative_dwg_path, "", "失败", 0, error_msg)
+        progress.publish(job_id, "failed", error=str(e))
+        raise
+    finally:
+        await dwg_files.aclose()
+    
+    logger.info(f"手动触发数据库转换任务完成: 总计 {stats['total_files']} 个文件，成功 {stats['converted_files']} 个，失败 {stats['failed_files']} 个")
+    progress.publish(job_id, "done", total_files=stats["total_files"],
+                     converted_files=stats["converted_files"], failed_files=stats["failed_files"])
+    return stats
 
 # API端点：手动触发数据库查询和转换任务
 @app.post("/convert/database", tags=["数据库转换"])
-async def convert_from_database(skip_exists_check: bool = False):
+async def convert_from_database(skip_exists_check: bool = False, background: bool = False, job_id: str = None):
     """手动触发从数据库查询DWG文件并进行转换的任务
     
     参数:
     - skip_exists_check: 是否跳过文件存在性检查
+    - background: 是否在后台执行；为true时立即返回job_id，通过/jobs/{job_id}/events获取进度
+    - job_id: 可选的任务ID，客户端可以先通过POST /jobs创建并订阅/jobs/{job_id}/events，再发起请求
     
     返回:
     - 任务执行状态和统计信息
     """
+    if job_id and not progress.is_valid_job_id(job_id):
+        raise HTTPException(status_code=400, detail="无效的job_id")
+    
     try:
         logger.info(f"收到手动触发数据库转换任务的请求，skip_exists_check: {skip_exists_check}")
+        job_id = progress.create_job("database", job_id)
         
-        # 执行查询获取需要转换的DWG文件
-        dwg_files = get_dwg_files_from_database()
+        # 转换时按CLAIM_BATCH_SIZE分页认领（已被其他工作进程认领的文件会被跳过），
+        # 这里的待转换文件数只用于进度显示
+        pending_count = await run_db(repository.count_pending)
         
-        if not dwg_files:
+        if not pending_count:
             logger.info("未找到需要转换的DWG文件")
+            progress.publish(job_id, "done", total_files=0, converted_files=0, failed_files=0)
             return {
                 "status": "success",
                 "message": "未找到需要转换的DWG文件",
+                "job_id": job_id,
                 "total_files": 0,
                 "converted_files": 0,
                 "failed_files": 0
             }
         
-        logger.info(f"找到 {len(dwg_files)} 个需要转换的DWG文件")
+        logger.info(f"找到 {pending_count} 个需要转换的DWG文件")
+        progress.publish(job_id, "started", total_files=pending_count)
         
-        # 统计信息
-        stats = {
-            "total_files": len(dwg_files),
-            "converted_files": 0,
-            "failed_files": 0,
-            "failed_files_details": []
-        }
+        if background:
+            task = asyncio.create_task(_convert_database_files(skip_exists_check, job_id))
+            _background_tasks.add(task)
+            task.add_done_callback(_background_tasks.discard)
+            return {
+                "status": "accepted",
+                "message": "数据库转换任务已在后台启动",
+                "job_id": job_id,
+                "total_files": pending_count
+            }
         
-
-        # 逐一转换每个DWG文件
-        for dwg_file in dwg_files:
-            order_id = dwg_file.get('id')
-            # 使用相对路径变量名，与periodic_check_and_convert函数保持一致
-            relative_dwg_path = dwg_file.get('FilePath')
-            
-            if order_id and relative_dwg_path:
-                logger.info(f"开始转换订单ID: {order_id} 的DWG文件: {relative_dwg_path} (相对路径)")
-                try:
-                    # 转换文件，传递skip_exists_check参数
-                    await convert_dwg_from_database(order_id, relative_dwg_path, skip_exists_check)
-                    stats["converted_files"] += 1
-                except Exception as e:
-                    error_msg = str(e)
-                    logger.error(f"转换订单ID: {order_id} 的DWG文件失败: {error_msg}")
-                    stats["failed_files"] += 1
-                    stats["failed_files_details"].append({
-                        "order_id": order_id,
-                        "file_path": relative_dwg_path,
-                        "error": error_msg
-                    })
-            else:
-                logger.warning(f"找到无效的DWG文件记录: {dwg_file}")
-                stats["failed_files"] += 1
-                
-        logger.info(f"手动触发数据库转换任务完成: 总计 {stats['total_files']} 个文件，成功 {stats['converted_files']} 个，失败 {stats['failed_files']} 个")
+        stats = await _convert_database_files(skip_exists_check, job_id)
         
         return {
             "status": "success",
             "message": f"数据库转换任务执行完成",
+            "job_id": job_id,
             "total_files": stats["total_files"],
             "converted_files": stats["converted_files"],
             "failed_files": stats["failed_files"],
@@ -255,15 +502,34 @@ async def convert_from_database(skip_exists_check: bool = False):
     except Exception as e:
         error_msg = str(e)
         logger.error(f"手动触发数据库转换任务失败: {error_msg}")
+        progress.publish(job_id, "failed", error=error_msg)
         raise HTTPException(status_code=500, detail=f"执行数据库转换任务失败: {error_msg}")
 
+# API端点：唤醒定期任务
+@app.post("/poll/wake", tags=["数据库转换"])
+async def wake_poller():
+    """立即唤醒处于空闲等待中的定期任务，开始新一轮数据库轮询
+    
+    适用于上游系统新增待转换附件后主动通知，无需等待退避间隔到期
+    """
+    poll_scheduler.wake("http")
+    return {"status": "accepted", "message": "已唤醒定期检查任务"}
+
 # API端点：DWG到JPG转换
 @app.post("/convert/dwg-to-jpg", response_class=FileResponse)
-async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = File(...), background_tasks: BackgroundTasks = BackgroundTasks()):
-    """将DWG文件转换为JPG格式"""
+async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = File(...),
+                                      job_id: str = None):
+    """将DWG文件转换为JPG格式
+    
+    参数:
+    - job_id: 可选的任务ID，客户端可以先通过POST /jobs创建并订阅/jobs/{job_id}/events，再上传，以获取转换进度
+    """
     # 验证文件类型
     if not file.filename.lower().endswith(".dwg"):
         raise HTTPException(status_code=400, detail="仅支持DWG文件")
+    if job_id and not progress.is_valid_job_id(job_id):
+        raise HTTPException(status_code=400, detail="无效的job_id")
+    job_id = progress.create_job("upload", job_id)
     
     try:
         # 保存上传的DWG文件到临时目录
@@ -282,15 +548,18 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
         
         logger.info(f"已保存上传文件到: {dwg_path}")
         
-        # 使用新创建的包来转换DWG到JPG
-        success = converter_dwg_to_jpg(str(dwg_path), str(jpg_path))
+        # 先渲染到临时目录，完成后再原子地发布到输出路径，输出路径上不会出现写了一半的文件
+        staged_jpg_path = TEMP_DIR / f"{temp_filename}.render.jpg"
+        with tracing.span("convert_upload", job_id=job_id, order_id=order_id, file=file.filename):
+            result = await run_conversion(dwg_path, staged_jpg_path, job_id=job_id, file_label=file.filename)
         
-        if not success:
-            raise Exception("DWG到JPG转换失败")
+        if not result["success"]:
+            raise Exception(result["error"] or "DWG到JPG转换失败")
         
         # 验证JPG文件是否成功创建
-        if not jpg_path.exists():
-            raise FileNotFoundError(f"JPG文件未创建: {jpg_path}")
+        if not staged_jpg_path.exists():
+            raise FileNotFoundError(f"JPG文件未创建: {staged_jpg_path}")
+        await publisher.publish(staged_jpg_path, jpg_path, move=True)
             
         # 获取文件大小作为额外验证
         jpg_size = jpg_path.stat().st_size
@@ -299,24 +568,33 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
             
         logger.info(f"成功将 {file.filename} 转换为JPG，文件大小: {jpg_size} 字节")
         
+        # 将源文件和默认参数的渲染结果保存到内容寻址存储，后续可通过/images/{sha256}直接获取
+        source_sha256 = None
+        try:
+            # 计算SHA256和复制文件会读写整个文件，放到线程中执行，不阻塞事件循环
+            source_sha256 = await asyncio.to_thread(image_store.store_source, dwg_path)
+            await asyncio.to_thread(image_store.store_rendered, source_sha256, jpg_path)
+        except Exception as store_error:
+            logger.warning(f"保存到内容寻址存储失败: {str(store_error)}")
+        
         # 记录转换成功信息到数据库
         try:
             insert_query = """
                 INSERT INTO conversion_history (file_name, original_path, jpg_path, status, file_size)
                 VALUES (?, ?, ?, ?, ?)
             """
-            db.execute_query(
+            await run_db(repository.execute, (
                 insert_query,
                 (file.filename, str(dwg_path), str(jpg_path), "成功", jpg_size)
-            )
+            ))
             logger.info("转换记录已保存到数据库")
             
             # 将生成的JPG文件插入到数据库附件表中
             # 使用传入的订单ID（如果有）
             if order_id:
                 try:
-                    # insert_jpg_to_attachment返回布尔值，表示操作是否成功
-                    success = insert_jpg_to_attachment(order_id, str(jpg_path), str(dwg_path))
+                    # insert_attachment返回布尔值，表示操作是否成功
+                    success = await run_db(repository.insert_attachment, order_id, str(jpg_path), str(dwg_path))
                     if success:
                         logger.info(f"成功将JPG文件插入到数据库附件表，订单ID: {order_id}")
                     else:
@@ -328,12 +606,8 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
         except Exception as db_error:
             logger.error(f"保存转换记录到数据库失败: {str(db_error)}")
         
-        # 添加后台任务，在响应返回后清理临时文件
+        # 在响应返回后延迟清理临时文件
         def cleanup_files():
-            cleanup_delay = 300  # 延迟30秒清理文件，确保文件传输完成
-            logger.info(f"等待{cleanup_delay}秒后开始清理文件，确保文件传输完成...")
-            time.sleep(cleanup_delay)
-            
             # 清理DWG文件
             if dwg_path and hasattr(dwg_path, 'exists') and dwg_path.exists():
                 try:
@@ -368,62 +642,12 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
             if not any(hasattr(loc, 'exists') and loc.exists() for loc in jpg_locations):
                 logger.info(f"未找到需要清理的JPG文件，文件基础名: {jpg_basename}")
         
-        # 注册后台清理任务
-        background_tasks.add_task(cleanup_files)
-        
-        # 在返回前等待并验证JPG文件是否存在
-        max_wait_time = 30  # 最大等待时间（秒）
-        check_interval = 0.5  # 检查间隔（秒）
-        waited_time = 0
-        
-        # 循环检查文件是否存在、大小大于最小阈值且稳定（不再变化）
-        stable_size_count = 0
-        required_stable_checks = 3  # 需要连续3次检测到相同大小才算稳定
-        last_size = -1
-        MIN_JPG_SIZE = 500  # 设置最小JPG文件大小阈值（字节）
-        
-        while waited_time < max_wait_time:
-            if jpg_path.exists():
-                jpg_size = jpg_path.stat().st_size
-                
-                # 检查文件大小是否大于最小阈值
-                if jpg_size >= MIN_JPG_SIZE:
-                    # 检查文件大小是否稳定（不再变化）
-                    if jpg_size == last_size:
-                        stable_size_count += 1
-                        logger.info(f"JPG文件大小稳定({stable_size_count}/{required_stable_checks}): {jpg_path}，大小: {jpg_size} 字节")
-                        
-                        # 如果文件大小连续稳定了指定次数，认为文件已完全写入完成
-                        if stable_size_count >= required_stable_checks:
-                            logger.info(f"JPG文件已完全生成并准备提供服务: {jpg_path}，大小: {jpg_size} 字节")
-                            break
-                    else:
-                        # 文件大小仍在变化，重置稳定计数
-                        stable_size_count = 0
-                        last_size = jpg_size
-                        logger.info(f"JPG文件正在生成中，当前大小: {jpg_size} 字节，等待: {waited_time:.1f}秒")
-                elif jpg_size > 0:
-                    # 文件大小小于最小阈值，可能是临时文件或空文件头
-                    logger.warning(f"JPG文件大小过小（{jpg_size}字节），可能不是有效的JPG文件，继续等待... 当前等待: {waited_time:.1f}秒")
-                    # 不增加稳定计数，继续等待文件增长
-                    last_size = jpg_size
-                else:
-                    logger.info(f"JPG文件已存在但大小为0，等待文件写入完成... 当前等待: {waited_time:.1f}秒")
-            else:
-                logger.info(f"JPG文件尚未生成，等待中... 当前等待: {waited_time:.1f}秒")
-            
-            time.sleep(check_interval)
-            waited_time += check_interval
-        
-        # 再次验证文件是否存在且大小符合要求
-        if not jpg_path.exists():
-            raise FileNotFoundError(f"JPG文件在等待{max_wait_time}秒后仍未生成: {jpg_path}")
-        
-        jpg_size = jpg_path.stat().st_size
-        if jpg_size < MIN_JPG_SIZE:
-            raise ValueError(f"JPG文件大小过小（{jpg_size}字节），可能不是有效的JPG文件: {jpg_path}")
+        # 注册延迟清理任务（不占用请求，应用关闭时立即清理）
+        logger.info(f"{UPLOAD_CLEANUP_DELAY:g}秒后清理临时文件，确保文件传输完成")
+        schedule_cleanup(cleanup_files)
         
         logger.info(f"返回文件路径: {str(jpg_path)}")
+        progress.publish(job_id, "done", file=file.filename, file_size=jpg_size)
         # 导入URL编码模块
         
         # 对文件名进行URL编码，解决中文文件名在HTTP头部的编码问题
@@ -435,13 +659,16 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
             filename=f"{file.filename.rsplit('.', 1)[0]}.jpg",
             media_type="image/jpeg",
             headers={
-                "Content-Disposition": f"attachment; filename={encoded_filename}"
+                "Content-Disposition": f"attachment; filename={encoded_filename}",
                 # 注意：filename*参数在某些浏览器中可能需要，但大多数现代浏览器支持filename参数的UTF-8编码
+                "X-Job-Id": job_id,
+                **({"X-Source-SHA256": source_sha256} if source_sha256 else {})
             }
         )
         
     except Exception as e:
         logger.error(f"转换文件时出错: {str(e)}")
+        progress.publish(job_id, "failed", file=file.filename, error=str(e))
         
         # 记录转换失败信息到数据库
         try:
@@ -451,21 +678,430 @@ async def convert_dwg_to_jpg_endpoint(order_id: int = None, file: UploadFile = F
                 VALUES (?, ?, ?, ?, ?)
                 """
                 jpg_path_str = str(jpg_path) if 'jpg_path' in locals() and hasattr(jpg_path, '__str__') else ""
-                db.execute_query(
+                await run_db(repository.execute, (
                     insert_query,
                     (file.filename, str(dwg_path), jpg_path_str, "失败", str(e))
-                )
+                ))
                 logger.info("转换失败记录已保存到数据库")
         except Exception as db_error:
             logger.error(f"保存转换失败记录到数据库失败: {str(db_error)}")
         # 转换失败时立即清理临时文件
         if 'dwg_path' in locals() and dwg_path.exists():
             dwg_path.unlink()
+        if 'staged_jpg_path' in locals() and staged_jpg_path.exists():
+            staged_jpg_path.unlink()
         if 'jpg_path' in locals() and jpg_path.exists():
             jpg_path.unlink()
         
         raise HTTPException(status_code=500, detail=f"转换失败: {str(e)}")
 
+# 一次批量转换最多包含的DWG文件数（含ZIP包中的文件），防止ZIP炸弹
+BATCH_MAX_FILES = int(os.getenv("BATCH_MAX_FILES", "1000"))
+# 一次批量转换中上传和从ZIP包解压的DWG文件的总大小上限（MB）
+BATCH_MAX_EXTRACTED_MB = float(os.getenv("BATCH_MAX_EXTRACTED_MB", "2048"))
+BATCH_COPY_CHUNK_SIZE = 1024 * 1024
+
+class _ZipStreamWriter:
+    """不可定位的写入缓冲区，供zipfile边生成边输出ZIP数据"""
+
+    def __init__(self):
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        """取出当前已写入的数据并清空缓冲区"""
+        data = bytes(self.buffer)
+        self.buffer.clear()
+        return data
+
+def _unique_name(name, used_names):
+    """在已使用的名称集合中生成不重复的文件名"""
+    stem, suffix = os.path.splitext(name)
+    candidate = name
+    index = 1
+    while candidate.lower() in used_names:
+        candidate = f"{stem}_{index}{suffix}"
+        index += 1
+    used_names.add(candidate.lower())
+    return candidate
+
+def _remove_files(*paths):
+    for path in paths:
+        if path.exists():
+            path.unlink()
+
+def _collect_batch_items(uploads, workspace, manifest):
+    """把上传的DWG文件和ZIP包中的DWG文件保存到批量任务工作目录（同步读写文件，在线程池中调用）
+
+    文件数超过BATCH_MAX_FILES或总大小超过BATCH_MAX_EXTRACTED_MB时抛出413错误；
+    ZIP包在解压前按目录中记录的大小检查，解压时再按实际写入的字节数检查
+
+    返回:
+    - 待转换条目列表，每个条目包含原始文件名、DWG路径、JPG路径和ZIP中的输出名称
+    """
+    items = []
+    used_dwg_names = set()
+    used_jpg_names = set()
+    max_bytes = int(BATCH_MAX_EXTRACTED_MB * 1024 * 1024)
+    total_bytes = 0
+
+    def too_large(detail):
+        return HTTPException(status_code=413, detail=detail)
+
+    def check_limits(files, size):
+        if len(items) + files > BATCH_MAX_FILES:
+            raise too_large(f"DWG文件数超过上限{BATCH_MAX_FILES}")
+        if total_bytes + size > max_bytes:
+            raise too_large(f"DWG文件总大小超过上限{BATCH_MAX_EXTRACTED_MB:g}MB")
+
+    def add_item(source_name, reader):
+        nonlocal total_bytes
+        check_limits(1, 0)
+        dwg_name = _unique_name(Path(source_name).name, used_dwg_names)
+        dwg_path = workspace / dwg_name
+        with open(dwg_path, "wb") as buffer:
+            while True:
+                chunk = reader.read(BATCH_COPY_CHUNK_SIZE)
+                if not chunk:
+                    break
+                check_limits(0, len(chunk))
+                total_bytes += len(chunk)
+                buffer.write(chunk)
+        items.append({
+            "file": source_name,
+            "dwg_path": dwg_path,
+            "jpg_path": workspace / f"{dwg_path.stem}.jpg",
+            "output": _unique_name(f"{Path(source_name).stem}.jpg", used_jpg_names)
+        })
+
+    for upload in uploads:
+        filename = upload.filename or ""
+        lower_name = filename.lower()
+        if lower_name.endswith(".dwg"):
+            add_item(filename, upload.file)
+        elif lower_name.endswith(".zip"):
+            try:
+                with zipfile.ZipFile(upload.file) as archive:
+                    # 只取文件名部分，避免ZIP中的路径穿越
+                    members = [member for member in archive.infolist()
+                               if not member.is_dir() and member.filename.lower().endswith(".dwg")]
+                    check_limits(len(members), sum(member.file_size for member in members))
+                    for member in members:
+                        with archive.open(member) as reader:
+                            add_item(member.filename, reader)
+            except zipfile.BadZipFile:
+                logger.warning(f"无效的ZIP文件: {filename}")
+                manifest.append({"file": filename, "status": "跳过", "error": "无效的ZIP文件"})
+        else:
+            manifest.append({"file": filename, "status": "跳过", "error": "仅支持DWG文件或ZIP压缩包"})
+    return items
+
+# API端点：批量DWG到JPG转换
+@app.post("/convert/batch", tags=["批量转换"])
+async def convert_batch_endpoint(files: List[UploadFile] = File(...), job_id: str = None):
+    """批量将DWG文件转换为JPG格式，以ZIP流的形式返回结果
+
+    参数:
+    - files: 多个DWG文件，或包含DWG文件的ZIP压缩包
+    - job_id: 可选的任务ID，客户端可以先通过POST /jobs创建并订阅/jobs/{job_id}/events，再上传，以获取每个文件的转换进度
+
+    返回:
+    - ZIP文件流，每个文件转换完成后立即写入；最后附带manifest.json记录每个文件的状态和耗时
+    """
+    if job_id and not progress.is_valid_job_id(job_id):
+        raise HTTPException(status_code=400, detail="无效的job_id")
+    workspace = TEMP_DIR / f"batch_{uuid.uuid4().hex}"
+    workspace.mkdir(parents=True, exist_ok=True)
+    manifest = []
+
+    try:
+        items = await asyncio.to_thread(_collect_batch_items, files, workspace, manifest)
+    except HTTPException:
+        shutil.rmtree(workspace, ignore_errors=True)
+        raise
+    except Exception as e:
+        shutil.rmtree(workspace, ignore_errors=True)
+        logger.error(f"保存批量上传文件失败: {str(e)}")
+        raise HTTPException(status_code=500, detail=f"保存上传文件失败: {str(e)}")
+
+    if not items:
+        shutil.rmtree(workspace, ignore_errors=True)
+        raise HTTPException(status_code=400, detail="未找到可转换的DWG文件")
+
+    logger.info(f"收到批量转换请求，共 {len(items)} 个DWG文件，工作目录: {workspace}")
+    job_id = progress.create_job("batch", job_id)
+    progress.publish(job_id, "started", total_files=len(items))
+
+    async def convert_item(item):
+        try:
+            source_sha256 = await asyncio.to_thread(image_store.store_source, item["dwg_path"])
+        except Exception as store_error:
+            logger.warning(f"保存到内容寻址存储失败: {str(store_error)}")
+            source_sha256 = None
+        try:
+            with tracing.span("convert_batch_item", job_id=job_id, file=item["output"]):
+                result = await run_conversion(item["dwg_path"], item["jpg_path"], job_id=job_id,
+                                              file_label=item["output"])
+        except Exception as e:
+            # 单个文件出错只记录在清单中，不中断整个批量转换
+            logger.error(f"批量转换文件出错: {item['file']}: {str(e)}")
+            result = {"success": False, "error": f"转换出错: {str(e)}", "seconds": 0.0, "total_seconds": 0.0}
+        entry = {
+            "file": item["file"],
+            "output": item["output"],
+            "sha256": source_sha256,
+            "status": "成功" if result["success"] else "失败",
+            "error": result["error"],
+            "queue_seconds": round(result["total_seconds"] - result["seconds"], 3),
+            "convert_seconds": round(result["seconds"], 3),
+            "total_seconds": round(result["total_seconds"], 3),
+            "file_size": 0
+        }
+        if result["success"] and item["jpg_path"].exists():
+            entry["file_size"] = item["jpg_path"].stat().st_size
+            if source_sha256:
+                try:
+                    await asyncio.to_thread(image_store.store_rendered, source_sha256, item["jpg_path"])
+                except Exception as store_error:
+                    logger.warning(f"保存渲染结果到内容寻址存储失败: {str(store_error)}")
+        elif result["success"]:
+            entry["status"] = "失败"
+            entry["error"] = "JPG文件未创建"
+        queue_conversion_record(item["file"], str(item["dwg_path"]), str(item["jpg_path"]),
+                                entry["status"], entry["file_size"], entry["error"])
+        return item, entry
+
+    async def stream_zip():
+        writer = _ZipStreamWriter()
+        batch_started = time.perf_counter()
+        tasks = [asyncio.ensure_future(convert_item(item)) for item in items]
+        try:
+            # JPG本身已经压缩，使用ZIP_STORED避免重复压缩
+            with zipfile.ZipFile(writer, "w", compression=zipfile.ZIP_STORED) as archive:
+                for finished in asyncio.as_completed(tasks):
+                    item, entry = await finished
+                    manifest.append(entry)
+                    if entry["status"] == "成功":
+                        await asyncio.to_thread(archive.write, item["jpg_path"], entry["output"])
+                        yield writer.drain()
+                    # 输出成功后立即删除JPG，减少磁盘占用
+                    await asyncio.to_thread(_remove_files, item["dwg_path"], item["jpg_path"])
+
+                converted = sum(1 for entry in manifest if entry["status"] == "成功")
+                archive.writestr("manifest.json", json.dumps({
+                    "total_files": len(items),
+                    "converted_files": converted,
+                    "failed_files": len(items) - converted,
+                    "total_seconds": round(time.perf_counter() - batch_started, 3),
+                    "files": manifest
+                }, ensure_ascii=False, indent=2))
+            yield writer.drain()
+            logger.info(f"批量转换完成: 总计 {len(items)} 个文件，成功 {converted} 个")
+            progress.publish(job_id, "done", total_files=len(items), converted_files=converted,
+                             failed_files=len(items) - converted)
+        except Exception as e:
+            progress.publish(job_id, "failed", error=str(e))
+            raise
+        finally:
+            for task in tasks:
+                task.cancel()
+            shutil.rmtree(workspace, ignore_errors=True)
+
+    return StreamingResponse(
+        stream_zip(),
+        media_type="application/zip",
+        headers={"Content-Disposition": "attachment; filename=dwg2jpg_batch.zip", "X-Job-Id": job_id}
+    )
+
+# 图像响应的缓存时间（秒），内容寻址的图像不会变化，默认缓存一年
+IMAGE_CACHE_MAX_AGE = int(os.getenv("IMAGE_CACHE_MAX_AGE", "31536000"))
+IMAGE_RANGE_CHUNK_SIZE = 64 * 1024
+
+def _etag_matches(header_value, etag):
+    """判断If-None-Match/If-Range请求头是否与ETag匹配"""
+    if not header_value:
+        return False
+    if header_value.strip() == "*":
+        return True
+    candidates = [value.strip() for value in header_value.split(",")]
+    # If-None-Match使用弱比较，忽略W/前缀
+    return any(candidate.replace("W/", "", 1) == etag for candidate in candidates)
+
+def _parse_range(range_header, file_size):
+    """解析单段Range请求头
+
+    返回:
+    - (start, end)闭区间；请求头无法识别或为多段范围时返回None（按完整内容响应）
+    - 范围无法满足时抛出ValueError
+    """
+    if not range_header or not range_header.startswith("bytes=") or "," in range_header:
+        return None
+    start_text, separator, end_text = range_header[len("bytes="):].strip().partition("-")
+    if not separator or not (start_text or end_text):
+        return None
+    if (start_text and not start_text.isdigit()) or (end_text and not end_text.isdigit()):
+        return None
+
+    if start_text:
+        start = int(start_text)
+        end = int(end_text) if end_text else file_size - 1
+        if end_text and start > end:
+            return None
+    else:
+        # bytes=-N 表示最后N个字节
+        suffix_length = int(end_text)
+        if suffix_length == 0:
+            raise ValueError(f"无法满足的范围: {range_header}")
+        start = max(file_size - suffix_length, 0)
+        end = file_size - 1
+
+    if start >= file_size:
+        raise ValueError(f"无法满足的范围: {range_header}")
+    return start, min(end, file_size - 1)
+
+def _iter_file_range(path, start, length):
+    """按块读取文件中的指定范围"""
+    with open(path, "rb") as f:
+        f.seek(start)
+        remaining = length
+        while remaining > 0:
+            chunk = f.read(min(IMAGE_RANGE_CHUNK_SIZE, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+# API端点：按内容哈希获取渲染图像
+@app.get("/images/{sha256}", tags=["图像"])
+async def get_image(sha256: str, request: Request, size: int = 3200, dpi: int = 600, format: str = "jpg"):
+    """按DWG源文件内容的SHA256获取渲染图像，图像不存在时按需渲染
+
+    参数:
+    - sha256: DWG源文件内容的SHA256（上传转换时通过X-Source-SHA256响应头返回）
+    - size: 输出图像的宽度（像素）
+    - dpi: 输出图像的DPI
+    - format: 输出格式（jpg或png）
+
+    返回:
+    - 图像内容；支持ETag/If-None-Match条件请求（304）和Range请求（206）
+    """
+    sha256 = sha256.lower()
+    image_format = format.lower()
+    if not image_store.is_valid_sha256(sha256):
+        raise HTTPException(status_code=400, detail="无效的SHA256")
+    if image_format not in image_store.IMAGE_FORMATS:
+        raise HTTPException(status_code=400, detail=f"不支持的图像格式: {format}")
+    if not image_store.MIN_SIZE <= size <= image_store.MAX_SIZE:
+        raise HTTPException(status_code=400, detail=f"size必须在{image_store.MIN_SIZE}到{image_store.MAX_SIZE}之间")
+    if not image_store.MIN_DPI <= dpi <= image_store.MAX_DPI:
+        raise HTTPException(status_code=400, detail=f"dpi必须在{image_store.MIN_DPI}到{image_store.MAX_DPI}之间")
+
+    etag = image_store.make_etag(sha256, size, dpi, image_format)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={IMAGE_CACHE_MAX_AGE}, immutable",
+        "Accept-Ranges": "bytes"
+    }
+
+    # ETag只由源文件哈希和渲染参数决定，命中时无需检查或渲染图像
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
+
+    image_path = await image_store.get_or_render(sha256, size, dpi, image_format)
+    if image_path is None:
+        if not image_store.source_path(sha256).exists():
+            raise HTTPException(status_code=404, detail="未找到对应的DWG源文件")
+        raise HTTPException(status_code=500, detail="图像渲染失败")
+
+    media_type = image_store.IMAGE_FORMATS[image_format]
+    file_size = image_path.stat().st_size
+    range_header = request.headers.get("range")
+    if_range = request.headers.get("if-range")
+    if range_header and (not if_range or if_range.strip() == etag):
+        try:
+            byte_range = _parse_range(range_header, file_size)
+        except ValueError:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{file_size}"})
+        if byte_range:
+            start, end = byte_range
+            length = end - start + 1
+            return StreamingResponse(
+                _iter_file_range(image_path, start, length),
+                status_code=206,
+                media_type=media_type,
+                headers={
+                    **headers,
+                    "Content-Range": f"bytes {start}-{end}/{file_size}",
+                    "Content-Length": str(length)
+                }
+            )
+
+    return FileResponse(path=str(image_path), media_type=media_type, headers=headers)
+
+# API端点：预先创建任务
+@app.post("/jobs", tags=["任务进度"])
+async def create_job():
+    """创建一个尚未开始的任务并返回job_id
+
+    客户端先用它订阅/jobs/{job_id}/events，再把job_id传给转换接口，可以收到从排队开始的全部事件；
+    一直没有开始的任务在JOB_RETENTION_SECONDS秒后被清理
+    """
+    return {"job_id": progress.create_job("pending")}
+
+# API端点：查询任务状态
+@app.get("/jobs/{job_id}", tags=["任务进度"])
+async def get_job_status(job_id: str):
+    """获取任务的汇总状态（文件数、成功和失败数、最后一个事件）和最近的事件"""
+    job = progress.get_job(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    return dict(job.summary(), events=[event for _, event in job.events])
+
+# API端点：以Server-Sent Events推送任务进度
+@app.get("/jobs/{job_id}/events", tags=["任务进度"])
+async def stream_job_events(job_id: str, request: Request):
+    """以SSE流推送任务的阶段变化，任务结束（done/failed）后关闭连接
+
+    阶段依次为：queued、oda、parsing、rendering（附带已绘制实体的百分比）、encoding、file_done，
+    最后为done或failed；批量任务（/convert/batch、/convert/database）开始时还会推送started，
+    每个文件的事件带有file字段。支持Last-Event-ID断线续传。
+    任务不存在或已被清理时返回404；需要在发起转换前订阅时先通过POST /jobs创建任务。
+    """
+    if not progress.is_valid_job_id(job_id):
+        raise HTTPException(status_code=400, detail="无效的job_id")
+    if progress.get_job(job_id) is None:
+        raise HTTPException(status_code=404, detail="任务不存在")
+    last_event_id = request.headers.get("last-event-id", "")
+    last_event_id = int(last_event_id) if last_event_id.isdigit() else -1
+
+    async def event_stream():
+        async for index, event in progress.iter_events(job_id, last_event_id):
+            if await request.is_disconnected():
+                break
+            if event is None:
+                # 心跳注释，防止代理关闭空闲连接
+                yield ": keepalive\n\n"
+                continue
+            yield f"id: {index}\nevent: {event['stage']}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+# API端点：Prometheus指标
+@app.get("/metrics", tags=["监控"], response_class=PlainTextResponse)
+async def get_metrics():
+    """以Prometheus文本格式输出转换吞吐量、各阶段耗时、缓存命中、队列和工作进程内存等指标"""
+    return PlainTextResponse(metrics.render_metrics(), media_type=metrics.CONTENT_TYPE)
+
 # API根端点
 @app.get("/")
 async def root():
@@ -474,49 +1110,90 @@ async def root():
         "message": "欢迎使用DWG到JPG转换器API",
         "endpoints": [
             "/convert/dwg-to-jpg (POST) - 上传DWG文件转换为JPG",
+            "/convert/batch (POST) - 批量上传DWG文件或ZIP压缩包，以ZIP流返回JPG",
+            "/images/{sha256} (GET) - 按DWG内容哈希获取渲染图像，支持条件请求和Range请求",
+            "/metrics (GET) - Prometheus格式的转换吞吐量和延迟指标",
+            "/jobs (POST) - 预先创建任务，获取可以提前订阅进度的job_id",
+            "/jobs/{job_id}/events (GET) - 以Server-Sent Events推送转换任务的进度",
             "/conversion-history (GET) - 获取转换历史记录",
-            "/convert/database (POST) - 手动触发从数据库查询DWG文件并进行转换的任务"
+            "/convert/database (POST) - 手动触发从数据库查询DWG文件并进行转换的任务",
+            "/poll/wake (POST) - 唤醒定期任务立即轮询数据库"
         ]
     }
 
+# 转换历史总数的缓存时间（秒），避免每次翻页都对整张表执行COUNT(*)
+HISTORY_COUNT_CACHE_SECONDS = int(os.getenv("HISTORY_COUNT_CACHE_SECONDS", "60"))
+# 按状态缓存的总数: status -> (过期时间, 总数, 是否为估算值)
+_history_count_cache = {}
+
+def _encode_history_cursor(row):
+    """把一行历史记录的(conversion_time, id)编码为不透明的游标"""
+    conversion_time = row["conversion_time"]
+    if hasattr(conversion_time, "isoformat"):
+        conversion_time = conversion_time.isoformat()
+    raw = json.dumps([conversion_time, row["id"]]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def _decode_history_cursor(cursor):
+    """解析游标，返回(conversion_time, id)；游标无效时抛出ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        conversion_time, row_id = json.loads(raw)
+        return datetime.datetime.fromisoformat(conversion_time), int(row_id)
+    except Exception as e:
+        raise ValueError(f"无效的cursor: {cursor}") from e
+
+def _history_total(status=None):
+    """获取转换历史总数（带缓存，不按状态过滤时SQL Server返回估算值）
+
+    返回:
+    - (总数, 是否为估算值)
+    """
+    cached = _history_count_cache.get(status)
+    if cached and cached[0] > time.time():
+        return cached[1], cached[2]
+
+    total, estimated = get_repository().count_history(status)
+    _history_count_cache[status] = (time.time() + HISTORY_COUNT_CACHE_SECONDS, total, estimated)
+    return total, estimated
+
+def _iter_history_ndjson(status=None, cursor=None):
+    """逐行从数据库读取转换历史并输出NDJSON（在线程池中迭代）"""
+    for row in get_repository().iter_history(status, cursor):
+        yield json.dumps(row, ensure_ascii=False, default=str) + "\n"
+
 # 获取转换历史记录
 @app.get("/conversion-history")
-async def get_conversion_history(page: int = 1, page_size: int = 20, status: str = None):
+async def get_conversion_history(page: int = 1, page_size: int = 20, status: str = None, cursor: str = None,
+                                 format: str = "json"):
     """获取转换历史记录
     
     参数:
-    - page: 页码（默认为1）
+    - page: 页码（默认为1）；提供cursor时忽略
     - page_size: 每页记录数（默认为20）
     - status: 过滤状态（可选：成功/失败）
+    - cursor: 上一页响应中的next_cursor，提供时按键集分页（深度翻页时比page快得多）
+    - format: json（默认）或ndjson；ndjson以流的形式导出全部匹配的记录（每行一个JSON对象）
     """
+    if page < 1 or not 1 <= page_size <= 1000:
+        raise HTTPException(status_code=400, detail="page必须大于0，page_size必须在1-1000之间")
+    if format not in ("json", "ndjson"):
+        raise HTTPException(status_code=400, detail="format必须是json或ndjson")
     try:
-        offset = (page - 1) * page_size
-        query_parts = [
-            "SELECT id, file_name, original_path, jpg_path, conversion_time, status, file_size, error_message",
-            "FROM conversion_history",
-            "WHERE 1=1"
-        ]
-        params = []
-        
-        # 添加状态过滤条件
-        if status:
-            query_parts.append("AND status = ?")
-            params.append(status)
-        
-        # 添加排序和分页
-        query_parts.append("ORDER BY conversion_time DESC")
-        query_parts.append(f"OFFSET {offset} ROWS FETCH NEXT {page_size} ROWS ONLY")
-        
-        # 执行查询获取数据
-        query = "\n".join(query_parts)
-        results = db.execute_query(query, params)
+        position = _decode_history_cursor(cursor) if cursor else None
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    
+    if format == "ndjson":
+        return StreamingResponse(_iter_history_ndjson(status, position), media_type="application/x-ndjson")
+    
+    try:
+        # 提供游标时按键集分页，否则兼容按页码分页
+        offset = (page - 1) * page_size if position is None else 0
+        results = await run_db(get_repository().history_page, status, position, limit=page_size, offset=offset)
         
-        # 查询总记录数
-        count_query = "SELECT COUNT(*) AS total FROM conversion_history WHERE 1=1"
-        if status:
-            count_query += " AND status = ?"
-        total_result = db.execute_query(count_query, params if status else None)
-        total_count = total_result[0]['total'] if total_result else 0
+        # 查询总记录数（带缓存，不按状态过滤时为估算值）
+        total_count, total_is_estimate = await run_db(_history_total, status)
         
         # 计算总页数
         total_pages = (total_count + page_size - 1) // page_size
@@ -525,7 +1202,9 @@ async def get_conversion_history(page: int = 1, page_size: int = 20, status: str
             "page": page,
             "page_size": page_size,
             "total_count": total_count,
+            "total_count_estimated": total_is_estimate,
             "total_pages": total_pages,
+            "next_cursor": _encode_history_cursor(results[-1]) if len(results) == page_size else None,
             "data": results
         }
     except Exception as e:
@@ -542,9 +1221,9 @@ async def startup_event():
     """应用启动时执行的初始化任务"""
     logger.info("DWG到JPG转换器API正在启动...")
     
-    # 初始化数据库连接
-    if not db.conn or db.conn.closed:
-        db.connect()
+    # 初始化数据库连接（SQLite在首次访问时自动建表，不需要预先连接）
+    if DB_BACKEND == "sqlserver" and not db.connected:
+        await run_db(db.connect, timeout=None)
     
     # 启动定期检查任务
     # 注意：如果在生产环境中使用，应该考虑使用后台任务管理而不是简单的异步任务
@@ -552,16 +1231,94 @@ async def startup_event():
     if os.getenv("ENABLE_PERIODIC_TASK", "true").lower() == "true":
         logger.info("启动定期检查和转换任务")
         # 使用create_task而不是直接await，这样应用可以继续启动
-        asyncio.create_task(periodic_check_and_convert())
+        _service_tasks["periodic"] = asyncio.create_task(periodic_check_and_convert())
+    
+    # 启动认领续约任务（定期任务和手动触发的数据库转换都会认领文件）
+    _service_tasks["renew"] = asyncio.create_task(renew_claims_periodically())
+    
+    # 按保留时间和容量上限定期清理图像存储
+    if image_store.IMAGE_STORE_CLEANUP_INTERVAL > 0:
+        _service_tasks["image_store"] = asyncio.create_task(image_store.cleanup_periodically())
+    
+    # 清理以前异常退出时遗留的流水线工作目录
+    await asyncio.to_thread(remove_stale_workspaces)
+    
+    # 从最近的图纸复杂度记录恢复成本模型，重启后不需要重新积累样本
+    if COMPLEXITY_PROFILE:
+        try:
+            loaded = cost_model.load(await run_db(repository.recent_profiles, COST_MODEL_HISTORY))
+            logger.info(f"已从drawing_profile表恢复 {loaded} 个成本模型样本")
+        except Exception as e:
+            logger.error(f"恢复成本模型样本失败: {str(e)}")
     
     logger.info("DWG到JPG转换器API已成功启动")
 
+# 关闭时排空进行中的转换
+async def drain_conversions(timeout=SHUTDOWN_DRAIN_TIMEOUT):
+    """停止认领新文件并等待进行中的转换完成，超过timeout秒后取消剩余的转换
+    
+    被取消的文件不写入转换状态，其认领在关闭时释放，由其他工作进程（或重启后的本进程）重新转换
+    
+    返回:
+    - (完成的转换数, 取消的转换数)
+    """
+    global _draining
+    _draining = True
+    # 结束定期任务的空闲等待，使其立即退出
+    poll_scheduler.wake("shutdown")
+    
+    periodic = _service_tasks.get("periodic")
+    waiting = set(_background_tasks)
+    if periodic is not None and not periodic.done():
+        # 定期任务释放候选窗口中尚未派发的认领，等待它派发的转换完成后退出
+        waiting.add(periodic)
+    if not waiting:
+        return 0, 0
+    logger.info(f"停止认领新文件，等待 {len(_background_tasks)} 个进行中的转换完成（最多{timeout:g}秒）")
+    done, pending = await asyncio.wait(waiting, timeout=timeout)
+    if pending:
+        # 停止流水线，进行中的文件以CancelledError结束并清理工作目录，再取消等待它们的任务
+        pending |= set(_background_tasks)
+        await conversion_pipeline.stop()
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    drained = len(done - {periodic})
+    cancelled = len(pending - {periodic})
+    logger.info(f"转换已排空: 完成 {drained} 个，取消 {cancelled} 个（认领将被释放）")
+    return drained, cancelled
+
 # 应用关闭事件
 @app.on_event("shutdown")
 async def shutdown_event():
-    """应用关闭时执行的清理任务"""
+    """应用关闭时执行的清理任务
+    
+    依次: 停止认领并排空进行中的转换 -> 停止流水线、预取、转换进程池和写入线程池 ->
+    立即执行延迟清理并删除工作目录 -> 写入剩余的转换结果 -> 释放尚未完成的认领 -> 断开数据库
+    """
     try:
+        await drain_conversions()
+        for task in _service_tasks.values():
+            task.cancel()
+        await asyncio.gather(*_service_tasks.values(), return_exceptions=True)
+        await conversion_pipeline.stop()
+        await prefetcher.stop()
+        shutdown_executor(wait=False)
+        # 等待正在写回的结果文件完成，避免留下临时文件
+        await asyncio.to_thread(publisher.shutdown)
+        # 上传接口尚未清理的临时文件，以及被取消的转换遗留的工作目录
+        await run_pending_cleanups()
+        await asyncio.to_thread(remove_workspaces)
+        # 写入批量写入队列中剩余的转换结果（状态更新会同时释放对应的认领）
+        await asyncio.to_thread(batch_writer.stop)
+        # 导出剩余的追踪数据
+        await asyncio.to_thread(tracing.exporter.stop)
+        # 释放尚未完成的认领，其他工作进程无需等待租约过期即可接手
+        await run_db(repository.release_claims)
+        db_executor.shutdown(wait=False)
         db.disconnect()
         logger.info("应用已关闭，数据库连接已断开")
     except Exception as e:
-        logger.error(f"关闭数据库连接时出错: {str(e)}")
\ No newline at end of file
+        logger.error(f"关闭数据库连接时出错: {str(e)}")
+    # 写出日志队列中剩余的日志，之后的日志直接同步写出
+    stop_logging()
@@ -0,0 +1,341 @@
+import os
+import time
+import pickle
+import tempfile
+import threading
+from logger_config import logger
+from repository import get_repository, ERROR_DEADLOCK, ERROR_UNAVAILABLE
+from retry_policy import retry_policy
+import metrics
+import tracing
+
+# 批量写入配置
+# 转换结果（状态更新、转换记录、JPG附件）先放入内存队列，攒够一批或到达刷新间隔后
+# 在一个事务中用executemany一次性写入，避免每个文件多次往返数据库
+# 每批最多写入的语句数，达到该数量时立即刷新
+DB_WRITE_BATCH_SIZE = int(os.getenv("DB_WRITE_BATCH_SIZE", "50"))
+# 刷新间隔（秒），队列不满时最多等待这么久就写入
+DB_WRITE_FLUSH_INTERVAL = float(os.getenv("DB_WRITE_FLUSH_INTERVAL", "2"))
+# 发生死锁（错误1205 / SQLSTATE 40001）时的最大重试次数
+DB_WRITE_DEADLOCK_RETRIES = int(os.getenv("DB_WRITE_DEADLOCK_RETRIES", "3"))
+# 数据库不可用时内存队列中最多保留的语句数，超过后新提交的语句暂存到磁盘，数据库恢复后按顺序写入
+DB_WRITE_QUEUE_LIMIT = int(os.getenv("DB_WRITE_QUEUE_LIMIT", "10000"))
+# 暂存溢出语句的目录，默认为系统临时目录
+DB_WRITE_SPILL_DIR = os.getenv("DB_WRITE_SPILL_DIR") or None
+
+
+class BatchWriter:
+    """后台批量写入数据库（write-behind）
+
+    submit放入的语句按提交顺序分组，同一条SQL的参数用一次executemany写入，
+    整批在一个事务中提交；发生死锁时重试整个事务，数据库不可用时放回队列等待下次刷新。
+    内存队列（含正在写入的批次）达到queue_limit后，新提交的语句按顺序追加到磁盘上的暂存文件，
+    刷新时先写内存中的语句再读回暂存的语句，不丢弃语句；只有暂存文件也写不进去时才丢弃并计入指标。
+    整批因数据错误失败时逐条写入：死锁或数据库不可用时剩余的语句放回队列，被数据库拒绝的语句保存到拒绝文件
+    （与暂存文件同一目录）并计入指标，便于排查后手动补写。
+    每次刷新记录为一个db_write span，关联（links）提交这些语句的转换任务的span（暂存的语句不保留关联）。
+    """
+
+    def __init__(self, batch_size=DB_WRITE_BATCH_SIZE, flush_interval=DB_WRITE_FLUSH_INTERVAL,
+                 deadlock_retries=DB_WRITE_DEADLOCK_RETRIES, queue_limit=DB_WRITE_QUEUE_LIMIT, repository=None,
+                 spill_dir=DB_WRITE_SPILL_DIR):
+        self._repository = repository
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.deadlock_retries = deadlock_retries
+        self.queue_limit = queue_limit
+        self._pending = []
+        # 提交待写入语句时的span (trace_id, span_id)，刷新时作为db_write span的关联
+        self._pending_links = []
+        # 正在写入的语句数，计入队列上限，写入失败放回队列时不会超过上限
+        self._in_flight = 0
+        # 暂存文件，以及其中尚未读回的语句数和读取位置
+        self._spill_path = os.path.join(spill_dir or tempfile.gettempdir(),
+                                        f"dwg2jpg_db_write_spill_{os.getpid()}_{id(self)}.pkl")
+        self._spilled = 0
+        self._spill_offset = 0
+        # 被数据库拒绝（数据错误）的语句及错误信息
+        self._rejected_path = os.path.join(spill_dir or tempfile.gettempdir(),
+                                           f"dwg2jpg_db_write_rejected_{os.getpid()}_{id(self)}.pkl")
+        self._lock = threading.Lock()
+        # 同一时间只允许一个线程刷新，保证写入顺序
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """启动后台刷新线程（重复调用无影响）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="db-batch-writer", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                # 写入成功且还有暂存的语句时立即继续刷新
+                if self.flush() and self._spilled:
+                    self._wakeup.set()
+            except Exception as e:
+                logger.error(f"批量写入数据库时出错: {str(e)}")
+
+    def submit(self, statement):
+        """放入一条待写入的语句
+
+        参数:
+        - statement: (query, params)，为None时忽略（例如JPG文件无效时不需要写入）
+        """
+        if statement is None:
+            return
+        self.start()
+        span = tracing.current_span()
+        with self._lock:
+            # 已有暂存的语句时新语句也暂存，保证写入顺序
+            if self._spilled or len(self._pending) + self._in_flight >= self.queue_limit:
+                self._spill(statement)
+                return
+            self._pending.append(statement)
+            # 同一个转换任务连续提交的多条语句只关联一次
+            if span is not None and self._pending_links[-1:] != [(span.trace_id, span.span_id)]:
+                self._pending_links.append((span.trace_id, span.span_id))
+            pending = len(self._pending)
+        metrics.DB_WRITE_QUEUE.set(pending)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def pending_count(self):
+        """尚未写入的语句数（含暂存到磁盘的语句）"""
+        with self._lock:
+            return len(self._pending) + self._spilled
+
+    def _spill(self, statement):
+        """把一条语句追加到暂存文件（调用方持有self._lock），写入失败时丢弃该语句"""
+        try:
+            with open(self._spill_path, "ab") as f:
+                pickle.dump(statement, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            metrics.DB_WRITE_DROPPED.inc()
+            logger.error(f"批量写入队列已满且无法暂存到磁盘，丢弃一条语句: {str(e)}")
+            return
+        if not self._spilled:
+            logger.warning(f"批量写入队列已满，新的语句暂存到 {self._spill_path}")
+        self._spilled += 1
+        metrics.DB_WRITE_SPILLED.set(self._spilled)
+
+    def _load_spilled(self, limit):
+        """按顺序读回最多limit条暂存的语句（调用方持有self._lock），全部读回后删除暂存文件"""
+        statements = []
+        if not self._spilled or limit <= 0:
+            return statements
+        try:
+            with open(self._spill_path, "rb") as f:
+                f.seek(self._spill_offset)
+                while len(statements) < min(limit, self._spilled):
+                    statements.append(pickle.load(f))
+                self._spill_offset = f.tell()
+        except Exception as e:
+            # 暂存文件损坏或被删除，剩余的语句无法读回
+            lost = self._spilled - len(statements)
+            metrics.DB_WRITE_DROPPED.inc(lost)
+            logger.error(f"读取暂存的待写入语句失败，丢弃剩余的 {lost} 条语句: {str(e)}")
+            self._spilled = len(statements)
+        self._spilled -= len(statements)
+        if not self._spilled:
+            self._spill_offset = 0
+            try:
+                os.remove(self._spill_path)
+            except OSError:
+                pass
+        metrics.DB_WRITE_SPILLED.set(self._spilled)
+        return statements
+
+    def _requeue(self, batch, links=()):
+        """把写入失败的批次放回队列头部，等待数据库恢复后重试
+
+        正在写入的批次计入队列上限，放回后内存队列不会超过上限；批次中读回的暂存语句同样放回内存
+        """
+        with self._lock:
+            self._pending[:0] = batch
+            self._pending_links[:0] = links
+            pending = len(self._pending)
+        metrics.DB_WRITE_QUEUE.set(pending)
+
+    @property
+    def repository(self):
+        if self._repository is None:
+            self._repository = get_repository()
+        return self._repository
+
+    def _write_batch(self, batch):
+        """在一个事务中写入整批语句，同一条SQL的参数合并为一次executemany"""
+        self.repository.execute_batch(batch)
+
+    def _write_row_by_row(self, batch):
+        """整批写入因数据错误失败时逐条写入（每条一个事务），避免一条错误的语句拖累整批
+
+        返回:
+        - (成功写入的语句数, 因死锁或数据库不可用未能写入、需要放回队列的语句)
+        """
+        written = 0
+        for index, statement in enumerate(batch):
+            try:
+                self._write_batch([statement])
+            except Exception as e:
+                if self.repository.classify_error(e) in (ERROR_DEADLOCK, ERROR_UNAVAILABLE):
+                    logger.error(f"逐条写入失败，剩余的 {len(batch) - index} 条语句放回队列: {str(e)}")
+                    return written, batch[index:]
+                self._reject(statement, e)
+                continue
+            written += 1
+        return written, []
+
+    def _reject(self, statement, error):
+        """记录一条被数据库拒绝的语句（数据错误，重试也不会成功），保存到拒绝文件"""
+        query, params = statement
+        logger.error(f"语句被数据库拒绝: {str(error)}，查询: {query.strip()}，参数: {params}")
+        try:
+            with self._lock, open(self._rejected_path, "ab") as f:
+                pickle.dump((statement, str(error)), f, protocol=pickle.HIGHEST_PROTOCOL)
+        except Exception as e:
+            metrics.DB_WRITE_DROPPED.inc()
+            logger.error(f"无法保存被拒绝的语句，丢弃: {str(e)}")
+            return
+        metrics.DB_WRITE_REJECTED.inc()
+        logger.error(f"被拒绝的语句已保存到 {self._rejected_path}")
+
+    def flush(self):
+        """立即写入队列中的全部语句
+
+        返回:
+        - 成功写入的语句数
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                links, self._pending_links = self._pending_links, []
+                # 内存中的语句都早于暂存的语句，先写内存中的，再按顺序补上暂存的语句
+                batch += self._load_spilled(self.queue_limit - len(batch))
+                self._in_flight = len(batch)
+            metrics.DB_WRITE_QUEUE.set(0)
+            if not batch:
+                return 0
+            try:
+                with tracing.span("db_write", parent=None, links=links, statements=len(batch)) as write_span:
+                    return self._flush_batch(batch, links, write_span)
+            finally:
+                with self._lock:
+                    self._in_flight = 0
+
+    def _flush_batch(self, batch, links, write_span):
+        """写入一批语句，返回成功写入的语句数"""
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                self._write_batch(batch)
+            except Exception as e:
+                error_kind = self.repository.classify_error(e)
+                if error_kind == ERROR_DEADLOCK and attempt < self.deadlock_retries:
+                    attempt += 1
+                    write_span.set_attribute("deadlock_retries", attempt)
+                    metrics.DB_BATCH_FLUSHES.inc(result="deadlock_retry")
+                    logger.warning(f"批量写入发生死锁，第 {attempt} 次重试: {str(e)}")
+                    time.sleep(min(0.1 * 2 ** attempt, 2))
+                    continue
+                if error_kind in (ERROR_DEADLOCK, ERROR_UNAVAILABLE):
+                    metrics.DB_BATCH_FLUSHES.inc(result="requeued")
+                    write_span.set_error(e)
+                    logger.error(f"批量写入失败，{len(batch)} 条语句放回队列: {str(e)}")
+                    self._requeue(batch, links)
+                    return 0
+                metrics.DB_BATCH_FLUSHES.inc(result="row_by_row")
+                write_span.set_attribute("row_by_row", True)
+                logger.error(f"批量写入失败，改为逐条写入 {len(batch)} 条语句: {str(e)}")
+                written, remaining = self._write_row_by_row(batch)
+                if remaining:
+                    metrics.DB_BATCH_FLUSHES.inc(result="requeued")
+                    self._requeue(remaining)
+                return written
+
+            metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage="db_write")
+            metrics.DB_BATCH_SIZE.observe(len(batch))
+            metrics.DB_BATCH_FLUSHES.inc(result="success")
+            logger.info(f"已批量写入 {len(batch)} 条语句")
+            return len(batch)
+
+    def stop(self, timeout=None):
+        """停止后台线程并写入队列中剩余的语句（关闭服务时调用）"""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        written = 0
+        while True:
+            flushed = self.flush()
+            written += flushed
+            if not flushed or not self._spilled:
+                break
+        remaining = self.pending_count()
+        if remaining:
+            logger.error(f"关闭时仍有 {remaining} 条语句未能写入数据库（其中 {self._spilled} 条暂存在 {self._spill_path}）")
+        return written
+
+
+# 全局批量写入实例
+writer = BatchWriter()
+
+
+def queue_conversion_status(order_id, file_path, status, error_message="", attachment_id=None):
+    """批量写入：更新C_Attachment表中的转换状态并释放认领（参数与update_conversion_status一致）"""
+    writer.submit(writer.repository.status_statement(order_id, file_path, status, attachment_id))
+
+
+def queue_conversion_failure(order_id, file_path, error_message, reason, attachment=None):
+    """批量写入：按重试策略记录一次失败的转换并释放认领
+
+    参数:
+    - reason: 失败原因，决定稍后重试、标记失败还是隔离
+    - attachment: 认领到的附件记录，提供时按附件主键更新，并以其中的RetryCount和CrashCount作为已失败次数
+      和已导致崩溃或超时的次数
+
+    返回:
+    - 处理结果（retry、failed或quarantined）
+    """
+    attachment = attachment or {}
+    outcome, attempts, crashes, delay = retry_policy.decide(reason, attachment.get('RetryCount'),
+                                                            attachment.get('CrashCount'))
+    if outcome == "quarantined":
+        logger.error(f"文件反复导致转换进程崩溃或超时，已隔离: {file_path}（{reason}，第{crashes}次）")
+    writer.submit(writer.repository.failure_statement(order_id, file_path, outcome, attempts, crashes, delay,
+                                                      f"{reason}: {error_message}",
+                                                      attachment.get('AttachmentId')))
+    return outcome
+
+
+def queue_conversion_record(file_name, original_path, jpg_path, status, file_size=0, error_message=""):
+    """批量写入：记录转换信息到conversion_history表"""
+    writer.submit(writer.repository.history_statement(file_name, original_path, jpg_path, status, file_size,
+                                                      error_message))
+
+
+def queue_jpg_attachment(order_id, jpg_path, original_dwg_path, source_record=None):
+    """批量写入：把JPG文件插入到C_Attachment表，source_record参见build_jpg_attachment
+
+    返回:
+    - JPG文件有效并已放入队列时返回True
+    """
+    statement = writer.repository.attachment_statement(order_id, jpg_path, original_dwg_path, source_record)
+    writer.submit(statement)
+    return statement is not None
+
+
+def queue_drawing_profile(file_name, original_path, source_sha256, profile, **measurements):
+    """批量写入：记录图纸复杂度和渲染开销到drawing_profile表（参数与build_drawing_profile一致）"""
+    writer.submit(writer.repository.profile_statement(file_name, original_path, source_sha256, profile,
+                                                      **measurements))
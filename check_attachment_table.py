@@ -13,7 +13,7 @@ def get_attachment_table_structure():
         logger.info("开始获取C_Attachment表的结构信息")
         
         # 初始化数据库连接
-        if not db.conn:
+        if not db.connected:
             db.connect()
             logger.info("数据库连接成功")
         
@@ -74,7 +74,7 @@ def get_attachment_table_structure():
         logger.error(f"获取表结构过程中发生错误: {str(e)}")
     finally:
         # 断开数据库连接
-        if db.conn:
+        if db.connected:
             db.disconnect()
 
 
@@ -0,0 +1,361 @@
+import os
+import time
+import threading
+from collections import Counter, deque
+from logger_config import logger
+import metrics
+
+# 图纸复杂度分析配置
+# ODA生成DXF后先快速扫描一遍DXF文本（不解析为ezdxf文档），统计实体数、块嵌套深度、填充和文字数、顶点数和范围，
+# 用以往的统计结果和实际渲染耗时、峰值内存拟合成本模型，在渲染前预测耗时和内存，复杂的图纸交给专用的工作进程渲染
+# 是否在渲染前分析图纸复杂度
+COMPLEXITY_PROFILE = os.getenv("COMPLEXITY_PROFILE", "true").lower() == "true"
+# 预测渲染耗时超过该秒数的图纸为复杂图纸
+COMPLEXITY_HEAVY_SECONDS = float(os.getenv("COMPLEXITY_HEAVY_SECONDS", "120"))
+# 预测峰值内存超过该值（MB）的图纸为复杂图纸
+COMPLEXITY_HEAVY_MEMORY_MB = float(os.getenv("COMPLEXITY_HEAVY_MEMORY_MB", "2048"))
+# 成本模型样本不足时，展开块引用后的实体数超过该值的图纸为复杂图纸；0表示样本不足时不判断
+COMPLEXITY_HEAVY_ENTITIES = int(os.getenv("COMPLEXITY_HEAVY_ENTITIES", "500000"))
+# 成本模型至少需要的样本数，样本不足时不做预测
+COST_MODEL_MIN_SAMPLES = int(os.getenv("COST_MODEL_MIN_SAMPLES", "20"))
+# 成本模型保留的最近样本数（启动时也从drawing_profile表读取这么多条）
+COST_MODEL_HISTORY = int(os.getenv("COST_MODEL_HISTORY", "1000"))
+
+# 填充和文字实体的类型（文字的渲染开销远大于线段）
+_HATCH_TYPES = {"HATCH", "MPOLYGON", "SOLID", "TRACE"}
+_TEXT_TYPES = {"TEXT", "MTEXT", "ATTRIB", "ATTDEF"}
+# 附属于上一个实体的记录，不单独计为实体（POLYLINE的顶点按顶点计数）
+_SUB_ENTITY_TYPES = {"VERTEX", "SEQEND"}
+# 块引用展开的最大深度，超过时视为循环引用
+_MAX_BLOCK_DEPTH = 64
+# 图形范围未计算时DXF中保存的占位值
+_UNSET_EXTENT = 1e19
+
+
+class _Container:
+    """一个块定义（或模型空间）内实体的统计"""
+
+    __slots__ = ("entities", "hatches", "texts", "vertices", "inserts")
+
+    def __init__(self):
+        self.entities = 0
+        self.hatches = 0
+        self.texts = 0
+        self.vertices = 0
+        # 引用的块名称 -> 引用次数
+        self.inserts = Counter()
+
+
+# 扫描时关心的组码，其余组码的值不需要处理
+_SCANNED_CODES = {"0", "2", "9", "10", "11", "20", "67"}
+
+
+def _scan(stream):
+    """扫描DXF的组码，返回(模型空间统计, 块定义统计, 模型空间各类型实体数, 范围)"""
+    model = _Container()
+    blocks = {}
+    entity_counts = Counter()
+    extents = {}
+    section = None
+    container = None
+    # 当前实体的类型、引用的块名称、是否在图纸空间
+    entity = None
+    insert_name = None
+    paper_space = False
+    header_variable = None
+    expect_section_name = False
+
+    def finish_entity():
+        if entity is None or container is None or entity in ("BLOCK", "ENDBLK"):
+            return
+        if container is model:
+            if paper_space:
+                return
+            entity_counts[entity] += 1
+        if entity in _SUB_ENTITY_TYPES:
+            return
+        container.entities += 1
+        if entity in _HATCH_TYPES:
+            container.hatches += 1
+        elif entity in _TEXT_TYPES:
+            container.texts += 1
+        elif entity == "INSERT" and insert_name:
+            container.inserts[insert_name] += 1
+
+    lines = iter(stream)
+    # DXF由(组码, 值)两行一组组成
+    for code in lines:
+        code = code.strip()
+        value = next(lines, "")
+        if code not in _SCANNED_CODES:
+            continue
+        if code == "10" or code == "11":
+            # 主要坐标点：多段线、样条曲线、填充边界的每个顶点，直线的起点和终点
+            if container is not None and not paper_space and entity != "BLOCK":
+                container.vertices += 1
+                continue
+        value = value.strip()
+        if code == "0":
+            finish_entity()
+            entity, insert_name, paper_space = value, None, False
+            if value == "SECTION":
+                expect_section_name = True
+            elif value == "ENDSEC":
+                section, container, entity = None, None, None
+            elif section == "BLOCKS":
+                if value == "BLOCK":
+                    container = _Container()
+                elif value == "ENDBLK":
+                    container = None
+        elif expect_section_name and code == "2":
+            section = value
+            expect_section_name = False
+            container = model if section == "ENTITIES" else None
+            entity = None
+        elif section == "HEADER":
+            if code == "9":
+                header_variable = value
+            elif header_variable in ("$EXTMIN", "$EXTMAX") and code in ("10", "20"):
+                extents[(header_variable, code)] = float(value)
+        elif container is None:
+            continue
+        elif code == "2":
+            if entity == "BLOCK":
+                blocks[value] = container
+            elif entity == "INSERT":
+                insert_name = value
+        elif code == "67" and value == "1":
+            paper_space = True
+    finish_entity()
+    return model, blocks, entity_counts, extents
+
+
+def _expand(blocks, name, cache, depth=0):
+    """展开块引用后一个块的(实体数, 填充数, 文字数, 顶点数, 嵌套深度)，结果按块名称缓存"""
+    if name in cache:
+        return cache[name]
+    block = blocks.get(name)
+    if block is None or depth > _MAX_BLOCK_DEPTH:
+        return (0, 0, 0, 0, 0)
+    # 先占位，循环引用时按空块处理
+    cache[name] = (0, 0, 0, 0, 0)
+    result = _expand_container(blocks, block, cache, depth + 1)
+    cache[name] = result
+    return result
+
+
+def _expand_container(blocks, container, cache, depth=0):
+    entities, hatches, texts, vertices = container.entities, container.hatches, container.texts, container.vertices
+    nesting = 0
+    for name, count in container.inserts.items():
+        child = _expand(blocks, name, cache, depth)
+        entities += count * child[0]
+        hatches += count * child[1]
+        texts += count * child[2]
+        vertices += count * child[3]
+        nesting = max(nesting, child[4] + 1)
+    return (entities, hatches, texts, vertices, nesting)
+
+
+def _extent(extents, variable, code):
+    value = extents.get((variable, code))
+    if value is None or abs(value) >= _UNSET_EXTENT:
+        return None
+    return value
+
+
+def profile_dxf(dxf_path):
+    """快速扫描ASCII DXF文件，统计影响渲染开销的复杂度指标
+
+    只逐行读取组码，不构建ezdxf文档，耗时远小于解析和渲染。只统计模型空间（渲染的内容），
+    块引用按引用次数展开计入实体数、填充数、文字数和顶点数。
+
+    返回:
+    - 字典，包含file_size、entity_count（模型空间实体数）、expanded_entity_count（展开块引用后的实体数）、
+      block_count、block_depth（块引用的最大嵌套深度）、hatch_count、text_count、vertex_count、
+      extent_min_x/extent_min_y/extent_max_x/extent_max_y（图形范围，未知时为None）、
+      entity_counts（模型空间各类型实体数）和scan_seconds；二进制DXF或读取失败时返回None
+    """
+    started = time.perf_counter()
+    try:
+        with open(dxf_path, "rb") as f:
+            if f.read(22) == b"AutoCAD Binary DXF\r\n\x1a\x00":
+                logger.debug("二进制DXF文件不做复杂度分析: %s", dxf_path)
+                return None
+        # R2007及以上版本的DXF为UTF-8，更早的版本为本地代码页，这里只关心组码和ASCII名称
+        with open(dxf_path, "r", encoding="utf-8", errors="replace") as f:
+            model, blocks, entity_counts, extents = _scan(f)
+        file_size = os.path.getsize(dxf_path)
+    except (OSError, ValueError) as e:
+        logger.error(f"分析DXF文件复杂度失败: {dxf_path}: {str(e)}")
+        return None
+
+    entities, hatches, texts, vertices, depth = _expand_container(blocks, model, {})
+    seconds = time.perf_counter() - started
+    metrics.STAGE_DURATION.observe(seconds, stage="profile")
+    return {
+        "file_size": file_size,
+        "entity_count": sum(count for entity, count in entity_counts.items() if entity not in _SUB_ENTITY_TYPES),
+        "expanded_entity_count": entities,
+        "block_count": len(blocks),
+        "block_depth": depth,
+        "hatch_count": hatches,
+        "text_count": texts,
+        "vertex_count": vertices,
+        "extent_min_x": _extent(extents, "$EXTMIN", "10"),
+        "extent_min_y": _extent(extents, "$EXTMIN", "20"),
+        "extent_max_x": _extent(extents, "$EXTMAX", "10"),
+        "extent_max_y": _extent(extents, "$EXTMAX", "20"),
+        "entity_counts": dict(entity_counts.most_common()),
+        "scan_seconds": seconds,
+    }
+
+
+def _features(profile):
+    """成本模型的特征向量（按量级缩放，避免不同特征的系数相差过大）"""
+    return [
+        1.0,
+        profile["expanded_entity_count"] / 1e4,
+        profile["vertex_count"] / 1e5,
+        profile["hatch_count"] / 1e3,
+        profile["text_count"] / 1e3,
+        profile["block_depth"],
+        profile["file_size"] / 1024 / 1024 / 10,
+    ]
+
+
+def _solve(matrix, vector):
+    """高斯消元求解线性方程组（矩阵为对称正定，维数很小）"""
+    n = len(vector)
+    rows = [list(matrix[i]) + [vector[i]] for i in range(n)]
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        if abs(rows[col][col]) < 1e-12:
+            return None
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    solution = [0.0] * n
+    for i in range(n - 1, -1, -1):
+        solution[i] = (rows[i][n] - sum(rows[i][c] * solution[c] for c in range(i + 1, n))) / rows[i][i]
+    return solution
+
+
+def _ridge_fit(samples, ridge):
+    """带L2正则的最小二乘拟合，返回系数；截距不做正则"""
+    size = len(samples[0][0])
+    gram = [[0.0] * size for _ in range(size)]
+    moment = [0.0] * size
+    for features, target in samples:
+        for i in range(size):
+            moment[i] += features[i] * target
+            for j in range(size):
+                gram[i][j] += features[i] * features[j]
+    for i in range(1, size):
+        gram[i][i] += ridge
+    return _solve(gram, moment)
+
+
+class CostModel:
+    """根据图纸复杂度预测渲染耗时和峰值内存
+
+    对最近的样本（复杂度指标、工作进程内的渲染耗时、峰值内存）做带正则的线性回归，
+    有新样本时在下一次预测前重新拟合；样本少于min_samples时不做预测
+    """
+
+    def __init__(self, min_samples=COST_MODEL_MIN_SAMPLES, history=COST_MODEL_HISTORY, ridge=1.0):
+        self.min_samples = min_samples
+        self.ridge = ridge
+        self._samples = deque(maxlen=max(history, 1))
+        self._coefficients = None
+        self._dirty = False
+        self._lock = threading.Lock()
+
+    @property
+    def sample_count(self):
+        return len(self._samples)
+
+    def observe(self, profile, seconds, peak_memory_bytes=None):
+        """记录一次渲染的复杂度指标、耗时（秒）和峰值内存（字节，未知时为None）"""
+        if profile is None or seconds is None or seconds < 0:
+            return
+        memory_mb = peak_memory_bytes / 1024 / 1024 if peak_memory_bytes else None
+        with self._lock:
+            self._samples.append((_features(profile), seconds, memory_mb))
+            self._dirty = True
+        metrics.COST_MODEL_SAMPLES.set(len(self._samples))
+
+    def load(self, rows):
+        """从drawing_profile表的记录（字段与profile_dxf的返回值相同，另有render_seconds和peak_memory_bytes）恢复样本
+
+        返回:
+        - 恢复的样本数
+        """
+        loaded = 0
+        # 记录按时间倒序返回，按时间顺序放入，保留最近的样本
+        for row in reversed(rows):
+            try:
+                self.observe(row, row["render_seconds"], row.get("peak_memory_bytes"))
+                loaded += 1
+            except (KeyError, TypeError) as e:
+                logger.debug("忽略无效的图纸复杂度记录: %s", e)
+        return loaded
+
+    def _fit(self):
+        seconds_samples = [(features, seconds) for features, seconds, _ in self._samples]
+        memory_samples = [(features, memory) for features, _, memory in self._samples if memory is not None]
+        seconds_coefficients = _ridge_fit(seconds_samples, self.ridge)
+        memory_coefficients = (_ridge_fit(memory_samples, self.ridge)
+                               if len(memory_samples) >= self.min_samples else None)
+        self._coefficients = (seconds_coefficients, memory_coefficients)
+        self._dirty = False
+
+    def predict(self, profile):
+        """预测渲染耗时和峰值内存
+
+        返回:
+        - (预测耗时（秒）, 预测峰值内存（字节）)，无法预测的项为None
+        """
+        if profile is None:
+            return None, None
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None, None
+            if self._dirty or self._coefficients is None:
+                self._fit()
+            seconds_coefficients, memory_coefficients = self._coefficients
+        features = _features(profile)
+        seconds = memory = None
+        if seconds_coefficients is not None:
+            seconds = max(sum(w * x for w, x in zip(seconds_coefficients, features)), 0.0)
+        if memory_coefficients is not None:
+            memory = max(sum(w * x for w, x in zip(memory_coefficients, features)), 0.0) * 1024 * 1024
+        return seconds, memory
+
+
+def is_heavy(profile, predicted_seconds=None, predicted_memory_bytes=None):
+    """判断图纸是否需要交给专用的工作进程渲染
+
+    有预测值时按COMPLEXITY_HEAVY_SECONDS和COMPLEXITY_HEAVY_MEMORY_MB判断；
+    都没有预测值（成本模型样本不足）时按展开后的实体数是否超过COMPLEXITY_HEAVY_ENTITIES判断
+    """
+    if profile is None:
+        return False
+    if predicted_seconds is None and predicted_memory_bytes is None:
+        return bool(COMPLEXITY_HEAVY_ENTITIES) and profile["expanded_entity_count"] > COMPLEXITY_HEAVY_ENTITIES
+    if predicted_seconds is not None and predicted_seconds > COMPLEXITY_HEAVY_SECONDS:
+        return True
+    return predicted_memory_bytes is not None and predicted_memory_bytes > COMPLEXITY_HEAVY_MEMORY_MB * 1024 * 1024
+
+
+def relative_error(predicted, actual):
+    """预测值相对实际值的误差（|预测-实际| / 实际），无法计算时返回None"""
+    if predicted is None or not actual or actual <= 0:
+        return None
+    return abs(predicted - actual) / actual
+
+
+# 全局成本模型
+cost_model = CostModel()
@@ -2,17 +2,19 @@
 from pathlib import Path
 from logger_config import logger
 # 注意：dwg2jpg.converter模块没有提供convert_dwg_to_pdf函数，提供了convert_dwg_to_jpg函数
-from dwg2jpg.converter import convert_dwg_to_jpg
+from dwg2jpg.converter import convert_dwg_to_jpg, convert_dxf_to_jpg, read_dxf
+import time
 
 
 
-def converter_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_color='black', dpi=600):
+def converter_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_color='black', dpi=600, image_format='jpg',
+                         timings=None, progress=None):
     """使用dwg2jpg库将DWG文件转换为JPG图像"""
-    logger.info(f"使用dwg2jpg库进行DWG到JPG转换: {dwg_path} -> {jpg_path}")
+    logger.debug("使用dwg2jpg库进行DWG到JPG转换: %s -> %s", dwg_path, jpg_path)
     
     try:
         # 调用dwg2jpg库的转换函数
-        success = convert_dwg_to_jpg(dwg_path, jpg_path, size, bg_color, line_color, dpi)
+        success = convert_dwg_to_jpg(dwg_path, jpg_path, size, bg_color, line_color, dpi, image_format, timings, progress)
         
         # 验证转换结果
         jpg_file = Path(jpg_path)
@@ -24,8 +26,33 @@ def converter_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_c
         if jpg_size == 0:
             raise ValueError(f"创建的JPG文件为空: {jpg_size} 字节")
         
-        logger.info(f"dwg2jpg库转换成功，JPG文件大小: {jpg_size} 字节")
+        logger.debug("dwg2jpg库转换成功，JPG文件大小: %d 字节", jpg_size)
         return True
     except Exception as e:
         logger.error(f"dwg2jpg库转换失败: {str(e)}")
-        return False
\ No newline at end of file
+        return False
+
+
+def converter_dxf_to_jpg(dxf_path, jpg_path, size=3200, bg_color='white', line_color='black', dpi=600,
+                         image_format='jpg', timings=None, progress=None):
+    """把ODA生成的DXF文件解析并渲染为JPG图像（流水线中的渲染阶段，ODA转换由前一阶段完成）"""
+    logger.debug("使用dwg2jpg库进行DXF到JPG转换: %s -> %s", dxf_path, jpg_path)
+    
+    try:
+        if progress is not None:
+            progress("parsing", None)
+        started = time.perf_counter()
+        doc = read_dxf(dxf_path)
+        if timings is not None:
+            timings["parse"] = time.perf_counter() - started
+        
+        if not convert_dxf_to_jpg(doc, jpg_path, size, bg_color, line_color, dpi, image_format, timings, progress):
+            return False
+        
+        jpg_file = Path(jpg_path)
+        if not jpg_file.exists() or jpg_file.stat().st_size == 0:
+            raise FileNotFoundError(f"JPG文件未创建或为空: {jpg_path}")
+        return True
+    except Exception as e:
+        logger.error(f"dwg2jpg库DXF转换失败: {str(e)}")
+        return False
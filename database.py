@@ -1,23 +1,253 @@
 import os
+import json
+import math
+import time
+import uuid
+import socket
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from pathlib import Path
 from dotenv import load_dotenv
-import pyodbc
 import os
 from typing import List, Dict, Any, Optional
 from logger_config import logger
+from scheduler import claim_priority_sql
+import metrics
 
 # 加载.env文件中的环境变量
 load_dotenv()
+
+# 连接池配置
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+# 借出连接的最长等待时间（秒）
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+# 空闲超过该时间（秒）的连接在借出前先做健康检查
+DB_POOL_HEALTH_CHECK_IDLE = float(os.getenv("DB_POOL_HEALTH_CHECK_IDLE", "30"))
+# 单条语句的执行超时（秒），0表示不限制
+DB_STATEMENT_TIMEOUT = int(os.getenv("DB_STATEMENT_TIMEOUT", "60"))
+# 建立连接失败时的重试次数，重试间隔按指数退避
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", "3"))
+DB_CONNECT_BACKOFF_MAX = 10
+# 从游标分批读取结果行时每批的行数
+DB_FETCH_SIZE = int(os.getenv("DB_FETCH_SIZE", "500"))
+# 异步访问数据库的专用线程池大小（默认与连接池最大连接数一致）
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", str(DB_POOL_MAX_SIZE)))
+# 异步数据库调用最多排队的数量，超过后调用方等待（背压），避免请求无限堆积
+DB_EXECUTOR_QUEUE_LIMIT = int(os.getenv("DB_EXECUTOR_QUEUE_LIMIT", "100"))
+# 异步数据库调用的默认超时（秒），同时作为这次调用中每条语句的执行超时
+DB_QUERY_TIMEOUT = float(os.getenv("DB_QUERY_TIMEOUT", "30"))
+
+# 当前线程中数据库调用的语句超时（由DBExecutor设置）
+_call_context = threading.local()
+
+
+def _iter_rows(cursor, batch_size=DB_FETCH_SIZE):
+    """从游标分批读取结果行，逐行产出字典"""
+    # 获取列名
+    columns = [column[0] for column in cursor.description]
+    while True:
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return
+        for row in rows:
+            yield dict(zip(columns, row))
+
+def _pyodbc():
+    """延迟导入pyodbc：只有SQL Server后端用到，使用SQLite后端时不需要安装pyodbc和unixODBC"""
+    import pyodbc
+    return pyodbc
+
+def _is_connection_error(error):
+    """判断pyodbc错误是否表示连接已断开（SQLSTATE 08xxx）"""
+    state = error.args[0] if error.args else ""
+    return isinstance(state, str) and state.startswith("08")
+
+
+@contextmanager
+def _statement_timeout(conn):
+    """在DBExecutor中调用时，把这次调用的超时设置为连接的语句超时，结束后恢复"""
+    timeout = getattr(_call_context, "timeout", None)
+    if not timeout:
+        yield
+        return
+    previous = conn.timeout
+    conn.timeout = max(int(math.ceil(timeout)), 1)
+    try:
+        yield
+    finally:
+        try:
+            conn.timeout = previous
+        except _pyodbc().Error:
+            pass
+
+
+class ConnectionPool:
+    """线程安全的pyodbc连接池
+    
+    连接以自动提交模式创建，需要多条语句组成一个事务时使用SQLDatabase.transaction()。
+    """
+    
+    def __init__(self, conn_str, min_size=DB_POOL_MIN_SIZE, max_size=DB_POOL_MAX_SIZE,
+                 timeout=DB_POOL_TIMEOUT, statement_timeout=DB_STATEMENT_TIMEOUT,
+                 health_check_idle=DB_POOL_HEALTH_CHECK_IDLE):
+        self.conn_str = conn_str
+        self.min_size = min_size
+        self.max_size = max(max_size, 1)
+        self.timeout = timeout
+        self.statement_timeout = statement_timeout
+        self.health_check_idle = health_check_idle
+        # 空闲连接栈，元素为(连接, 归还时间)，后进先出以便少用的连接自然老化
+        self._idle = []
+        self._size = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        for _ in range(min(self.min_size, self.max_size)):
+            conn = self._create_connection()
+            self._idle.append((conn, time.monotonic()))
+            self._size += 1
+        self._update_gauges()
+    
+    def _create_connection(self):
+        """建立新连接，失败时按指数退避重试"""
+        delay = 0.5
+        for attempt in range(1, DB_CONNECT_RETRIES + 1):
+            try:
+                conn = _pyodbc().connect(self.conn_str, autocommit=True)
+                if self.statement_timeout:
+                    conn.timeout = self.statement_timeout
+                return conn
+            except _pyodbc().Error as e:
+                if attempt >= DB_CONNECT_RETRIES:
+                    raise
+                logger.warning(f"建立数据库连接失败（第{attempt}次），{delay}秒后重试: {str(e)}")
+                time.sleep(delay)
+                delay = min(delay * 2, DB_CONNECT_BACKOFF_MAX)
+    
+    @staticmethod
+    def _is_healthy(conn):
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute("SELECT 1")
+                cursor.fetchone()
+            return True
+        except _pyodbc().Error:
+            return False
+    
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except Exception:
+            pass
+    
+    def _update_gauges(self):
+        idle = len(self._idle)
+        metrics.DB_POOL_CONNECTIONS.set(idle, state="idle")
+        metrics.DB_POOL_CONNECTIONS.set(self._size - idle, state="in_use")
+    
+    def acquire(self, timeout=None):
+        """借出一个连接，连接池已满时最多等待timeout秒"""
+        started = time.perf_counter()
+        deadline = time.monotonic() + (self.timeout if timeout is None else timeout)
+        conn = None
+        last_used = None
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise RuntimeError("数据库连接池已关闭")
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.max_size:
+                    # 占位后在锁外建立连接，避免阻塞其他线程
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    metrics.DB_POOL_TIMEOUTS.inc()
+                    raise TimeoutError(f"等待数据库连接超时（连接池大小: {self.max_size}）")
+                self._cond.wait(remaining)
+            self._update_gauges()
+        
+        try:
+            if conn is None:
+                conn = self._create_connection()
+            elif time.monotonic() - last_used > self.health_check_idle and not self._is_healthy(conn):
+                logger.warning("数据库连接健康检查失败，重新建立连接")
+                metrics.DB_RECONNECTS.inc()
+                self._close_quietly(conn)
+                conn = self._create_connection()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._update_gauges()
+                self._cond.notify()
+            raise
+        
+        metrics.DB_POOL_WAIT.observe(time.perf_counter() - started)
+        return conn
+    
+    def release(self, conn, discard=False):
+        """归还连接；discard为True时关闭连接（例如连接已断开）"""
+        if discard:
+            metrics.DB_RECONNECTS.inc()
+        with self._cond:
+            if discard or self._closed:
+                self._close_quietly(conn)
+                self._size -= 1
+            else:
+                self._idle.append((conn, time.monotonic()))
+            self._update_gauges()
+            self._cond.notify()
+    
+    @contextmanager
+    def connection(self):
+        """借出连接的上下文管理器，退出时自动归还"""
+        conn = self.acquire()
+        discard = False
+        try:
+            yield conn
+        except _pyodbc().Error as e:
+            discard = _is_connection_error(e)
+            raise
+        finally:
+            self.release(conn, discard)
+    
+    def stats(self):
+        """连接池使用情况"""
+        with self._cond:
+            idle = len(self._idle)
+            return {"size": self._size, "idle": idle, "in_use": self._size - idle, "max_size": self.max_size}
+    
+    def close(self):
+        """关闭连接池中的全部空闲连接，使用中的连接在归还时关闭"""
+        with self._cond:
+            self._closed = True
+            for conn, _ in self._idle:
+                self._close_quietly(conn)
+            self._size -= len(self._idle)
+            self._idle.clear()
+            self._update_gauges()
+            self._cond.notify_all()
+
+
 class SQLDatabase:
     """SQL数据库连接和操作类"""
     
     def __init__(self):
-        """初始化数据库连接"""
-        self.conn = None
-        self.connect()
+        """初始化（导入时不连接数据库，首次执行查询或调用connect()时才建立连接池）"""
+        self.pool = None
+    
+    @property
+    def connected(self):
+        """连接池是否可用"""
+        return self.pool is not None
     
     def connect(self):
-        """建立数据库连接"""
+        """建立数据库连接池"""
         try:
             # 从环境变量获取数据库连接信息
             server = os.getenv("DB_SERVER", "localhost")
@@ -36,68 +266,112 @@ class SQLDatabase:
                 "TrustServerCertificate=yes;"
             )
             
-            # 建立连接
-            self.conn = pyodbc.connect(conn_str)
-            logger.info(f"成功连接到数据库: {server}/{database}")
+            # 建立连接池
+            self.pool = ConnectionPool(conn_str)
+            logger.info(f"成功连接到数据库: {server}/{database}，连接池大小: {DB_POOL_MIN_SIZE}-{DB_POOL_MAX_SIZE}")
         except Exception as e:
-            print(server,database,username,password,driver)
             logger.error(f"数据库连接失败: {str(e)}")
-            self.conn = None
+            self.pool = None
+    
+    def _get_pool(self):
+        """获取连接池，不可用时尝试重新建立"""
+        if self.pool is None:
+            self.connect()
+            if self.pool is None:
+                raise Exception("无法建立数据库连接")
+        return self.pool
     
-    def execute_query(self, query: str, params: tuple = None) -> List[Dict[str, Any]]:
+    @contextmanager
+    def transaction(self):
+        """在一个事务中执行多条语句：正常退出时提交，出现异常时回滚
+        
+        用法:
+            with db.transaction() as conn:
+                cursor = conn.cursor()
+                ...
         """
-        执行SQL查询并返回结果
+        with self._get_pool().connection() as conn:
+            conn.autocommit = False
+            try:
+                yield conn
+                conn.commit()
+            except Exception:
+                try:
+                    conn.rollback()
+                except _pyodbc().Error:
+                    pass
+                raise
+            finally:
+                try:
+                    conn.autocommit = True
+                except _pyodbc().Error:
+                    pass
+    
+    def execute_query(self, query: str, params: tuple = None, fetch: bool = None) -> List[Dict[str, Any]]:
+        """
+        执行SQL查询并返回结果（从连接池借用连接，可在多个线程中并发调用）
         
         参数:
         - query: SQL查询语句
         - params: 查询参数（可选）
+        - fetch: 是否返回结果行；默认仅SELECT返回结果行。
+          对于带OUTPUT子句的UPDATE等语句设置为True
         
         返回:
-        - 查询结果列表
+        - 查询结果列表（SELECT或fetch=True），否则为受影响的行数
         """
+        is_select = query.strip().upper().startswith("SELECT")
+        if fetch is None:
+            fetch = is_select
         try:
-            # 检查连接是否有效，如果无效则重新连接
-            if not self.conn or self.conn.closed:
-                self.connect()
-                if not self.conn or self.conn.closed:
-                    raise Exception("无法建立数据库连接")
-            
-            # 执行查询
-            with self.conn.cursor() as cursor:
+            # 执行查询（连接以自动提交模式运行，每条语句单独提交）
+            started = time.perf_counter()
+            with self._get_pool().connection() as conn, _statement_timeout(conn), conn.cursor() as cursor:
                 if params:
                     cursor.execute(query, params)
                 else:
                     cursor.execute(query)
                 
-                # 如果是SELECT查询，获取结果
-                if query.strip().upper().startswith("SELECT"):
-                    # 获取列名
-                    columns = [column[0] for column in cursor.description]
+                # 如果是SELECT查询（或需要返回结果行的语句），获取结果
+                if fetch:
                     # 将结果转换为字典列表
-                    results = []
-                    for row in cursor.fetchall():
-                        results.append(dict(zip(columns, row)))
+                    results = list(_iter_rows(cursor))
+                    if not is_select:
+                        metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage="db_write")
                     return results
                 # 如果是其他查询，返回受影响的行数
                 else:
-                    # 提交事务
-                    self.conn.commit()
+                    metrics.STAGE_DURATION.observe(time.perf_counter() - started, stage="db_write")
                     return cursor.rowcount
         except Exception as e:
             logger.error(f"执行SQL查询失败: {str(e)}")
             logger.error(f"查询: {query}")
             logger.error(f"参数: {params}")
-            # 如果是SELECT查询，返回空列表；否则返回0
-            if query.strip().upper().startswith("SELECT"):
+            # 如果是需要返回结果行的查询，返回空列表；否则返回0
+            if fetch:
                 return []
             else:
                 return 0
     
+    def iter_query(self, query: str, params: tuple = None, batch_size: int = DB_FETCH_SIZE):
+        """
+        执行查询并逐行产出结果（字典），每次从游标读取batch_size行，适合结果集很大的查询
+        
+        注意：遍历期间一直占用一个连接，遍历结束或生成器关闭时归还；出错时抛出异常
+        """
+        with self._get_pool().connection() as conn, _statement_timeout(conn), conn.cursor() as cursor:
+            if params:
+                cursor.execute(query, params)
+            else:
+                cursor.execute(query)
+            yield from _iter_rows(cursor, batch_size)
+    
     def disconnect(self):
-        """关闭数据库连接"""
+        """关闭数据库连接池"""
         try:
-            if self.conn and not self.conn.closed:
-                self.conn.close()
+            if self.pool is not None:
+                self.pool.close()
+                self.pool = None
                 logger.info("数据库连接已关闭")
         except Exception as e:
             logger.error(f"关闭数据库连接时出错: {str(e)}")
@@ -105,6 +379,94 @@ class SQLDatabase:
 # 创建全局数据库实例
 db = SQLDatabase()
 
+
+class DBExecutor:
+    """异步访问数据库的专用有界线程池
+    
+    pyodbc是同步的，在事件循环中直接调用会阻塞其他请求。run()在专用线程池中执行同步的数据库函数，
+    与默认线程池（文件操作等）隔离；排队数量有上限，并对每次调用设置超时。
+    """
+    
+    def __init__(self, workers=DB_EXECUTOR_WORKERS, queue_limit=DB_EXECUTOR_QUEUE_LIMIT):
+        self.workers = max(workers, 1)
+        self.queue_limit = queue_limit
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+    
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="db")
+            return self._executor
+    
+    @staticmethod
+    def _call(func, timeout, args, kwargs):
+        _call_context.timeout = timeout
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _call_context.timeout = None
+    
+    async def run(self, func, *args, timeout=DB_QUERY_TIMEOUT, **kwargs):
+        """在专用线程池中执行同步的数据库函数
+        
+        参数:
+        - timeout: 超时（秒），超时后抛出asyncio.TimeoutError；同时作为函数中每条语句的执行超时，
+          使数据库端也会中止超时的语句。None表示不限制
+        
+        排队和执行中的调用占用的名额在线程中的调用真正结束时才释放：超时后线程仍在执行查询，
+        数据库变慢时不会因为调用方放弃等待而接受无限多的新调用
+        """
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers + self.queue_limit)
+        loop = asyncio.get_running_loop()
+        await self._slots.acquire()
+        metrics.DB_EXECUTOR_CALLS.inc()
+        try:
+            future = self._get_executor().submit(self._call, func, timeout, args, kwargs)
+        except BaseException:
+            self._release()
+            raise
+        future.add_done_callback(lambda _: self._release_threadsafe(loop))
+        try:
+            # 留出少量余量，让数据库端的语句超时先生效并返回明确的错误
+            return await asyncio.wait_for(asyncio.wrap_future(future), None if timeout is None else timeout + 1)
+        except asyncio.TimeoutError:
+            metrics.DB_QUERY_TIMEOUTS.inc()
+            logger.error(f"数据库调用超时（{timeout}秒）: {getattr(func, '__name__', func)}")
+            raise
+    
+    def _release(self):
+        self._slots.release()
+        metrics.DB_EXECUTOR_CALLS.dec()
+    
+    def _release_threadsafe(self, loop):
+        """线程池中的调用结束（或排队时被取消）后，在事件循环中释放名额"""
+        try:
+            loop.call_soon_threadsafe(self._release)
+        except RuntimeError:
+            # 事件循环已关闭
+            pass
+    
+    def shutdown(self, wait=True):
+        """关闭线程池"""
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+
+# 全局异步数据库线程池
+db_executor = DBExecutor()
+
+async def run_db(func, *args, timeout=DB_QUERY_TIMEOUT, **kwargs):
+    """在数据库专用线程池中执行同步的数据库函数，例如 await run_db(claim_dwg_files, limit=10)"""
+    return await db_executor.run(func, *args, timeout=timeout, **kwargs)
+
+async def execute_query_async(query: str, params: tuple = None, fetch: bool = None, timeout=DB_QUERY_TIMEOUT):
+    """db.execute_query的异步版本"""
+    return await db_executor.run(db.execute_query, query, params, fetch, timeout=timeout)
+
 # 数据库操作函数
 def get_dwg_files_from_database():
     """从数据库查询需要转换的DWG文件"""
@@ -121,116 +483,359 @@ def get_dwg_files_from_database():
         """
         
         results = db.execute_query(query)
+        metrics.DB_PENDING_FILES.set(len(results))
         logger.info(f"查询数据库成功，返回 {len(results)} 条记录")
         return results
     except Exception as e:
         logger.error(f"查询数据库中的DWG文件失败: {str(e)}")
         return []
 
-def record_conversion_to_database(file_name, original_path, jpg_path, status, file_size=0, error_message=""):
-    """记录转换信息到conversion_history表"""
+# 工作租约配置
+# 多个uvicorn工作进程或多台服务器同时轮询时，通过C_Attachment上的ClaimOwner/ClaimExpiresAt列认领待转换的行，
+# 避免同一个DWG被重复转换。需要先执行 migrations/001_c_attachment_work_lease.sql
+WORKER_ID = os.getenv("WORKER_ID") or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+# 租约时长（秒），超过该时间未续约的行会被其他工作进程重新认领（例如工作进程崩溃时）
+CLAIM_LEASE_SECONDS = int(os.getenv("CLAIM_LEASE_SECONDS", "600"))
+# 每次认领的最大行数（定期轮询按附件Id分页认领，即每页的大小）
+CLAIM_BATCH_SIZE = int(os.getenv("CLAIM_BATCH_SIZE", "20"))
+
+def resolve_dwg_path(relative_dwg_path):
+    """把数据库中的DWG路径解析为完整路径（拼接DWG_FILE_PREFIX并统一路径分隔符）"""
+    # 检查传入的relative_dwg_path是否已经是完整的绝对路径
+    # 判断条件: 以驱动器字母开头(如D:)
+    # 注意：在Windows上，os.path.isabs()会将以/或\开头的路径视为绝对路径，我们需要更精确的判断
+    if len(relative_dwg_path) >= 2 and relative_dwg_path[1] == ':' and relative_dwg_path[0].isalpha():
+        return relative_dwg_path
+    
+    dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
+    if not dwg_file_prefix:
+        # 如果没有设置前缀，直接使用原始路径
+        return relative_dwg_path
+    
+    # 确保路径分隔符的一致性，在Windows环境下统一处理：将所有/替换为\
+    normalized_prefix = dwg_file_prefix.replace('/', '\\')
+    normalized_dwg_path = relative_dwg_path.replace('/', '\\')
+    
+    # 确保prefix以\结尾
+    if not normalized_prefix.endswith('\\'):
+        normalized_prefix += '\\'
+    
+    # 移除relative_dwg_path开头的\（如果有）
+    if normalized_dwg_path.startswith('\\'):
+        normalized_dwg_path = normalized_dwg_path[1:]
+    return normalized_prefix + normalized_dwg_path
+
+def claim_dwg_files(limit=CLAIM_BATCH_SIZE, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS, after_id=None):
+    """原子地认领需要转换的DWG文件
+    
+    使用UPDLOCK+READPAST跳过其他工作进程正在认领的行，并把认领的行标记为当前工作进程所有，
+    租约过期的行（认领者已崩溃）会被重新认领；失败后等待重试的行在NextAttemptAt之前不会被认领。
+    
+    认领顺序在数据库中决定：先按优先级（scheduler.claim_priority_sql），同一优先级内按订单轮转
+    （ROW_NUMBER() OVER (PARTITION BY RefId)，即每个订单的第1个文件、每个订单的第2个文件……），
+    一个订单的大量图纸不会占满一次认领，其他订单的文件也不会一直等待。
+    候选行先不加更新锁排序，更新时再加锁并重新检查认领条件，不会在排序期间锁住整个待转换集合。
+    
+    参数:
+    - limit: 最多认领的行数，None表示认领全部待转换的行
+    - owner: 认领者标识
+    - lease_seconds: 租约时长（秒）
+    - after_id: 只认领附件ID大于该值的行
+    
+    返回:
+    - 认领到的记录列表，包含AttachmentId、id（订单ID）、FilePath、FullPath（解析后的完整路径），
+      插入JPG附件时需要沿用的AttachmentType、GroupGuid、Tag、Version和CreatedBy，
+      排定转换优先级用到的OrderStatus、FileSize和CreatedDateTime，
+      以及已失败的次数RetryCount和其中导致工作进程崩溃或超时的次数CrashCount
+    """
     try:
-        # 计算PDF文件的相对路径而不是使用绝对路径
-        import os
-        from pathlib import Path
-        
-        dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
-        relative_jpg_path = jpg_path
-        
-        # 如果设置了DWG_FILE_PREFIX，并且PDF路径不为空且以该前缀开头，则移除前缀
-        if dwg_file_prefix and jpg_path and jpg_path.startswith(dwg_file_prefix):
-            # 移除前缀并确保路径以斜杠开头
-            relative_jpg_path = jpg_path[len(dwg_file_prefix):]
-            # 确保路径以斜杠开头
-            if relative_jpg_path and not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
-                relative_jpg_path = '/' + relative_jpg_path
-            logger.info(f"已将绝对路径转换为相对路径: {relative_jpg_path}")
-        elif jpg_path:      
-            # 如果无法基于DWG_FILE_PREFIX计算相对路径，但有原始路径信息，尝试从原始路径推断目录结构
-            try:
+        priority, priority_params = claim_priority_sql()
+        query = f"""
+            WITH ranked AS (
+                SELECT
+                   c.Id, o.OrderStatus,
+                   {priority} AS Priority,
+                   ROW_NUMBER() OVER (PARTITION BY c.RefId ORDER BY c.Id) AS OrderRank
+                FROM 
+                   C_Attachment c WITH (READPAST)
+                INNER JOIN c_order o on c.RefId = o.id 
+                WHERE 
+                   o.OrderStatus BETWEEN 60 and 160 and c.istojpg is null AND c.FilePath LIKE '%.dwg'
+                   AND (c.ClaimExpiresAt IS NULL OR c.ClaimExpiresAt < SYSUTCDATETIME())
+                   AND (c.NextAttemptAt IS NULL OR c.NextAttemptAt <= SYSUTCDATETIME())
+                   AND c.Id > ?
+            ),
+            pending AS (
+                SELECT TOP (?) Id, OrderStatus
+                FROM ranked
+                ORDER BY Priority, OrderRank, Id
+            )
+            UPDATE c
+            SET ClaimOwner = ?, ClaimExpiresAt = DATEADD(SECOND, ?, SYSUTCDATETIME())
+            OUTPUT inserted.Id AS AttachmentId, inserted.RefId AS id, inserted.FilePath,
+                   inserted.AttachmentType, inserted.GroupGuid, inserted.Tag, inserted.Version, inserted.CreatedBy,
+                   pending.OrderStatus, inserted.FileSize, inserted.CreatedDateTime, inserted.RetryCount,
+                   inserted.CrashCount
+            FROM C_Attachment c WITH (UPDLOCK, READPAST, ROWLOCK)
+            INNER JOIN pending ON pending.Id = c.Id
+            WHERE c.istojpg IS NULL AND (c.ClaimExpiresAt IS NULL OR c.ClaimExpiresAt < SYSUTCDATETIME())
+        """
+        top = limit if limit is not None else 2147483647
+        params = tuple(priority_params) + (after_id if after_id is not None else -1, top, owner, lease_seconds)
+        results = db.execute_query(query, params, fetch=True)
+        # 路径只在认领时解析一次，后续流水线直接使用FullPath
+        for row in results:
+            if row.get('FilePath'):
+                row['FullPath'] = resolve_dwg_path(row['FilePath'])
+        if results:
+            logger.info(f"已认领 {len(results)} 个需要转换的DWG文件，认领者: {owner}")
+        return results
+    except Exception as e:
+        logger.error(f"认领需要转换的DWG文件失败: {str(e)}")
+        return []
+
+def renew_claims(owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS):
+    """为当前工作进程仍在处理的全部行续约
+    
+    返回:
+    - 续约的行数
+    """
+    try:
+        query = """
+            UPDATE C_Attachment
+            SET ClaimExpiresAt = DATEADD(SECOND, ?, SYSUTCDATETIME())
+            WHERE ClaimOwner = ? AND istojpg IS NULL
+        """
+        return db.execute_query(query, (lease_seconds, owner))
+    except Exception as e:
+        logger.error(f"续约失败: {str(e)}")
+        return 0
+
+def release_claims(owner=WORKER_ID, attachment_ids=None):
+    """释放当前工作进程尚未完成的认领，使其他工作进程可以立即认领
+    
+    参数:
+    - attachment_ids: 只释放这些附件ID的认领；默认释放全部
+    
+    返回:
+    - 释放的行数
+    """
+    try:
+        query = """
+            UPDATE C_Attachment
+            SET ClaimOwner = NULL, ClaimExpiresAt = NULL
+            WHERE ClaimOwner = ? AND istojpg IS NULL
+        """
+        params = (owner,)
+        if attachment_ids is not None:
+            if not attachment_ids:
+                return 0
+            query += f" AND Id IN ({', '.join('?' for _ in attachment_ids)})"
+            params += tuple(attachment_ids)
+        released = db.execute_query(query, params)
+        if released:
+            logger.info(f"已释放 {released} 个未完成的认领，认领者: {owner}")
+        return released
+    except Exception as e:
+        logger.error(f"释放认领失败: {str(e)}")
+        return 0
+
+def count_pending_dwg_files():
+    """统计待转换的DWG文件数（包括已被认领但尚未完成的），用于监控积压"""
+    try:
+        query = """
+            SELECT COUNT(*) AS total
+            FROM 
+               c_order o 
+            INNER JOIN C_Attachment c on c.RefId = o.id 
+            WHERE 
+               OrderStatus BETWEEN 60 and 160 and c.istojpg is null  AND c.FilePath LIKE '%.dwg'
+        """
+        results = db.execute_query(query)
+        total = results[0]['total'] if results else 0
+        metrics.DB_PENDING_FILES.set(total)
+        return total
+    except Exception as e:
+        logger.error(f"统计待转换的DWG文件数失败: {str(e)}")
+        return 0
+
+def get_pending_watermark():
+    """获取待转换DWG文件的(数量, 最大附件ID)，两者任一变化说明有新的待转换文件或有文件已完成，用于轻量地检测变化
+    
+    返回:
+    - (数量, 最大附件ID)；查询失败时返回None
+    """
+    query = """
+        SELECT COUNT(*) AS total, MAX(c.Id) AS max_id
+        FROM 
+           c_order o 
+        INNER JOIN C_Attachment c on c.RefId = o.id 
+        WHERE 
+           OrderStatus BETWEEN 60 and 160 and c.istojpg is null  AND c.FilePath LIKE '%.dwg'
+    """
+    results = db.execute_query(query)
+    if not results:
+        return None
+    metrics.DB_PENDING_FILES.set(results[0]['total'])
+    return results[0]['total'], results[0]['max_id']
+
+def build_conversion_record(file_name, original_path, jpg_path, status, file_size=0, error_message=""):
+    """生成写入conversion_history表的语句和参数（不访问数据库）
+    
+    返回:
+    - (insert_query, params)；JPG文件为空不需要记录时返回None
+    """
+    # 计算PDF文件的相对路径而不是使用绝对路径
+    dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
+    relative_jpg_path = jpg_path
+    
+    # 如果设置了DWG_FILE_PREFIX，并且PDF路径不为空且以该前缀开头，则移除前缀
+    if dwg_file_prefix and jpg_path and jpg_path.startswith(dwg_file_prefix):
+        # 移除前缀并确保路径以斜杠开头
+        relative_jpg_path = jpg_path[len(dwg_file_prefix):]
+        # 确保路径以斜杠开头
+        if relative_jpg_path and not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
+            relative_jpg_path = '/' + relative_jpg_path
+        logger.debug("已将绝对路径转换为相对路径: %s", relative_jpg_path)
+    elif jpg_path:      
+        # 如果无法基于DWG_FILE_PREFIX计算相对路径，但有原始路径信息，尝试从原始路径推断目录结构
+        try:
+            
+            # 从原始路径获取目录结构
+            if original_path and original_path.startswith(dwg_file_prefix):
+                # 获取原始文件的相对路径
+                relative_original_path = original_path[len(dwg_file_prefix):]
+                # 获取原始文件的目录结构
+                original_dir = os.path.dirname(relative_original_path)
                 
-                # 从原始路径获取目录结构
-                if original_path and original_path.startswith(dwg_file_prefix):
-                    # 获取原始文件的相对路径
-                    relative_original_path = original_path[len(dwg_file_prefix):]
-                    # 获取原始文件的目录结构
-                    original_dir = os.path.dirname(relative_original_path)
-                    
-                    # 提取JPG文件名
-                    jpg_filename = Path(jpg_path).name
-                    
-                    if original_dir:
-                        # 构建与原始文件相同目录结构的JPG相对路径
-                        relative_jpg_path = os.path.join(original_dir, jpg_filename)
-                        # 确保路径以斜杠开头
-                        if not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
-                            relative_jpg_path = '/' + relative_jpg_path
-                        logger.info(f"基于原始路径推断的JPG相对路径: {relative_jpg_path}")
-                    else:
-                        # 回退到使用文件名部分
-                        logger.warning(f"无法从原始路径推断目录结构，使用文件名部分")
-                        relative_jpg_path = '/' + jpg_filename
+                # 提取JPG文件名
+                jpg_filename = Path(jpg_path).name
+                
+                if original_dir:
+                    # 构建与原始文件相同目录结构的JPG相对路径
+                    relative_jpg_path = os.path.join(original_dir, jpg_filename)
+                    # 确保路径以斜杠开头
+                    if not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
+                        relative_jpg_path = '/' + relative_jpg_path
+                    logger.debug("基于原始路径推断的JPG相对路径: %s", relative_jpg_path)
                 else:
-                    # 如果原始路径不以DWG_FILE_PREFIX开头，使用文件名部分
-                    jpg_filename = Path(jpg_path).name
+                    # 回退到使用文件名部分
+                    logger.warning(f"无法从原始路径推断目录结构，使用文件名部分")
                     relative_jpg_path = '/' + jpg_filename
-            except Exception as e:
-                logger.error(f"尝试从原始路径推断JPG路径时出错: {str(e)}")
-                # 回退到使用文件名部分
+            else:
+                # 如果原始路径不以DWG_FILE_PREFIX开头，使用文件名部分
                 jpg_filename = Path(jpg_path).name
-                relative_jpg_path = '/' + jpg_filename  
+                relative_jpg_path = '/' + jpg_filename
+        except Exception as e:
+            logger.error(f"尝试从原始路径推断JPG路径时出错: {str(e)}")
+            # 回退到使用文件名部分
+            jpg_filename = Path(jpg_path).name
+            relative_jpg_path = '/' + jpg_filename  
+    
+    # 统一路径分隔符为斜杠（如果有路径的话）
+    if relative_jpg_path:
+        relative_jpg_path = relative_jpg_path.replace('\\', '/')
         
-        # 统一路径分隔符为斜杠（如果有路径的话）
-        if relative_jpg_path:
-            relative_jpg_path = relative_jpg_path.replace('\\', '/')
-            
-        # 检查是否为成功状态并且PDF文件存在
-        if status == "成功" and jpg_path:
-            # 检查PDF文件是否为空（仅包含基本的PDF头信息）
-            try:
-                # 检查文件是否存在
-                if os.path.exists(jpg_path):
-                    # 检查文件大小
-                    actual_file_size = os.path.getsize(jpg_path)
-                    
-                    # 如果文件大小小于20字节，很可能是只有PDF头的空文件
-                    if actual_file_size < 20:
-                        logger.warning(f"JPG文件为空（仅包含头信息）: {jpg_path}，大小: {actual_file_size} 字节，不记录到数据库")
-                        # 不记录到数据库，直接返回
-                        return
+    # 检查是否为成功状态并且PDF文件存在
+    if status == "成功" and jpg_path:
+        # 检查PDF文件是否为空（仅包含基本的PDF头信息）
+        try:
+            # 检查文件是否存在
+            if os.path.exists(jpg_path):
+                # 检查文件大小
+                actual_file_size = os.path.getsize(jpg_path)
+                
+                # 如果文件大小小于20字节，很可能是只有PDF头的空文件
+                if actual_file_size < 20:
+                    logger.warning(f"JPG文件为空（仅包含头信息）: {jpg_path}，大小: {actual_file_size} 字节，不记录到数据库")
+                    # 不记录到数据库，直接返回
+                    return
+                
+                # 进一步检查文件内容
+                with open(jpg_path, 'rb') as f:
+                    # 读取前20个字节
+                    content = f.read(20)
                     
-                    # 进一步检查文件内容
-                    with open(jpg_path, 'rb') as f:
-                        # 读取前20个字节
-                        content = f.read(20)
-                        
-                    # 检查是否只有jpg头信息（"%jpg-1.4\n%"）
-                    if content.startswith(b'%jpg-1.4\n%') and len(content.strip()) == 8:
-                        logger.warning(f"JPG文件为空（仅包含头信息）: {jpg_path}，不记录到数据库")
-                        # 不记录到数据库，直接返回
-                        return
-            except Exception as check_error:
-                logger.warning(f"检查JPG文件内容时出错: {str(check_error)}")
-                # 发生错误时，继续处理，让调用者决定是否记录
-        
-        if status == "成功":
-            insert_query = """
-                INSERT INTO conversion_history (file_name, original_path, jpg_path, status, file_size)
-                VALUES (?, ?, ?, ?, ?)
-            """
-            params = (file_name, original_path, relative_jpg_path, status, file_size)
-        else:
-            insert_query = """
-                INSERT INTO conversion_history (file_name, original_path, jpg_path, status, error_message)
-                VALUES (?, ?, ?, ?, ?)
-            """
-            params = (file_name, original_path, relative_jpg_path, status, error_message)
-        
-        db.execute_query(insert_query, params)
+                # 检查是否只有jpg头信息（"%jpg-1.4\n%"）
+                if content.startswith(b'%jpg-1.4\n%') and len(content.strip()) == 8:
+                    logger.warning(f"JPG文件为空（仅包含头信息）: {jpg_path}，不记录到数据库")
+                    # 不记录到数据库，直接返回
+                    return
+        except Exception as check_error:
+            logger.warning(f"检查JPG文件内容时出错: {str(check_error)}")
+            # 发生错误时，继续处理，让调用者决定是否记录
+    
+    if status == "成功":
+        insert_query = """
+            INSERT INTO conversion_history (file_name, original_path, jpg_path, status, file_size)
+            VALUES (?, ?, ?, ?, ?)
+        """
+        params = (file_name, original_path, relative_jpg_path, status, file_size)
+    else:
+        insert_query = """
+            INSERT INTO conversion_history (file_name, original_path, jpg_path, status, error_message)
+            VALUES (?, ?, ?, ?, ?)
+        """
+        params = (file_name, original_path, relative_jpg_path, status, error_message)
+    
+    return insert_query, params
+
+def record_conversion_to_database(file_name, original_path, jpg_path, status, file_size=0, error_message=""):
+    """记录转换信息到conversion_history表"""
+    try:
+        statement = build_conversion_record(file_name, original_path, jpg_path, status, file_size, error_message)
+        if statement is None:
+            return
+        db.execute_query(*statement)
         logger.info(f"转换记录已保存到数据库: {file_name}, 状态: {status}")
     except Exception as db_error:
         logger.error(f"保存转换记录到数据库失败: {str(db_error)}")
 
+DRAWING_PROFILE_INSERT = """
+    INSERT INTO drawing_profile (
+        file_name, original_path, source_sha256, file_size, entity_count, expanded_entity_count, block_count,
+        block_depth, hatch_count, text_count, vertex_count, extent_min_x, extent_min_y, extent_max_x, extent_max_y,
+        entity_counts, render_seconds, peak_memory_bytes, predicted_seconds, predicted_memory_bytes, pool
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def build_drawing_profile(file_name, original_path, source_sha256, profile, render_seconds=None,
+                          peak_memory_bytes=None, predicted_seconds=None, predicted_memory_bytes=None, pool=None):
+    """生成写入drawing_profile表（图纸复杂度和渲染开销，与conversion_history对应）的语句和参数（不访问数据库）
+    
+    参数:
+    - profile: complexity.profile_dxf返回的复杂度指标
+    - render_seconds、peak_memory_bytes: 工作进程内的实际渲染耗时和峰值内存
+    - predicted_seconds、predicted_memory_bytes: 渲染前成本模型的预测值，样本不足时为None
+    - pool: 渲染使用的进程池（normal或heavy）
+    """
+    params = (
+        file_name, original_path, source_sha256, profile["file_size"], profile["entity_count"],
+        profile["expanded_entity_count"], profile["block_count"], profile["block_depth"], profile["hatch_count"],
+        profile["text_count"], profile["vertex_count"], profile["extent_min_x"], profile["extent_min_y"],
+        profile["extent_max_x"], profile["extent_max_y"], json.dumps(profile["entity_counts"]),
+        render_seconds, peak_memory_bytes,
+        predicted_seconds, int(predicted_memory_bytes) if predicted_memory_bytes is not None else None, pool
+    )
+    return DRAWING_PROFILE_INSERT, params
+
+def get_recent_drawing_profiles(limit):
+    """查询最近的图纸复杂度记录（按时间倒序），用于启动时恢复成本模型的样本"""
+    query = """
+        SELECT TOP (?)
+            file_size, entity_count, expanded_entity_count, block_count, block_depth, hatch_count, text_count,
+            vertex_count, render_seconds, peak_memory_bytes
+        FROM drawing_profile
+        WHERE render_seconds IS NOT NULL
+        ORDER BY id DESC
+    """
+    try:
+        return db.execute_query(query, (limit,))
+    except Exception as e:
+        logger.error(f"查询图纸复杂度记录失败: {str(e)}")
+        return []
+
 def update_attachment_is_jpg(order_id, file_path):
     """更新C_Attachment表中的istojpg字段，标记为已转换（注意：istojpg是历史遗留字段名，实际存储的是JPG转换状态）"""
     
@@ -270,136 +875,186 @@ def update_attachment_is_jpg(order_id, file_path):
     except Exception as db_error:
         logger.error(f"更新C_Attachment表失败: {str(db_error)}")
 
-def insert_jpg_to_attachment(order_id, jpg_path, original_dwg_path):
-    """将生成的JPG文件插入到C_Attachment表中"""
+# 插入JPG附件：已有原始DWG记录（认领时一并返回）时直接使用其字段
+JPG_ATTACHMENT_INSERT_VALUES = """
+    INSERT INTO C_Attachment (
+        RefId, 
+        AttachmentType, 
+        FileName, 
+        FilePath, 
+        CreatedBy, 
+        CreatedDateTime, 
+        GroupGuid, 
+        Tag, 
+        Version, 
+        istojpg
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+# 插入JPG附件：没有原始DWG记录时通过OUTER APPLY在同一条语句中读取原始DWG记录的AttachmentType、GroupGuid等信息，
+# 不再需要先查询一次原始记录；找不到原始记录时使用默认值
+JPG_ATTACHMENT_INSERT = """
+    INSERT INTO C_Attachment (
+        RefId, 
+        AttachmentType, 
+        FileName, 
+        FilePath, 
+        CreatedBy, 
+        CreatedDateTime, 
+        GroupGuid, 
+        Tag, 
+        Version, 
+        istojpg
+    )
+    SELECT
+        ?,
+        CASE WHEN src.Id IS NULL THEN 1 ELSE src.AttachmentType END,
+        ?,
+        CASE WHEN src.Id IS NULL THEN ? ELSE ? END,
+        CASE WHEN src.Id IS NULL THEN 'DWG2JPG API' ELSE src.CreatedBy END,
+        ?,
+        src.GroupGuid,
+        CASE WHEN src.Id IS NULL THEN N'DWG转JPG' ELSE src.Tag END,
+        CASE WHEN src.Id IS NULL THEN 1 ELSE src.Version END,
+        1
+    FROM (SELECT 1 AS one) AS d
+    OUTER APPLY (
+        SELECT TOP 1 Id, AttachmentType, CreatedBy, GroupGuid, Tag, Version
+        FROM C_Attachment
+        WHERE RefId = ? AND FilePath = ?
+        ORDER BY Id DESC
+    ) AS src
+"""
+
+def _check_jpg_file(jpg_path):
+    """检查JPG文件是否存在且内容有效"""
+    jpg_file = Path(jpg_path)
+    if not jpg_file.exists():
+        logger.error(f"JPG文件不存在，无法插入到数据库: {jpg_path}")
+        return False
+    
+    # 检查JPG文件是否为空
     try:
-        jpg_file = Path(jpg_path)
-        if not jpg_file.exists():
-            logger.error(f"JPG文件不存在，无法插入到数据库: {jpg_path}")
+        # 检查文件大小
+        actual_file_size = jpg_file.stat().st_size
+        
+        # 如果文件大小小于20字节，很可能是空文件
+        if actual_file_size < 20:
+            logger.warning(f"JPG文件为空: {jpg_path}，大小: {actual_file_size} 字节，不插入到C_Attachment表")
             return False
         
-        # 检查JPG文件是否为空
-        try:
-            # 检查文件大小
-            actual_file_size = jpg_file.stat().st_size
+        # 进一步检查文件内容是否为JPG格式
+        with open(jpg_path, 'rb') as f:
+            # 读取前几个字节检查JPG文件头
+            content = f.read(4)
             
-            # 如果文件大小小于20字节，很可能是空文件
-            if actual_file_size < 20:
-                logger.warning(f"JPG文件为空: {jpg_path}，大小: {actual_file_size} 字节，不插入到C_Attachment表")
-                # 不插入到数据库，直接返回
-                return False
-            
-            # 进一步检查文件内容是否为JPG格式
-            with open(jpg_path, 'rb') as f:
-                # 读取前几个字节检查JPG文件头
-                content = f.read(4)
-                
-                # 检查JPG文件头是否正确
-                if content.startswith(b'\xff\xd8\xff'):
-                    logger.info(f"JPG文件内容正确: {jpg_path}")
-                else:
-                    logger.warning(f"JPG文件内容错误，可能不是有效的JPG文件: {jpg_path}")
-                    # 不插入到数据库，直接返回
-                    return False
-        except Exception as check_error:
-            logger.warning(f"检查JPG文件内容时出错: {str(check_error)}")
-            # 发生错误时，继续处理，让调用者决定是否记录
-        
-        # 获取JPG文件信息
-        jpg_filename = jpg_file.name
-        
-        # 获取当前时间作为创建时间
-        import datetime
-        current_time = datetime.datetime.now()
-        
-        # 从原始DWG文件记录获取相关信息（如AttachmentType、GroupGuid等）
-        # 首先查询原始DWG文件的记录
-        dwg_record = get_dwg_attachment_record(order_id, original_dwg_path)
-        
-        if dwg_record:
-            attachment_type = dwg_record.get('AttachmentType', 1)  # 默认值为1
-            created_by = dwg_record.get('CreatedBy', 'DWG2JPG API')
-            group_guid = dwg_record.get('GroupGuid')
-            tag = dwg_record.get('Tag')
-            version = dwg_record.get('Version', 1)
-            logger.info(f"已获取原始DWG文件的记录信息，AttachmentType: {attachment_type}, GroupGuid: {group_guid}")
-        else:
-            # 如果没有找到原始DWG记录，使用默认值
-            attachment_type = 1
-            created_by = 'DWG2JPG API'
-            group_guid = None
-            tag = 'DWG转JPG'
-            version = 1
-            logger.warning(f"未找到原始DWG文件的记录，使用默认值: {original_dwg_path}")
-        
-        # 计算相对路径而不是使用绝对路径
-        # 获取DWG_FILE_PREFIX环境变量作为基准路径
-        dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
-        relative_jpg_path = str(jpg_path)
-        
-        # 如果设置了DWG_FILE_PREFIX，并且JPG路径以该前缀开头，则移除前缀
-        if dwg_file_prefix and relative_jpg_path.startswith(dwg_file_prefix):
-            # 移除前缀并确保路径以斜杠开头
-            relative_jpg_path = relative_jpg_path[len(dwg_file_prefix):]
-            # 确保路径以斜杠开头
-            if not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
-                relative_jpg_path = '/' + relative_jpg_path
-            logger.info(f"已将绝对路径转换为相对路径: {relative_jpg_path}")
-        else:
-            # 如果无法基于DWG_FILE_PREFIX计算相对路径，但有原始DWG文件的记录，尝试从原始DWG路径推断
-            if dwg_record and 'FilePath' in dwg_record:
-                original_dwg_relative_path = dwg_record['FilePath']
-                # 保留原始DWG文件的目录结构，只替换文件名
-                dwg_dir_in_db = os.path.dirname(original_dwg_relative_path)
-                if dwg_dir_in_db:
-                    relative_jpg_path = os.path.join(dwg_dir_in_db, jpg_filename)
-                    # 确保路径以斜杠开头
-                    if not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
-                        relative_jpg_path = '/' + relative_jpg_path
-                    logger.info(f"基于原始DWG路径推断的相对路径: {relative_jpg_path}")
-                else:
-                    # 回退到使用文件名部分
-                    logger.warning(f"无法从原始DWG路径推断目录结构，使用文件名部分")
-                    relative_jpg_path = '/' + jpg_filename
+            # 检查JPG文件头是否正确
+            if content.startswith(b'\xff\xd8\xff'):
+                logger.debug("JPG文件内容正确: %s", jpg_path)
             else:
-                # 如果没有原始DWG记录，记录警告并使用原始路径的文件名部分
-                logger.warning(f"无法基于DWG_FILE_PREFIX({dwg_file_prefix})计算相对路径且无原始DWG记录，使用文件名部分")
-                relative_jpg_path = '/' + jpg_filename
-            
-            # 统一路径分隔符为斜杠
-            relative_jpg_path = relative_jpg_path.replace('\\', '/')
-        
-        # 插入JPG文件到C_Attachment表
-        insert_query = """
-            INSERT INTO C_Attachment (
-                RefId, 
-                AttachmentType, 
-                FileName, 
-                FilePath, 
-                CreatedBy, 
-                CreatedDateTime, 
-                GroupGuid, 
-                Tag, 
-                Version, 
-                istojpg
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """
-        
+                logger.warning(f"JPG文件内容错误，可能不是有效的JPG文件: {jpg_path}")
+                return False
+    except Exception as check_error:
+        logger.warning(f"检查JPG文件内容时出错: {str(check_error)}")
+        # 发生错误时，继续处理，让调用者决定是否记录
+    return True
+
+def _relative_jpg_paths(jpg_path, original_dwg_path):
+    """计算JPG文件写入数据库的相对路径
+    
+    返回:
+    - (path_with_record, path_without_record)：分别为找到/未找到原始DWG记录时使用的路径
+    """
+    jpg_filename = Path(jpg_path).name
+    
+    # 计算相对路径而不是使用绝对路径
+    # 获取DWG_FILE_PREFIX环境变量作为基准路径
+    dwg_file_prefix = os.getenv("DWG_FILE_PREFIX", "")
+    relative_jpg_path = str(jpg_path)
+    
+    # 如果设置了DWG_FILE_PREFIX，并且JPG路径以该前缀开头，则移除前缀
+    if dwg_file_prefix and relative_jpg_path.startswith(dwg_file_prefix):
+        # 移除前缀并确保路径以斜杠开头
+        relative_jpg_path = relative_jpg_path[len(dwg_file_prefix):]
+        # 确保路径以斜杠开头
+        if not relative_jpg_path.startswith('/') and not relative_jpg_path.startswith('\\'):
+            relative_jpg_path = '/' + relative_jpg_path
+        logger.debug("已将绝对路径转换为相对路径: %s", relative_jpg_path)
+        return relative_jpg_path, relative_jpg_path
+    
+    # 如果无法基于DWG_FILE_PREFIX计算相对路径，找到原始DWG记录时保留其目录结构，只替换文件名
+    # （原始记录的FilePath就是original_dwg_path，因此其目录就是original_dwg_path的目录）
+    path_without_record = '/' + jpg_filename
+    dwg_dir_in_db = os.path.dirname(str(original_dwg_path))
+    if dwg_dir_in_db:
+        path_with_record = os.path.join(dwg_dir_in_db, jpg_filename)
+        # 确保路径以斜杠开头
+        if not path_with_record.startswith('/') and not path_with_record.startswith('\\'):
+            path_with_record = '/' + path_with_record
+    else:
+        # 回退到使用文件名部分
+        path_with_record = path_without_record
+    
+    # 统一路径分隔符为斜杠
+    return path_with_record.replace('\\', '/'), path_without_record
+
+def build_jpg_attachment(order_id, jpg_path, original_dwg_path, source_record=None):
+    """生成把JPG文件插入到C_Attachment表的语句和参数（不访问数据库）
+    
+    参数:
+    - source_record: 原始DWG的附件记录（claim_dwg_files返回的行），提供时直接沿用其
+      AttachmentType、GroupGuid、Tag、Version和CreatedBy；否则在插入语句中按路径查找原始记录
+    
+    返回:
+    - (insert_query, params)；JPG文件不存在或无效时返回None
+    """
+    if not _check_jpg_file(jpg_path):
+        return None
+    
+    # 获取JPG文件信息
+    jpg_filename = Path(jpg_path).name
+    
+    # 获取当前时间作为创建时间
+    import datetime
+    current_time = datetime.datetime.now()
+    
+    path_with_record, path_without_record = _relative_jpg_paths(jpg_path, original_dwg_path)
+    
+    if source_record is not None:
         params = (
             order_id,  # RefId: 订单ID
-            attachment_type,  # AttachmentType: 附件类型，与原始DWG相同或使用默认值
+            source_record.get('AttachmentType'),  # AttachmentType: 与原始DWG相同
             jpg_filename,  # FileName: JPG文件名
-            relative_jpg_path,  # FilePath: JPG文件相对路径
-            created_by,  # CreatedBy: 创建者
+            path_with_record,  # FilePath: JPG文件相对路径
+            source_record.get('CreatedBy'),  # CreatedBy: 创建者
             current_time,  # CreatedDateTime: 创建时间
-            group_guid,  # GroupGuid: 分组GUID，与原始DWG相同
-            tag,  # Tag: 标签
-            version,  # Version: 版本号
-            1  # istojpg: 暂时保持为1，后续会更新为istojpg字段
+            source_record.get('GroupGuid'),  # GroupGuid: 分组GUID，与原始DWG相同
+            source_record.get('Tag'),  # Tag: 标签
+            source_record.get('Version'),  # Version: 版本号
+            1  # istojpg
         )
+        return JPG_ATTACHMENT_INSERT_VALUES, params
+    
+    params = (
+        order_id,  # RefId: 订单ID
+        jpg_filename,  # FileName: JPG文件名
+        path_without_record,  # FilePath: 没有原始DWG记录时的JPG文件相对路径
+        path_with_record,  # FilePath: 有原始DWG记录时的JPG文件相对路径
+        current_time,  # CreatedDateTime: 创建时间
+        order_id,  # 原始DWG记录的RefId
+        str(original_dwg_path)  # 原始DWG记录的FilePath
+    )
+    return JPG_ATTACHMENT_INSERT, params
+
+def insert_jpg_to_attachment(order_id, jpg_path, original_dwg_path, source_record=None):
+    """将生成的JPG文件插入到C_Attachment表中，source_record参见build_jpg_attachment"""
+    try:
+        statement = build_jpg_attachment(order_id, jpg_path, original_dwg_path, source_record)
+        if statement is None:
+            return False
         
-        affected_rows = db.execute_query(insert_query, params)
-        logger.info(f"已将JPG文件插入到C_Attachment表，文件名: {jpg_filename}，受影响行数: {affected_rows}")
+        affected_rows = db.execute_query(*statement)
+        logger.info(f"已将JPG文件插入到C_Attachment表，文件名: {Path(jpg_path).name}，受影响行数: {affected_rows}")
         return True
         
     except Exception as db_error:
@@ -430,46 +1085,93 @@ def get_dwg_attachment_record(order_id, dwg_path):
         logger.error(f"查询原始DWG文件记录失败: {str(e)}")
         return None
 
-def update_conversion_status(order_id, file_path, status, error_message=""):
+# 更新转换状态并释放认领
+# 没有附件主键时按订单ID和路径精确匹配
+CONVERSION_STATUS_UPDATE = """
+    UPDATE C_Attachment
+    SET istojpg = ?, ClaimOwner = NULL, ClaimExpiresAt = NULL
+    WHERE RefId = ? AND FilePath = ?
+"""
+
+# 已知附件主键（认领时返回的AttachmentId）时按主键更新
+ATTACHMENT_STATUS_UPDATE = """
+    UPDATE C_Attachment
+    SET istojpg = ?, ClaimOwner = NULL, ClaimExpiresAt = NULL
+    WHERE Id = ?
+"""
+
+def build_conversion_status(order_id, file_path, status, attachment_id=None):
+    """生成更新C_Attachment表istojpg字段的语句和参数（不访问数据库）
+    
+    参数:
+    - file_path: 与数据库中FilePath完全一致的路径（不做模糊匹配）
+    - attachment_id: 原始DWG附件的主键，提供时按主键更新，否则按订单ID和路径匹配
+    
+    返回:
+    - (update_query, params)；未知状态返回None
+    """
+    if status not in ("成功", "失败"):
+        logger.warning(f"未知的转换状态: {status}")
+        return None
+    
+    istojpg_value = -1 if status == "失败" else 1
+    if attachment_id is not None:
+        return ATTACHMENT_STATUS_UPDATE, (istojpg_value, attachment_id)
+    
+    return CONVERSION_STATUS_UPDATE, (istojpg_value, order_id, file_path)
+
+def update_conversion_status(order_id, file_path, status, error_message="", attachment_id=None):
     """更新转换状态，更新C_Attachment表中的istojpg字段表示转换状态（注意：istojpg是历史遗留字段名，实际存储的是JPG转换状态）"""
     try:
         logger.info(f"更新订单ID: {order_id} 的转换状态为: {status}")
-        
-        # 标准化文件路径，确保与数据库中的路径格式一致
-        normalized_file_path = file_path.replace('/', '\\')
-        
-        if status == "失败":
-            update_query = """
-                UPDATE C_Attachment
-                SET istojpg = -1
-                WHERE RefId = ? AND FilePath = ?
-            """
-            affected_rows = db.execute_query(update_query, (order_id, normalized_file_path))
-            logger.info(f"已更新C_Attachment表，标记文件处理失败，受影响行数: {affected_rows}")
-        elif status == "成功":
-            update_query = """
-                UPDATE C_Attachment
-                SET istojpg = 1
-                WHERE RefId = ? AND FilePath = ?
-            """
-            affected_rows = db.execute_query(update_query, (order_id, normalized_file_path))
-            logger.info(f"已更新C_Attachment表，标记文件处理成功，受影响行数: {affected_rows}")
-        
-        # 如果没有找到记录，尝试使用LIKE操作符进行模糊匹配
+        statement = build_conversion_status(order_id, file_path, status, attachment_id)
+        if statement is None:
+            return
+        affected_rows = db.execute_query(*statement)
         if affected_rows == 0:
-            logger.warning(f"未找到订单ID: {order_id} 的文件记录: {normalized_file_path}")
-            # 尝试使用LIKE操作符进行模糊匹配
-            like_query = """
-                UPDATE C_Attachment
-                SET istojpg = ?
-                WHERE RefId = ? AND FilePath LIKE ?
-            """
-            istojpg_value = -1 if status == "失败" else 1
-            like_affected_rows = db.execute_query(like_query, 
-                (istojpg_value, order_id, f'%{os.path.basename(normalized_file_path)}%'))
-            if like_affected_rows > 0:
-                logger.info(f"通过文件名模糊匹配找到了记录，已更新 {like_affected_rows} 条记录")
+            logger.warning(f"未找到订单ID: {order_id} 的文件记录: {file_path}")
+        else:
+            logger.info(f"已更新C_Attachment表，标记文件处理{status}，受影响行数: {affected_rows}")
     except Exception as db_error:
         logger.error(f"更新转换状态失败: {str(db_error)}")
         # 记录详细的错误信息，包括参数值
-        logger.error(f"失败参数: order_id={order_id}, file_path={file_path}, status={status}")
\ No newline at end of file
+        logger.error(f"失败参数: order_id={order_id}, file_path={file_path}, status={status}")
+
+# 转换失败后按重试策略更新状态并释放认领（需要先执行 migrations/004_c_attachment_retry.sql）
+# istojpg为NULL时保持未转换，NextAttemptAt之后重新认领；延迟为NULL时NextAttemptAt也为NULL
+ATTACHMENT_FAILURE_UPDATE = """
+    UPDATE C_Attachment
+    SET istojpg = ?, RetryCount = ?, CrashCount = ?, NextAttemptAt = DATEADD(SECOND, ?, SYSUTCDATETIME()),
+        LastError = ?, ClaimOwner = NULL, ClaimExpiresAt = NULL
+    WHERE Id = ?
+"""
+
+CONVERSION_FAILURE_UPDATE = """
+    UPDATE C_Attachment
+    SET istojpg = ?, RetryCount = ?, CrashCount = ?, NextAttemptAt = DATEADD(SECOND, ?, SYSUTCDATETIME()),
+        LastError = ?, ClaimOwner = NULL, ClaimExpiresAt = NULL
+    WHERE RefId = ? AND FilePath = ?
+"""
+
+# 失败处理结果对应的istojpg值
+FAILURE_STATUS_VALUES = {"retry": None, "failed": -1, "quarantined": -2}
+
+def build_conversion_failure(order_id, file_path, outcome, attempts, crashes, delay_seconds, error_message,
+                             attachment_id=None):
+    """生成按重试策略记录转换失败的语句和参数（不访问数据库）
+    
+    参数:
+    - outcome: 重试策略的处理结果（retry、failed、quarantined）
+    - attempts: 累计失败次数
+    - crashes: 累计导致工作进程崩溃或超时的次数
+    - delay_seconds: 重试前的等待时间（秒），不重试时为None
+    - error_message: 记录到LastError的失败原因和错误信息
+    
+    返回:
+    - (update_query, params)
+    """
+    values = (FAILURE_STATUS_VALUES[outcome], attempts, crashes,
+              int(delay_seconds) if delay_seconds is not None else None, (error_message or "")[:500])
+    if attachment_id is not None:
+        return ATTACHMENT_FAILURE_UPDATE, values + (attachment_id,)
+    return CONVERSION_FAILURE_UPDATE, values + (order_id, file_path)
@@ -0,0 +1,10 @@
+# -*- coding: utf-8 -*-
+
+"""python -m dwg2jpg 入口"""
+
+import sys
+
+from .cli import main
+
+if __name__ == "__main__":
+    sys.exit(main())
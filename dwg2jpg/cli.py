@@ -0,0 +1,378 @@
+# -*- coding: utf-8 -*-
+
+"""
+命令行批量转换
+
+用法:
+    python -m dwg2jpg convert D:\\Archive --workers 8 --output D:\\Archive_jpg
+
+遍历目录树中的DWG文件，用多个进程并行转换为JPG，显示进度和吞吐量。
+每个文件完成后追加一行到清单文件（JSON Lines），中断后再次运行同一命令时跳过已经完成的文件。
+"""
+
+import os
+import sys
+import json
+import time
+import signal
+import logging
+import argparse
+import collections
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+
+from . import __version__
+from .converter import convert_dwg_to_jpg
+
+# 默认的清单文件名（放在输出目录中，未指定输出目录时放在源目录中）
+MANIFEST_NAME = ".dwg2jpg-manifest.jsonl"
+# 非终端输出时打印进度的间隔（秒）
+PROGRESS_LOG_INTERVAL = 10
+# 与convert_dwg_to_jpg一致的渲染参数
+RENDER_OPTIONS = ("size", "bg_color", "line_color", "dpi", "image_format")
+
+
+def find_dwg_files(source_dir, extensions=(".dwg",)):
+    """按路径顺序遍历目录树，返回DWG文件的完整路径（扩展名不区分大小写）"""
+    found = []
+    for root, dirs, files in os.walk(source_dir):
+        dirs.sort()
+        for name in sorted(files):
+            if os.path.splitext(name)[1].lower() in extensions:
+                found.append(os.path.join(root, name))
+    return found
+
+
+def output_path_for(source, source_dir, output_dir, image_format):
+    """输出文件路径：未指定输出目录时与DWG文件放在一起，否则在输出目录中保持相同的目录结构"""
+    stem = os.path.splitext(source)[0]
+    if output_dir:
+        stem = os.path.join(output_dir, os.path.relpath(stem, source_dir))
+    return f"{stem}.{image_format}"
+
+
+class Manifest:
+    """可续传的转换清单
+
+    每个文件转换完成（成功或失败）后追加一行JSON，记录源文件的相对路径、大小和修改时间、
+    渲染参数和结果；同一个文件有多行时以最后一行为准。写到一半的行（进程被强制结束）在读取时忽略。
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self._file = None
+
+    def load(self):
+        """读取已有的清单，返回读取的记录数"""
+        if not os.path.exists(self.path):
+            return 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    self.entries[entry["source"]] = entry
+                except (ValueError, KeyError, TypeError):
+                    continue
+        return len(self.entries)
+
+    def is_done(self, source, stat, options, output, retry_failed=False):
+        """判断文件是否已经按相同的渲染参数转换过且源文件没有变化
+
+        失败的文件在retry_failed为False时同样跳过（避免每次运行都重试无法转换的图纸）
+        """
+        entry = self.entries.get(source)
+        if entry is None or entry.get("options") != options:
+            return False
+        if entry.get("size") != stat.st_size or entry.get("mtime_ns") != stat.st_mtime_ns:
+            return False
+        if entry.get("status") == "success":
+            return os.path.exists(output)
+        return not retry_failed
+
+    def append(self, entry):
+        """追加一条记录并立即写入磁盘"""
+        if self._file is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+        self._file.flush()
+        self.entries[entry["source"]] = entry
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+# 工作进程中用于报告开始转换的文件的队列（由进程池初始化函数设置）
+_started_queue = None
+
+
+def _init_worker(log_level, started_queue):
+    """工作进程初始化：导入converter时设置的日志级别改为命令行指定的级别
+
+    工作进程忽略Ctrl+C，由主进程统一处理中断，正在转换的文件不会因中断而被记录为失败
+    """
+    global _started_queue
+    _started_queue = started_queue
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    logging.getLogger().setLevel(log_level)
+
+
+def _create_executor(workers, started_queue):
+    return ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                               initargs=(logging.getLogger().level, started_queue))
+
+
+def _convert_one(source, output, options):
+    """在工作进程中转换一个文件，返回(是否成功, 耗时, 错误信息, 各阶段耗时)"""
+    # SimpleQueue的put直接写入管道，主进程收到转换结果时一定已经能读到这条记录
+    if _started_queue is not None:
+        _started_queue.put(source)
+    started = time.perf_counter()
+    timings = {}
+    try:
+        success = convert_dwg_to_jpg(source, output, timings=timings, **options)
+        error = ""
+        if success and not (os.path.exists(output) and os.path.getsize(output) > 0):
+            success, error = False, "输出文件未创建或为空"
+        elif not success:
+            error = "DWG到JPG转换失败"
+    except Exception as e:
+        success, error = False, str(e)
+    return success, time.perf_counter() - started, error, timings
+
+
+def _submit(executor, item, options):
+    source, relative, output, stat = item
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    return executor.submit(_convert_one, source, output, options)
+
+
+def _format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds % 3600 // 60:02d}:{seconds % 60:02d}"
+
+
+class ProgressReporter:
+    """在标准错误输出显示进度和吞吐量；终端中原地刷新一行，否则每隔PROGRESS_LOG_INTERVAL秒输出一行"""
+
+    def __init__(self, total, stream=sys.stderr):
+        self.total = total
+        self.stream = stream
+        self.interactive = stream.isatty()
+        self.started = time.monotonic()
+        self.succeeded = 0
+        self.failed = 0
+        self.source_bytes = 0
+        self._last_printed = 0.0
+        # 终端中上一次输出的进度行长度，用空格覆盖较长的旧内容
+        self._width = 0
+
+    @property
+    def done(self):
+        return self.succeeded + self.failed
+
+    def update(self, success, source_bytes):
+        if success:
+            self.succeeded += 1
+        else:
+            self.failed += 1
+        self.source_bytes += source_bytes
+        now = time.monotonic()
+        if self.interactive or now - self._last_printed >= PROGRESS_LOG_INTERVAL or self.done == self.total:
+            self._last_printed = now
+            self._print(self.status_line())
+
+    def status_line(self):
+        elapsed = max(time.monotonic() - self.started, 1e-6)
+        rate = self.done / elapsed
+        percent = self.done / self.total * 100 if self.total else 100.0
+        remaining = (self.total - self.done) / rate if rate > 0 else 0
+        return (f"[{self.done}/{self.total}] {percent:5.1f}%  成功 {self.succeeded}  失败 {self.failed}  "
+                f"{rate:.2f} 文件/秒  {self.source_bytes / 1024 / 1024 / elapsed:.2f} MB/秒  "
+                f"已用 {_format_duration(elapsed)}  剩余约 {_format_duration(remaining)}")
+
+    def _print(self, line):
+        if self.interactive:
+            self.stream.write("\r" + line.ljust(self._width))
+            self._width = len(line)
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def message(self, line):
+        """输出一行消息（例如失败的文件），不打乱进度行"""
+        if self.interactive:
+            self.stream.write("\r" + line.ljust(self._width) + "\n")
+            self._width = 0
+            if self.done:
+                self._print(self.status_line())
+        else:
+            self.stream.write(line + "\n")
+        self.stream.flush()
+
+    def finish(self):
+        if self.interactive and self.done:
+            self.stream.write("\n")
+        self.stream.flush()
+
+
+def run_convert(args):
+    """执行convert命令，返回退出码（0：全部成功，1：有文件失败，130：被中断）"""
+    source_dir = os.path.abspath(args.source)
+    if not os.path.isdir(source_dir):
+        print(f"源目录不存在: {source_dir}", file=sys.stderr)
+        return 2
+    output_dir = os.path.abspath(args.output) if args.output else None
+    options = {name: getattr(args, name) for name in RENDER_OPTIONS}
+    manifest = Manifest(args.manifest or os.path.join(output_dir or source_dir, MANIFEST_NAME))
+    loaded = manifest.load()
+
+    pending = []
+    skipped = 0
+    for source in find_dwg_files(source_dir):
+        relative = os.path.relpath(source, source_dir)
+        output = output_path_for(source, source_dir, output_dir, args.image_format)
+        try:
+            stat = os.stat(source)
+        except OSError as e:
+            print(f"无法读取文件信息: {source}: {str(e)}", file=sys.stderr)
+            continue
+        if not args.force and manifest.is_done(relative, stat, options, output, args.retry_failed):
+            skipped += 1
+            continue
+        pending.append((source, relative, output, stat))
+
+    print(f"找到 {len(pending) + skipped} 个DWG文件，待转换 {len(pending)} 个，"
+          f"清单中已完成 {skipped} 个（清单: {manifest.path}，已有 {loaded} 条记录），工作进程数: {args.workers}",
+          file=sys.stderr)
+    if not pending:
+        return 0
+
+    reporter = ProgressReporter(len(pending))
+    # 提交的任务数限制为工作进程数的两倍，目录中文件很多时不会一次创建全部future
+    max_in_flight = args.workers * 2
+    queue = collections.deque(pending)
+    # 工作进程崩溃时已经开始转换的文件：无法确定是哪个文件导致的崩溃，逐个单独重新转换，
+    # 单独转换时仍然崩溃的文件才记录为失败
+    suspects = collections.deque()
+    # future -> (进程池代数, 是否单独转换, 文件)
+    running = {}
+    # 工作进程已经开始转换、尚未得到结果的文件
+    started = set()
+    started_queue = multiprocessing.SimpleQueue()
+    # 每次重建进程池代数加一，旧进程池中的任务随后收到的BrokenProcessPool不再触发重建
+    generation = 0
+    executor = _create_executor(args.workers, started_queue)
+    interrupted = False
+    try:
+        while True:
+            if suspects:
+                if not running:
+                    item = suspects.popleft()
+                    running[_submit(executor, item, options)] = (generation, True, item)
+            else:
+                while queue and len(running) < max_in_flight:
+                    item = queue.popleft()
+                    running[_submit(executor, item, options)] = (generation, False, item)
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            while not started_queue.empty():
+                started.add(started_queue.get())
+            for future in finished:
+                future_generation, isolated, item = running.pop(future)
+                source, relative, output, stat = item
+                was_started = source in started
+                started.discard(source)
+                try:
+                    success, seconds, error, timings = future.result()
+                except BrokenProcessPool as e:
+                    if future_generation == generation:
+                        # 工作进程异常退出（例如内存不足被系统杀死），进程池已无法使用，重建后继续转换
+                        executor.shutdown(wait=False)
+                        generation += 1
+                        executor = _create_executor(args.workers, started_queue)
+                        if not isolated:
+                            reporter.message(f"转换进程异常退出，已重建进程池，正在转换的文件将逐个重新转换: {str(e)}")
+                    if not isolated:
+                        # 同一进程池中的其他文件都以该错误结束，不写入清单：
+                        # 已经开始转换的文件稍后单独转换，还没有开始的放回队列
+                        if was_started:
+                            suspects.append(item)
+                        else:
+                            queue.appendleft(item)
+                        continue
+                    success, seconds, error, timings = False, 0.0, f"转换进程异常退出: {str(e)}", {}
+                manifest.append({
+                    "source": relative,
+                    "output": output,
+                    "status": "success" if success else "failed",
+                    "size": stat.st_size,
+                    "mtime_ns": stat.st_mtime_ns,
+                    "options": options,
+                    "seconds": round(seconds, 3),
+                    "timings": {stage: round(value, 3) for stage, value in timings.items()},
+                    "error": error,
+                    "finished_at": time.strftime("%Y-%m-%d %H:%M:%S"),
+                })
+                if not success:
+                    reporter.message(f"转换失败: {relative}: {error}")
+                reporter.update(success, stat.st_size)
+    except KeyboardInterrupt:
+        interrupted = True
+        reporter.message("已中断，正在停止工作进程；再次运行同一命令将从中断处继续")
+    finally:
+        # 中断时不等待正在转换的文件，它们没有写入清单，下次运行时重新转换
+        executor.shutdown(wait=not interrupted, cancel_futures=True)
+        manifest.close()
+        reporter.finish()
+
+    elapsed = time.monotonic() - reporter.started
+    print(f"完成 {reporter.done}/{reporter.total} 个文件：成功 {reporter.succeeded}，失败 {reporter.failed}，"
+          f"耗时 {_format_duration(elapsed)}，平均 {reporter.done / max(elapsed, 1e-6):.2f} 文件/秒", file=sys.stderr)
+    if reporter.failed:
+        print("失败的文件已记录在清单中，使用 --retry-failed 重新转换", file=sys.stderr)
+    if interrupted:
+        return 130
+    return 1 if reporter.failed else 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog="python -m dwg2jpg", description="DWG到JPG转换工具")
+    parser.add_argument("--version", action="version", version=f"%(prog)s {__version__}")
+    parser.add_argument("--log-level", default="WARNING",
+                        help="日志级别（默认WARNING，避免逐个文件的日志打乱进度显示）")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    convert = commands.add_parser("convert", help="遍历目录树，用多个进程把DWG文件批量转换为JPG（可续传）")
+    convert.add_argument("source", help="包含DWG文件的目录（递归遍历子目录）")
+    convert.add_argument("-o", "--output", help="输出目录，按源目录的结构保存；不指定时与DWG文件放在一起")
+    convert.add_argument("-j", "--workers", type=int, default=os.cpu_count() or 2,
+                         help="并行转换的进程数（默认与CPU核数一致）")
+    convert.add_argument("--manifest", help=f"清单文件路径（默认为输出目录或源目录中的{MANIFEST_NAME}）")
+    convert.add_argument("--retry-failed", action="store_true", help="重新转换清单中记录为失败的文件")
+    convert.add_argument("--force", action="store_true", help="忽略清单，重新转换全部文件")
+    # 渲染参数，与convert_dwg_to_jpg一致
+    convert.add_argument("--size", type=int, default=3200, help="输出图像的宽度（像素，默认3200）")
+    convert.add_argument("--bg-color", default="white", help="背景颜色（默认white）")
+    convert.add_argument("--line-color", default="black", help="线条颜色（默认black）")
+    convert.add_argument("--dpi", type=int, default=600, help="输出图像的DPI（默认600）")
+    convert.add_argument("--format", dest="image_format", choices=("jpg", "png"), default="jpg",
+                         help="输出图像格式（默认jpg）")
+    convert.set_defaults(handler=run_convert)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    logging.getLogger().setLevel(args.log_level.upper())
+    if getattr(args, "workers", 1) < 1:
+        print("--workers 必须大于0", file=sys.stderr)
+        return 2
+    return args.handler(args)
@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 
 import os
+import time
 import logging
 from pathlib import Path
 import tempfile
@@ -51,6 +52,19 @@ class MatplotlibBackendCustom(MatplotlibBackend):
         self.dimension_entities.append(dimension)
         return result
 
+def _record_timing(timings, stage, started):
+    """如果调用方提供了timings字典，记录阶段耗时（秒）"""
+    if timings is not None:
+        timings[stage] = time.perf_counter() - started
+
+def _report_progress(progress, stage, percent=None):
+    """如果调用方提供了progress回调，报告阶段变化；回调出错不影响转换"""
+    if progress is not None:
+        try:
+            progress(stage, percent)
+        except Exception as e:
+            logger.warning(f"报告转换进度失败: {str(e)}")
+
 def read_dxf(filepath):
     """
     读取DXF文件
@@ -62,7 +76,7 @@ def read_dxf(filepath):
         ezdxf.drawing.Drawing: DXF文档对象
     """
     try:
-        logger.info(f"正在读取DXF文件: {filepath}")
+        logger.debug("正在读取DXF文件: %s", filepath)
         doc = ezdxf.readfile(str(filepath))
         return doc
     except IOError as e:
@@ -94,14 +108,14 @@ def convert_dwg_to_dxf(dwg_path, dxf_path=None):
             logger.error(f"ODA转换工具不存在: {oda_converter_path}")
             return False
         
-        logger.info(f"ODA转换工具路径: {oda_converter_path}")
+        logger.debug("ODA转换工具路径: %s", oda_converter_path)
         
         # 检查输入DWG文件是否存在
         if not os.path.exists(dwg_path):
             logger.error(f"输入DWG文件不存在: {dwg_path}")
             return False
         
-        logger.info(f"使用DWG文件: {dwg_path}")
+        logger.debug("使用DWG文件: %s", dwg_path)
         
         # 确定输出目录和文件名
         input_dir = os.path.dirname(dwg_path)
@@ -132,16 +146,15 @@ def convert_dwg_to_dxf(dwg_path, dxf_path=None):
             temp_output_dir = tempfile.mkdtemp(prefix='dxf_convert_')
             logger.warning(f"输入和输出目录不能相同，已创建临时输出目录: {temp_output_dir}")
         
-        logger.info(f"输入目录: {input_dir}")
-        logger.info(f"输出目录: {temp_output_dir}")
-        logger.info(f"输入文件名: {input_filename}")
+        logger.debug("输入目录: %s，输出目录: %s，输入文件名: %s", input_dir, temp_output_dir, input_filename)
         
         # 确保输出目录存在
         if not os.path.exists(temp_output_dir):
             os.makedirs(temp_output_dir, exist_ok=True)
         
-        # 列出输入目录中的文件
-        logger.info(f"输入目录内容: {os.listdir(input_dir)}")
+        # 列出输入目录中的文件（共享目录中可能有大量文件，只在输出DEBUG日志时列出）
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("输入目录内容: %s", os.listdir(input_dir))
         
         # 构建ODA转换命令 - 修改参数确保输出为DXF格式
         cmd_args = [
@@ -154,7 +167,7 @@ def convert_dwg_to_dxf(dwg_path, dxf_path=None):
             input_filename  # 要转换的文件名
         ]
             
-        logger.info(f"执行ODA转换命令: {' '.join(cmd_args)}")
+        logger.debug("执行ODA转换命令: %s", cmd_args)
         
         # 执行命令
         result = subprocess.run(
@@ -166,19 +179,18 @@ def convert_dwg_to_dxf(dwg_path, dxf_path=None):
             text=True
         )
         
-        logger.info(f"ODA转换成功，输出: {result.stdout}")
-        logger.info(f"ODA错误输出: {result.stderr}")
+        logger.debug("ODA转换成功，输出: %s，错误输出: %s", result.stdout, result.stderr)
             
         # 检查是否有DXF文件生成
         output_files = os.listdir(temp_output_dir)
-        logger.info(f"输出目录内容: {output_files}")
+        logger.debug("输出目录内容: %s", output_files)
         
         # 找到转换后的DXF文件
         base_name = os.path.splitext(input_filename)[0]
         dxf_files = [f for f in output_files if f.lower().startswith(base_name.lower()) and f.lower().endswith('.dxf')]
         
         if dxf_files:
-            logger.info(f"找到转换后的DXF文件: {dxf_files}")
+            logger.debug("找到转换后的DXF文件: %s", dxf_files)
             
             # 如果指定了特定的dxf_path，且转换后的文件名与目标文件名不同，则移动文件
             if dxf_path and os.path.basename(dxf_path) not in dxf_files:
@@ -190,7 +202,7 @@ def convert_dwg_to_dxf(dwg_path, dxf_path=None):
                     # 如果跨磁盘，则使用shutil.move
                     import shutil
                     shutil.move(source_dxf, dxf_path)
-                logger.info(f"已将文件移动到: {dxf_path}")
+                logger.debug("已将文件移动到: %s", dxf_path)
             
             return True
         else:
@@ -242,7 +254,8 @@ def calculate_bbox(doc):
 
 
 
-def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_color='black', dpi=600):
+def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_color='black', dpi=600, image_format='jpg',
+                       timings=None, progress=None):
     """
     将DWG文件直接转换为JPG图像
     
@@ -253,6 +266,10 @@ def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_col
         bg_color: 背景颜色
         line_color: 线条颜色
         dpi: 输出图像的DPI
+        image_format: 输出图像格式（jpg或png）
+        timings: 可选的字典，用于记录各阶段耗时（oda、parse、render、encode）
+        progress: 可选的回调函数 progress(stage, percent)，在进入oda、parsing、rendering、encoding阶段时调用，
+            rendering阶段还会报告已绘制实体的百分比
         
     Returns:
         bool: 转换是否成功
@@ -271,11 +288,14 @@ def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_col
         base_name = os.path.splitext(os.path.basename(dwg_path))[0]
         temp_dxf_path = os.path.join(temp_dir, f"{base_name}.dxf")
         
-        logger.info(f"创建临时DXF文件: {temp_dxf_path}")
+        logger.debug("创建临时DXF文件: %s", temp_dxf_path)
         
         # 第一步：将DWG转换为DXF
-        logger.info("步骤1: 正在将DWG转换为DXF...")
+        logger.debug("步骤1: 正在将DWG转换为DXF...")
+        _report_progress(progress, "oda")
+        stage_started = time.perf_counter()
         dxf_success = convert_dwg_to_dxf(dwg_path, temp_dxf_path)
+        _record_timing(timings, "oda", stage_started)
         
         if not dxf_success:
             logger.error("DWG到DXF转换失败")
@@ -287,10 +307,14 @@ def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_col
             return False
         
         # 第二步：读取DXF文件并转换为JPG
-        logger.info("步骤2: 正在将DXF转换为JPG...")
+        logger.debug("步骤2: 正在将DXF转换为JPG...")
         try:
+            _report_progress(progress, "parsing")
+            stage_started = time.perf_counter()
             doc = ezdxf.readfile(temp_dxf_path)
-            jpg_success = convert_dxf_to_jpg(doc, jpg_path, size, bg_color, line_color, dpi)
+            _record_timing(timings, "parse", stage_started)
+            jpg_success = convert_dxf_to_jpg(doc, jpg_path, size, bg_color, line_color, dpi, image_format,
+                                             timings, progress)
             
             if jpg_success:
                 logger.info(f"DWG到JPG转换成功，输出文件: {jpg_path}")
@@ -303,7 +327,7 @@ def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_col
             return False
         finally:
             # 清理临时文件和目录
-            logger.info("清理临时文件...")
+            logger.debug("清理临时文件...")
             try:
                 if os.path.exists(temp_dxf_path):
                     os.remove(temp_dxf_path)
@@ -316,7 +340,8 @@ def convert_dwg_to_jpg(dwg_path, jpg_path, size=3200, bg_color='white', line_col
         logger.error(f"DWG到JPG转换过程中发生错误: {str(e)}")
         return False
 
-def convert_dxf_to_jpg(doc, output_path, size=3200, bg_color='white', line_color='black', dpi=600):
+def convert_dxf_to_jpg(doc, output_path, size=3200, bg_color='white', line_color='black', dpi=600, image_format='jpg',
+                       timings=None, progress=None):
     """
     将DXF文档转换为JPG图像
     
@@ -327,14 +352,18 @@ def convert_dxf_to_jpg(doc, output_path, size=3200, bg_color='white', line_color
         bg_color: 背景颜色
         line_color: 线条颜色
         dpi: 输出图像的DPI
+        image_format: 输出图像格式（jpg或png）
+        timings: 可选的字典，用于记录render和encode阶段耗时
+        progress: 可选的回调函数 progress(stage, percent)，报告rendering（含已绘制实体百分比）和encoding阶段
         
     Returns:
         bool: 转换是否成功
     """
     try:
-        logger.info(f"正在转换DXF为JPG: {output_path}")
+        logger.debug("正在转换DXF为JPG: %s", output_path)
         
         # 创建matplotlib图形
+        stage_started = time.perf_counter()
         fig = plt.figure(figsize=(size/dpi, size/dpi), dpi=dpi)
         ax = fig.add_axes([0, 0, 1, 1])
         ax.set_axis_off()
@@ -365,16 +394,37 @@ def convert_dxf_to_jpg(doc, output_path, size=3200, bg_color='white', line_color
         frontend = Frontend(ctx, backend)
         
         # 渲染DXF实体
-        frontend.draw_layout(doc.modelspace(), finalize=True, layout_properties=msp_properties)
+        _report_progress(progress, "rendering", 0)
+        if progress is not None:
+            # 通过实体过滤函数统计已绘制的实体数，每增加5%报告一次进度
+            total_entities = max(len(doc.modelspace()), 1)
+            drawn = {"count": 0, "reported": 0}
+
+            def count_entity(entity):
+                drawn["count"] += 1
+                percent = min(100, drawn["count"] * 100 // total_entities)
+                if percent - drawn["reported"] >= 5:
+                    drawn["reported"] = percent
+                    _report_progress(progress, "rendering", percent)
+                return True
+
+            frontend.draw_layout(doc.modelspace(), finalize=True, filter_func=count_entity,
+                                 layout_properties=msp_properties)
+        else:
+            frontend.draw_layout(doc.modelspace(), finalize=True, layout_properties=msp_properties)
         
         # 调整视图以适应所有实体
         ax.autoscale(tight=True)
         ax.set_aspect('equal')
+        _record_timing(timings, "render", stage_started)
         
-        # 保存为JPG
+        # 保存为JPG（或指定的图像格式）
+        _report_progress(progress, "encoding")
+        stage_started = time.perf_counter()
         canvas = FigureCanvas(fig)
-        fig.savefig(output_path, format='jpg', dpi=dpi, bbox_inches='tight')
+        fig.savefig(output_path, format=image_format, dpi=dpi, bbox_inches='tight')
         plt.close(fig)
+        _record_timing(timings, "encode", stage_started)
         
         logger.info(f"转换完成: {output_path}")
         return True
@@ -0,0 +1,218 @@
+import os
+import re
+import stat
+import time
+import shutil
+import asyncio
+import hashlib
+import uuid
+from pathlib import Path
+from logger_config import logger
+from dwg2jpg import __version__ as converter_version
+from worker_pool import run_conversion
+import metrics
+
+# 内容寻址存储目录：sources保存按SHA256命名的DWG源文件，renders保存渲染结果
+IMAGE_STORE_DIR = Path(os.path.abspath(os.getenv("IMAGE_STORE_DIR", "image_store")))
+SOURCES_DIR = IMAGE_STORE_DIR / "sources"
+RENDERS_DIR = IMAGE_STORE_DIR / "renders"
+# 存储的容量上限（MB），超过时按最近使用时间从早到晚删除文件；0表示不限制
+IMAGE_STORE_MAX_MB = float(os.getenv("IMAGE_STORE_MAX_MB", "10240"))
+# 超过该天数未被使用（保存、命中或被相同内容的文件复用）的文件被删除；0表示不按时间清理
+IMAGE_STORE_MAX_AGE_DAYS = float(os.getenv("IMAGE_STORE_MAX_AGE_DAYS", "30"))
+# 清理存储的间隔（秒），0表示不清理
+IMAGE_STORE_CLEANUP_INTERVAL = float(os.getenv("IMAGE_STORE_CLEANUP_INTERVAL", "3600"))
+
+# 支持的输出格式及对应的MIME类型
+IMAGE_FORMATS = {
+    "jpg": "image/jpeg",
+    "png": "image/png"
+}
+
+# 渲染参数范围限制，避免按需渲染被用来生成超大图像
+MIN_SIZE, MAX_SIZE = 100, 10000
+MIN_DPI, MAX_DPI = 50, 1200
+
+_SHA256_PATTERN = re.compile(r"^[0-9a-f]{64}$")
+_HASH_CHUNK_SIZE = 1024 * 1024
+# 发布或渲染中断时遗留的临时文件（以.开头）超过该时间（秒）后删除，更新的可能仍在写入
+_STALE_TEMP_SECONDS = 3600
+
+# 正在渲染的任务，相同参数的并发请求共享同一次渲染
+_inflight_renders = {}
+
+
+def is_valid_sha256(value):
+    """检查是否为合法的SHA256十六进制字符串"""
+    return bool(value) and bool(_SHA256_PATTERN.match(value))
+
+
+def file_sha256(path):
+    """计算文件内容的SHA256"""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_HASH_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def source_path(sha256):
+    """获取DWG源文件在存储中的路径"""
+    return SOURCES_DIR / sha256[:2] / f"{sha256}.dwg"
+
+
+def rendered_path(sha256, size, dpi, image_format):
+    """获取渲染结果在存储中的路径"""
+    return RENDERS_DIR / sha256[:2] / f"{sha256}_{size}_{dpi}.{image_format}"
+
+
+def touch(path):
+    """更新文件的最近使用时间（修改时间），清理时最近使用的文件最后删除
+
+    返回:
+    - 文件是否存在
+    """
+    try:
+        os.utime(path)
+        return True
+    except OSError:
+        return False
+
+
+def make_etag(sha256, size, dpi, image_format):
+    """生成强ETag
+
+    渲染结果完全由源文件内容、渲染参数和转换器版本决定，因此不需要读取图像内容即可生成ETag
+    """
+    return f'"{sha256}-{size}-{dpi}-{image_format}-{converter_version}"'
+
+
+def _publish(source, target):
+    """先复制到临时文件再原子重命名，避免读者看到不完整的文件"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_target = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+    try:
+        shutil.copyfile(source, temp_target)
+        os.replace(temp_target, target)
+    finally:
+        if temp_target.exists():
+            temp_target.unlink()
+
+
+def store_source(dwg_path):
+    """把DWG文件保存到内容寻址存储中
+
+    返回:
+    - 源文件内容的SHA256
+    """
+    sha256 = file_sha256(dwg_path)
+    target = source_path(sha256)
+    if not touch(target):
+        _publish(dwg_path, target)
+        logger.info(f"已保存DWG源文件到内容寻址存储: {target}")
+    return sha256
+
+
+def store_rendered(sha256, image_path, size=3200, dpi=600, image_format="jpg"):
+    """把已有的渲染结果保存到存储中，后续相同参数的请求可以直接命中"""
+    target = rendered_path(sha256, size, dpi, image_format)
+    if not touch(target):
+        _publish(image_path, target)
+    return target
+
+
+async def _render(sha256, size, dpi, image_format, target):
+    """在转换进程池中渲染图像并发布到存储"""
+    target.parent.mkdir(parents=True, exist_ok=True)
+    temp_output = target.with_name(f".{target.name}.{uuid.uuid4().hex}.render")
+    try:
+        logger.info(f"按需渲染图像: {sha256}, size={size}, dpi={dpi}, format={image_format}")
+        result = await run_conversion(source_path(sha256), temp_output,
+                                      size=size, dpi=dpi, image_format=image_format)
+        if not result["success"] or not temp_output.exists():
+            logger.error(f"按需渲染图像失败: {sha256}, 错误: {result['error']}")
+            return None
+        os.replace(temp_output, target)
+        return target
+    finally:
+        if temp_output.exists():
+            temp_output.unlink()
+
+
+async def get_or_render(sha256, size=3200, dpi=600, image_format="jpg"):
+    """获取渲染结果，不存在时按需渲染
+
+    返回:
+    - 渲染结果的路径；源文件不存在或渲染失败时返回None
+    """
+    target = rendered_path(sha256, size, dpi, image_format)
+    if touch(target):
+        metrics.IMAGE_CACHE_REQUESTS.inc(result="hit")
+        return target
+    metrics.IMAGE_CACHE_REQUESTS.inc(result="miss")
+    if not source_path(sha256).exists():
+        return None
+
+    key = (sha256, size, dpi, image_format)
+    task = _inflight_renders.get(key)
+    if task is None:
+        task = asyncio.ensure_future(_render(sha256, size, dpi, image_format, target))
+        _inflight_renders[key] = task
+        task.add_done_callback(lambda _: _inflight_renders.pop(key, None))
+    # shield防止某个客户端断开连接时取消其他请求共享的渲染
+    return await asyncio.shield(task)
+
+
+def cleanup(max_mb=IMAGE_STORE_MAX_MB, max_age_days=IMAGE_STORE_MAX_AGE_DAYS):
+    """清理存储：删除超过max_age_days天未使用的文件，总大小仍超过max_mb时按最近使用时间从早到晚删除
+
+    源文件被删除后，该图纸未渲染过的尺寸/DPI/格式无法再按需渲染，重新上传或转换后恢复
+
+    返回:
+    - 删除的文件数
+    """
+    now = time.time()
+    files = []
+    for directory in (SOURCES_DIR, RENDERS_DIR):
+        for path in directory.rglob("*"):
+            try:
+                info = path.stat()
+            except OSError:
+                continue
+            if stat.S_ISREG(info.st_mode):
+                files.append((info.st_mtime, info.st_size, path))
+    files.sort(key=lambda item: item[0])
+    total = sum(size for _, size, _ in files)
+    max_bytes = max_mb * 1024 * 1024
+    removed = 0
+    for mtime, size, path in files:
+        age = now - mtime
+        if path.name.startswith("."):
+            if age < _STALE_TEMP_SECONDS:
+                continue
+        elif not (max_age_days and age > max_age_days * 86400) and not (max_mb and total > max_bytes):
+            continue
+        try:
+            path.unlink()
+        except FileNotFoundError:
+            pass
+        except OSError as e:
+            logger.warning(f"删除图像存储中的文件失败: {path}: {str(e)}")
+            continue
+        total -= size
+        removed += 1
+    metrics.IMAGE_STORE_BYTES.set(total)
+    if removed:
+        metrics.IMAGE_STORE_EVICTIONS.inc(removed)
+        logger.info(f"已清理图像存储中的 {removed} 个文件，当前大小 {total / 1024 / 1024:.1f} MB")
+    return removed
+
+
+async def cleanup_periodically(interval=IMAGE_STORE_CLEANUP_INTERVAL):
+    """后台任务：定期清理存储（启动时先清理一次）"""
+    while True:
+        try:
+            await asyncio.to_thread(cleanup)
+        except Exception as e:
+            logger.error(f"清理图像存储时出错: {str(e)}")
+        await asyncio.sleep(interval)
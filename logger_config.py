@@ -1,44 +1,287 @@
 import os
+import json
+import queue
+import atexit
 import logging
+import itertools
+import threading
 import logging.handlers
 from datetime import datetime
 
-# 配置日志
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    datefmt='%Y-%m-%d %H:%M:%S'
-)
+# 日志配置
+# 日志记录只放入内存队列，由后台线程（QueueListener）格式化并写入控制台和文件，
+# 转换任务和请求处理线程不会因为写磁盘而阻塞。转换工作进程的日志通过进程间队列交给主进程写入
+# 默认日志级别
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# 按模块设置日志级别，格式为 模块=级别，多个用逗号分隔，例如 "pipeline=DEBUG,batch_writer=WARNING,ezdxf=WARNING"
+# 模块可以是源文件名（不含.py）或日志记录器名称（按点号前缀匹配）
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+# 日志格式：json（每行一个JSON对象，extra中的字段作为独立的键）或 text
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower()
+# 日志文件路径，为目录或不带扩展名时在其中创建日志文件；留空则只输出到控制台
+LOG_FILE = os.getenv("LOG_FILE")
+# 日志文件轮转方式：留空时每次启动创建一个带日期的日志文件，size按大小轮转，time按时间轮转
+LOG_ROTATE = os.getenv("LOG_ROTATE", "").lower()
+# 按大小轮转时单个日志文件的最大字节数
+LOG_MAX_BYTES = int(os.getenv("LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+# 按时间轮转的周期（TimedRotatingFileHandler的when参数，例如 midnight、H）
+LOG_ROTATE_WHEN = os.getenv("LOG_ROTATE_WHEN", "midnight")
+# 轮转后保留的旧日志文件数
+LOG_BACKUP_COUNT = int(os.getenv("LOG_BACKUP_COUNT", "10"))
+# DEBUG日志采样：同一处代码的DEBUG日志每N条只保留1条，1表示全部保留
+LOG_DEBUG_SAMPLE_RATE = max(int(os.getenv("LOG_DEBUG_SAMPLE_RATE", "1")), 1)
 
-# 创建logger对象
-logger = logging.getLogger(__name__)
+TEXT_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
-# 检查是否设置了日志文件环境变量
-LOG_FILE = os.getenv("LOG_FILE")
-if LOG_FILE:
-    # 确保日志目录存在
-    # 如果LOG_FILE是目录，则使用默认文件名
+# LogRecord自带的属性，其余属性（通过extra传入）在JSON日志中作为独立的键输出
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime"}
+
+
+def _parse_level(value, default=logging.INFO):
+    level = logging.getLevelName(str(value).strip().upper())
+    return level if isinstance(level, int) else default
+
+
+def _parse_module_levels(value):
+    """解析LOG_LEVELS，返回 {模块: 级别}"""
+    levels = {}
+    for item in value.split(","):
+        if "=" not in item:
+            continue
+        name, level = item.split("=", 1)
+        if name.strip():
+            levels[name.strip()] = _parse_level(level)
+    return levels
+
+
+class JsonFormatter(logging.Formatter):
+    """把日志记录格式化为一行JSON"""
+
+    def format(self, record):
+        entry = {
+            "time": datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "line": record.lineno,
+            "process": record.process,
+            "thread": record.threadName,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRIBUTES and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = record.stack_info
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class ModuleLevelFilter(logging.Filter):
+    """按模块过滤日志级别
+
+    大部分模块共用logger_config中的logger，因此除了日志记录器名称，还按记录所在的源文件（record.module）匹配。
+    """
+
+    def __init__(self, default_level, module_levels):
+        super().__init__()
+        self.default_level = default_level
+        self.module_levels = module_levels
+
+    def _level_for(self, record):
+        level = self.module_levels.get(record.module)
+        if level is not None:
+            return level
+        name = record.name
+        while name:
+            level = self.module_levels.get(name)
+            if level is not None:
+                return level
+            name = name.rpartition(".")[0]
+        return self.default_level
+
+    def filter(self, record):
+        return record.levelno >= self._level_for(record)
+
+
+class DebugSamplingFilter(logging.Filter):
+    """同一处代码（源文件和行号）的DEBUG日志每rate条只保留1条"""
+
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self._counters = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG or self.rate <= 1:
+            return True
+        key = (record.pathname, record.lineno)
+        counter = self._counters.get(key)
+        if counter is None:
+            counter = self._counters.setdefault(key, itertools.count())
+        return next(counter) % self.rate == 0
+
+
+class _DeferredQueueHandler(logging.handlers.QueueHandler):
+    """同一进程内的队列处理器：日志消息推迟到后台线程中再格式化"""
+
+    def prepare(self, record):
+        return record
+
+
+def _log_file_path(rotating):
+    """根据LOG_FILE确定日志文件路径，并确保目录存在"""
+    # 如果LOG_FILE是目录或不带扩展名，则在其中生成日志文件
     if os.path.isdir(LOG_FILE) or not os.path.splitext(LOG_FILE)[1]:
-        # 确保目录存在
-        log_dir = LOG_FILE if os.path.isdir(LOG_FILE) else os.path.dirname(LOG_FILE) or '.'
-        if not os.path.exists(log_dir):
-            os.makedirs(log_dir)
+        log_dir = LOG_FILE
+        os.makedirs(log_dir, exist_ok=True)
+        if rotating:
+            # 轮转的日志文件名固定，旧文件由轮转加上后缀
+            return os.path.join(log_dir, 'app.log')
         # 生成带日期的日志文件名，格式为：app_2025-09-07.log
         current_date = datetime.now().strftime('%Y-%m-%d')
-        log_file_path = os.path.join(log_dir, f'app_{current_date}.log')
-    else:
-        log_dir = os.path.dirname(LOG_FILE)
-        if log_dir and not os.path.exists(log_dir):
-            os.makedirs(log_dir)
-        log_file_path = LOG_FILE
-    
-    # 使用基本的FileHandler，因为TimedRotatingFileHandler在Python 3.8中不支持自定义日期格式
-    # 这种方式会在每次应用启动时创建一个新的带日期的日志文件
-    file_handler = logging.FileHandler(
-        log_file_path,
-        encoding='utf-8'
-    )
-    file_handler.setLevel(logging.INFO)
-    file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-    file_handler.setFormatter(file_formatter)
-    logger.addHandler(file_handler)
\ No newline at end of file
+        return os.path.join(log_dir, f'app_{current_date}.log')
+    log_dir = os.path.dirname(LOG_FILE)
+    if log_dir:
+        os.makedirs(log_dir, exist_ok=True)
+    return LOG_FILE
+
+
+def _create_file_handler():
+    # delay=True：文件在第一次写入时才打开，转换工作进程导入本模块时不会打开日志文件
+    if LOG_ROTATE == "size":
+        return logging.handlers.RotatingFileHandler(_log_file_path(True), maxBytes=LOG_MAX_BYTES,
+                                                    backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    if LOG_ROTATE == "time":
+        return logging.handlers.TimedRotatingFileHandler(_log_file_path(True), when=LOG_ROTATE_WHEN,
+                                                         backupCount=LOG_BACKUP_COUNT, encoding='utf-8', delay=True)
+    return logging.FileHandler(_log_file_path(False), encoding='utf-8', delay=True)
+
+
+def _create_output_handlers():
+    """创建实际输出日志的处理器（由后台线程调用）"""
+    text_formatter = logging.Formatter(TEXT_FORMAT, datefmt=DATE_FORMAT)
+    formatter = JsonFormatter() if LOG_FORMAT == "json" else text_formatter
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    handlers = [console_handler]
+    if LOG_FILE:
+        file_handler = _create_file_handler()
+        file_handler.setFormatter(formatter)
+        handlers.append(file_handler)
+    return handlers
+
+
+def _install_filters(handler):
+    handler.addFilter(ModuleLevelFilter(_default_level, _module_levels))
+    if LOG_DEBUG_SAMPLE_RATE > 1:
+        handler.addFilter(DebugSamplingFilter(LOG_DEBUG_SAMPLE_RATE))
+
+
+def _lowest_level():
+    return min([_default_level] + list(_module_levels.values()))
+
+
+_default_level = _parse_level(LOG_LEVEL)
+_module_levels = _parse_module_levels(LOG_LEVELS)
+_output_handlers = _create_output_handlers()
+_listeners = []
+_listeners_lock = threading.Lock()
+_queue_handler = None
+
+
+def _start_listener(log_queue):
+    listener = logging.handlers.QueueListener(log_queue, *_output_handlers)
+    listener.start()
+    with _listeners_lock:
+        _listeners.append(listener)
+    return listener
+
+
+def _configure():
+    """把根日志记录器的输出改为写入内存队列，由后台线程写出"""
+    global _queue_handler
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    queue_handler = _DeferredQueueHandler(queue.SimpleQueue())
+    _install_filters(queue_handler)
+    root.addHandler(queue_handler)
+    root.setLevel(_lowest_level())
+    _queue_handler = queue_handler
+    # 日志记录器名称对应的级别直接设置在记录器上，低于该级别的日志不会创建LogRecord
+    for name, level in _module_levels.items():
+        logging.getLogger(name).setLevel(level)
+    _start_listener(queue_handler.queue)
+
+
+def create_worker_log_queue(context):
+    """创建转换工作进程使用的日志队列，并在本进程中启动写出这些日志的后台线程
+
+    参数:
+    - context: multiprocessing上下文（与进程池使用的一致）
+    """
+    log_queue = context.Queue()
+    _start_listener(log_queue)
+    return log_queue
+
+
+def configure_worker_logging(log_queue):
+    """在转换工作进程中调用：日志不在工作进程中写出，而是放入日志队列交给主进程
+
+    fork启动的工作进程继承了主进程的队列处理器，但没有继承写出日志的后台线程，因此需要替换。
+    """
+    global _queue_handler
+    _queue_handler = None
+    with _listeners_lock:
+        listeners = list(_listeners)
+        _listeners.clear()
+    for listener in listeners:
+        # spawn启动的工作进程导入本模块时启动了自己的后台线程，在这里停止；fork继承的线程对象没有运行，不需要停止
+        if listener._thread is not None and listener._thread.is_alive():
+            listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    # 跨进程的队列处理器在放入队列前格式化消息，保证日志记录可以序列化
+    queue_handler = logging.handlers.QueueHandler(log_queue)
+    _install_filters(queue_handler)
+    root.addHandler(queue_handler)
+
+
+def stop_logging():
+    """写出队列中剩余的日志并停止后台线程（关闭服务时调用，重复调用无影响）"""
+    with _listeners_lock:
+        listeners = list(_listeners)
+        _listeners.clear()
+    for listener in listeners:
+        try:
+            listener.stop()
+        except Exception:
+            pass
+    for handler in _output_handlers:
+        try:
+            handler.flush()
+        except (ValueError, OSError):
+            # 输出流已经被关闭（例如测试框架在退出前关闭了捕获的stdout）
+            pass
+    # 之后的日志（例如解释器退出前的日志）直接同步写出，不再放入已经没有后台线程读取的队列
+    global _queue_handler
+    root = logging.getLogger()
+    if _queue_handler is not None and _queue_handler in root.handlers:
+        root.removeHandler(_queue_handler)
+        for handler in _output_handlers:
+            _install_filters(handler)
+            root.addHandler(handler)
+    _queue_handler = None
+
+
+_configure()
+atexit.register(stop_logging)
+
+# 创建logger对象
+logger = logging.getLogger(__name__)
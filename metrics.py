@@ -0,0 +1,364 @@
+import math
+import threading
+
+# Prometheus文本格式的Content-Type
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# 已注册的全部指标，按注册顺序输出
+_registry = []
+
+
+def _escape_label_value(value):
+    """按Prometheus文本格式转义标签值"""
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=None):
+    """把标签格式化为 {a="1",b="2"} 形式"""
+    pairs = list(zip(labelnames, labelvalues))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape_label_value(value)}"' for name, value in pairs) + "}"
+
+
+def _format_value(value):
+    """格式化指标数值"""
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    """指标基类，线程安全，按标签值分别保存样本"""
+
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        if not self.labelnames and self.metric_type != "histogram":
+            # 无标签的计数器和仪表从0开始输出
+            self._values[()] = 0
+        _registry.append(self)
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"指标 {self.name} 的标签必须是: {self.labelnames}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def remove(self, **labels):
+        """删除一组标签对应的样本"""
+        with self._lock:
+            self._values.pop(self._key(labels), None)
+
+    def _samples(self):
+        with self._lock:
+            return [(self.name, labelvalues, None, value) for labelvalues, value in sorted(self._values.items())]
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for sample_name, labelvalues, extra, value in self._samples():
+            lines.append(f"{sample_name}{_format_labels(self.labelnames, labelvalues, extra)} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """只增不减的计数器"""
+
+    metric_type = "counter"
+
+    def inc(self, amount=1, **labels):
+        if amount < 0:
+            raise ValueError("计数器只能增加")
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(_Metric):
+    """可任意设置的瞬时值"""
+
+    metric_type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def get(self, **labels):
+        with self._lock:
+            return self._values.get(self._key(labels), 0)
+
+
+class Histogram(_Metric):
+    """累积分桶的直方图"""
+
+    metric_type = "histogram"
+
+    DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+                self._values[key] = state
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state["counts"][index] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def _samples(self):
+        samples = []
+        with self._lock:
+            for labelvalues, state in sorted(self._values.items()):
+                for bound, count in zip(self.buckets, state["counts"]):
+                    samples.append((f"{self.name}_bucket", labelvalues, ("le", _format_value(bound)), count))
+                samples.append((f"{self.name}_sum", labelvalues, None, state["sum"]))
+                samples.append((f"{self.name}_count", labelvalues, None, state["count"]))
+        return samples
+
+
+def render_metrics():
+    """以Prometheus文本格式输出全部指标"""
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# 转换流水线指标
+STAGE_DURATION = Histogram(
+    "dwg2jpg_stage_duration_seconds",
+    "各转换阶段耗时（fetch、oda、profile、parse、render、encode、write、db_write）",
+    ["stage"]
+)
+CONVERSION_DURATION = Histogram(
+    "dwg2jpg_conversion_duration_seconds",
+    "单个文件从提交到转换进程池到完成的总耗时（含排队）"
+)
+CONVERSIONS = Counter(
+    "dwg2jpg_conversions_total",
+    "转换结果计数，按状态和失败原因区分",
+    ["status", "reason"]
+)
+IMAGE_STORE_BYTES = Gauge(
+    "dwg2jpg_image_store_bytes",
+    "图像存储中源文件和渲染结果的总大小（每次清理后更新）"
+)
+IMAGE_STORE_EVICTIONS = Counter(
+    "dwg2jpg_image_store_evictions_total",
+    "因超过保留时间或容量上限从图像存储中删除的文件数"
+)
+IMAGE_CACHE_REQUESTS = Counter(
+    "dwg2jpg_image_cache_requests_total",
+    "内容寻址图像存储的查询次数，按命中/未命中区分",
+    ["result"]
+)
+QUEUE_DEPTH = Gauge(
+    "dwg2jpg_queue_depth",
+    "等待空闲工作进程的转换任务数"
+)
+JOBS_IN_FLIGHT = Gauge(
+    "dwg2jpg_jobs_in_flight",
+    "已提交到转换进程池且尚未完成的任务数"
+)
+WORKER_MEMORY = Gauge(
+    "dwg2jpg_worker_memory_bytes",
+    "转换工作进程最近一次任务结束时的内存占用",
+    ["pid"]
+)
+PIPELINE_QUEUE = Gauge(
+    "dwg2jpg_pipeline_queue",
+    "转换流水线中等待进入各阶段的文件数",
+    ["stage"]
+)
+PIPELINE_BUSY = Gauge(
+    "dwg2jpg_pipeline_busy",
+    "转换流水线各阶段正在处理的文件数",
+    ["stage"]
+)
+PIPELINE_CONCURRENCY = Gauge(
+    "dwg2jpg_pipeline_concurrency",
+    "转换流水线各阶段的并发数",
+    ["stage"]
+)
+PIPELINE_BUSY_SECONDS = Counter(
+    "dwg2jpg_pipeline_busy_seconds_total",
+    "转换流水线各阶段累计的处理时间（除以并发数和经过时间即为利用率）",
+    ["stage"]
+)
+PIPELINE_UTILIZATION = Gauge(
+    "dwg2jpg_pipeline_utilization",
+    "最近一个统计周期内转换流水线各阶段的利用率（0~1），利用率最高的阶段为瓶颈",
+    ["stage"]
+)
+PREFETCH_RESULTS = Counter(
+    "dwg2jpg_prefetch_results_total",
+    "预取结果（hit：使用了预取的副本，miss：没有预取，unstable：文件仍在写入而跳过，"
+    "changed：源文件在预取期间或之后发生变化，checksum_mismatch：副本校验失败，error：复制出错）",
+    ["result"]
+)
+PREFETCH_BYTES = Counter(
+    "dwg2jpg_prefetch_bytes_total",
+    "预取从共享目录读取的字节数"
+)
+PREFETCH_STAGED = Gauge(
+    "dwg2jpg_prefetch_staged",
+    "已预取或正在预取、尚未被转换使用的文件数"
+)
+PUBLISH_RESULTS = Counter(
+    "dwg2jpg_publish_results_total",
+    "写回结果文件的次数（success：写入成功，retry：写入失败后重试，failed：重试后仍失败）",
+    ["result"]
+)
+PUBLISH_BYTES = Counter(
+    "dwg2jpg_publish_bytes_total",
+    "写回目标位置的字节数"
+)
+PUBLISH_SECONDS = Counter(
+    "dwg2jpg_publish_seconds_total",
+    "写回文件累计花费的时间（秒），与写入字节数相除即为平均写入吞吐量"
+)
+PUBLISH_THROUGHPUT = Gauge(
+    "dwg2jpg_publish_throughput_bytes_per_second",
+    "最近写入吞吐量的移动平均（字节/秒）"
+)
+RETRY_DECISIONS = Counter(
+    "dwg2jpg_retry_decisions_total",
+    "转换失败后的处理，按失败分类（transient、permanent、poison）和处理结果（retry：稍后重试，"
+    "failed：标记为失败，quarantined：隔离）区分",
+    ["kind", "outcome"]
+)
+TRACE_SPANS = Counter(
+    "dwg2jpg_trace_spans_total",
+    "追踪span的导出结果（exported：已导出，dropped：导出失败或等待导出的span过多而丢弃）",
+    ["result"]
+)
+RENDER_ROUTES = Counter(
+    "dwg2jpg_render_routes_total",
+    "渲染任务提交到的进程池（normal：普通进程池，heavy：复杂图纸专用进程池）",
+    ["pool"]
+)
+WORKER_POOL_RESTARTS = Counter(
+    "dwg2jpg_worker_pool_restarts_total",
+    "转换进程池被丢弃重建的次数（crashed：工作进程异常退出，timeout：渲染超时后终止工作进程）",
+    ["pool", "cause"]
+)
+COST_MODEL_SAMPLES = Gauge(
+    "dwg2jpg_cost_model_samples",
+    "成本模型当前用于拟合的样本数"
+)
+COST_PREDICTION_ERROR = Histogram(
+    "dwg2jpg_cost_prediction_error",
+    "成本模型预测渲染耗时的相对误差（|预测-实际| / 实际）",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5)
+)
+POLL_CYCLES = Counter(
+    "dwg2jpg_poll_cycles_total",
+    "数据库轮询次数，按触发原因区分（work：上一轮有待转换文件，wake：外部唤醒，changed：检测到数据变化，timeout：空闲退避到期）",
+    ["trigger"]
+)
+POLL_INTERVAL = Gauge(
+    "dwg2jpg_poll_interval_seconds",
+    "当前空闲退避的轮询间隔，有待转换文件时为0"
+)
+CONVERSIONS_DEDUPLICATED = Counter(
+    "dwg2jpg_conversions_deduplicated_total",
+    "因源文件相同而省去的转换次数（queue：候选窗口中合并，path：共享正在进行的同路径转换，"
+    "content：共享正在进行的同内容转换，cached：图像存储中已有相同内容的渲染结果）",
+    ["kind"]
+)
+SCHEDULE_QUEUE = Gauge(
+    "dwg2jpg_schedule_queue",
+    "已认领、在候选窗口中等待派发的文件数，按优先级区分",
+    ["priority"]
+)
+SCHEDULE_LATENCY = Histogram(
+    "dwg2jpg_schedule_latency_seconds",
+    "定期任务中从认领到转换完成的耗时，按优先级区分",
+    ["priority"]
+)
+DB_PENDING_FILES = Gauge(
+    "dwg2jpg_db_pending_files",
+    "最近一次轮询数据库时待转换的DWG文件数"
+)
+
+
+def record_conversion(success, reason=""):
+    """记录一次转换结果，成功时reason为空"""
+    CONVERSIONS.inc(status="success" if success else "failure", reason="" if success else reason)
+
+# 数据库连接池指标
+DB_POOL_WAIT = Histogram(
+    "dwg2jpg_db_pool_wait_seconds",
+    "从数据库连接池借出连接的等待时间",
+    buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30)
+)
+DB_POOL_CONNECTIONS = Gauge(
+    "dwg2jpg_db_pool_connections",
+    "数据库连接池中的连接数，按空闲/使用中区分",
+    ["state"]
+)
+DB_POOL_TIMEOUTS = Counter(
+    "dwg2jpg_db_pool_timeouts_total",
+    "等待数据库连接超时的次数"
+)
+DB_RECONNECTS = Counter(
+    "dwg2jpg_db_reconnects_total",
+    "因健康检查失败或连接错误而重建数据库连接的次数"
+)
+DB_EXECUTOR_CALLS = Gauge(
+    "dwg2jpg_db_executor_calls",
+    "数据库专用线程池中正在执行或排队的异步数据库调用数"
+)
+DB_QUERY_TIMEOUTS = Counter(
+    "dwg2jpg_db_query_timeouts_total",
+    "异步数据库调用超时的次数"
+)
+
+# 批量写入指标
+DB_WRITE_QUEUE = Gauge(
+    "dwg2jpg_db_write_queue",
+    "等待批量写入数据库的语句数"
+)
+DB_WRITE_SPILLED = Gauge(
+    "dwg2jpg_db_write_spilled",
+    "批量写入队列已满时暂存到磁盘、等待写入的语句数"
+)
+DB_WRITE_DROPPED = Counter(
+    "dwg2jpg_db_write_dropped_total",
+    "无法暂存到磁盘（或无法保存到拒绝文件）而被丢弃的待写入语句数"
+)
+DB_WRITE_REJECTED = Counter(
+    "dwg2jpg_db_write_rejected_total",
+    "逐条写入时被数据库拒绝（数据错误）、保存到拒绝文件的语句数"
+)
+DB_BATCH_SIZE = Histogram(
+    "dwg2jpg_db_batch_size",
+    "每次批量写入提交的语句数",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+DB_BATCH_FLUSHES = Counter(
+    "dwg2jpg_db_batch_flushes_total",
+    "批量写入的提交次数，按结果区分（success、deadlock_retry、requeued、row_by_row）",
+    ["result"]
+)
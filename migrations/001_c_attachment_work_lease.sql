@@ -0,0 +1,20 @@
+-- ==================================================
+-- C_Attachment 工作租约列
+-- 多个工作进程/多台服务器同时轮询待转换的DWG时，通过租约认领行，避免重复转换
+--   ClaimOwner:     认领者标识（主机名:进程号:随机后缀，或WORKER_ID环境变量）
+--   ClaimExpiresAt: 租约到期时间（UTC），过期后其他工作进程可以重新认领
+-- 可重复执行
+-- ==================================================
+
+IF COL_LENGTH('C_Attachment', 'ClaimOwner') IS NULL
+    ALTER TABLE C_Attachment ADD ClaimOwner NVARCHAR(128) NULL;
+GO
+
+IF COL_LENGTH('C_Attachment', 'ClaimExpiresAt') IS NULL
+    ALTER TABLE C_Attachment ADD ClaimExpiresAt DATETIME2 NULL;
+GO
+
+-- 续约和释放按认领者查找行
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_C_Attachment_ClaimOwner' AND object_id = OBJECT_ID('C_Attachment'))
+    CREATE INDEX IX_C_Attachment_ClaimOwner ON C_Attachment (ClaimOwner) WHERE ClaimOwner IS NOT NULL;
+GO
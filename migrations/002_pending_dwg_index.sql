@@ -0,0 +1,19 @@
+-- ==================================================
+-- 待转换DWG轮询索引
+-- 认领查询的条件为 istojpg IS NULL AND FilePath LIKE '%.dwg'，并按RefId关联c_order、按Id排序。
+-- 过滤索引只包含尚未转换的行，行数远小于整张C_Attachment表，轮询不再需要扫描全表；
+-- FilePath放在INCLUDE中（前导通配符的LIKE无法使用索引查找，只需在索引内过滤）
+-- 可重复执行
+-- ==================================================
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_C_Attachment_PendingDwg' AND object_id = OBJECT_ID('C_Attachment'))
+    CREATE INDEX IX_C_Attachment_PendingDwg
+        ON C_Attachment (istojpg, RefId, Id)
+        INCLUDE (FilePath, ClaimOwner, ClaimExpiresAt)
+        WHERE istojpg IS NULL;
+GO
+
+-- 认领查询按订单状态筛选订单
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_C_Order_OrderStatus' AND object_id = OBJECT_ID('c_order'))
+    CREATE INDEX IX_C_Order_OrderStatus ON c_order (OrderStatus, id);
+GO
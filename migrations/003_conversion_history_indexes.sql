@@ -0,0 +1,17 @@
+-- ==================================================
+-- conversion_history 分页索引
+-- /conversion-history 按 (conversion_time DESC, id DESC) 键集分页，可按status过滤：
+--   IX_conversion_history_status_time: 按状态过滤的分页和COUNT(*)只读取该索引（覆盖索引）
+--   IX_conversion_history_time:        不过滤状态时按时间倒序分页
+-- 可重复执行
+-- ==================================================
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_conversion_history_status_time' AND object_id = OBJECT_ID('conversion_history'))
+    CREATE INDEX IX_conversion_history_status_time
+        ON conversion_history (status, conversion_time DESC, id DESC)
+        INCLUDE (file_name, original_path, jpg_path, file_size, error_message);
+GO
+
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_conversion_history_time' AND object_id = OBJECT_ID('conversion_history'))
+    CREATE INDEX IX_conversion_history_time ON conversion_history (conversion_time DESC, id DESC);
+GO
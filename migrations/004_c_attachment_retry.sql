@@ -0,0 +1,42 @@
+-- ==================================================
+-- C_Attachment 重试状态列
+-- 转换失败时按失败原因决定稍后重试、标记失败或隔离，而不是一律把istojpg置为-1：
+--   RetryCount:    已经失败的转换次数
+--   NextAttemptAt: 下一次允许认领的时间（UTC），为NULL或已到期时才会被认领
+--   LastError:     最近一次失败的原因和错误信息
+--   CrashCount:    其中导致工作进程崩溃或渲染超时的次数，是否隔离只看这个次数（暂时性错误不计入）
+-- istojpg = -1 表示转换失败（不可重试的错误或重试次数用尽），-2 表示反复导致工作进程崩溃或超时而被隔离。
+-- 重新转换某个文件: UPDATE C_Attachment SET istojpg = NULL, RetryCount = 0, CrashCount = 0, NextAttemptAt = NULL WHERE Id = ...
+-- 可重复执行
+-- ==================================================
+
+IF COL_LENGTH('C_Attachment', 'RetryCount') IS NULL
+    ALTER TABLE C_Attachment ADD RetryCount INT NULL;
+GO
+
+IF COL_LENGTH('C_Attachment', 'NextAttemptAt') IS NULL
+    ALTER TABLE C_Attachment ADD NextAttemptAt DATETIME2 NULL;
+GO
+
+IF COL_LENGTH('C_Attachment', 'LastError') IS NULL
+    ALTER TABLE C_Attachment ADD LastError NVARCHAR(500) NULL;
+GO
+
+IF COL_LENGTH('C_Attachment', 'CrashCount') IS NULL
+    ALTER TABLE C_Attachment ADD CrashCount INT NULL;
+GO
+
+-- 认领查询增加了NextAttemptAt条件，放入待转换DWG轮询索引的INCLUDE中
+IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_C_Attachment_PendingDwg' AND object_id = OBJECT_ID('C_Attachment'))
+    AND NOT EXISTS (
+        SELECT 1 FROM sys.index_columns ic
+        INNER JOIN sys.indexes i ON i.object_id = ic.object_id AND i.index_id = ic.index_id
+        WHERE i.name = 'IX_C_Attachment_PendingDwg' AND i.object_id = OBJECT_ID('C_Attachment')
+          AND ic.column_id = COLUMNPROPERTY(OBJECT_ID('C_Attachment'), 'NextAttemptAt', 'ColumnId')
+    )
+    CREATE INDEX IX_C_Attachment_PendingDwg
+        ON C_Attachment (istojpg, RefId, Id)
+        INCLUDE (FilePath, ClaimOwner, ClaimExpiresAt, NextAttemptAt, RetryCount)
+        WHERE istojpg IS NULL
+        WITH (DROP_EXISTING = ON);
+GO
@@ -0,0 +1,45 @@
+-- ==================================================
+-- drawing_profile 图纸复杂度表
+-- 渲染前扫描DXF得到的复杂度指标，以及实际的渲染耗时和峰值内存，每次成功渲染一行（与conversion_history对应）。
+-- 服务启动时读取最近的记录恢复成本模型，用于在渲染前预测耗时和内存、把复杂图纸交给专用进程池：
+--   expanded_entity_count: 展开块引用后的模型空间实体数
+--   block_depth:           块引用的最大嵌套深度
+--   entity_counts:         模型空间各类型实体数（JSON）
+--   render_seconds / peak_memory_bytes:           工作进程内的实际渲染耗时和峰值内存
+--   predicted_seconds / predicted_memory_bytes:   渲染前成本模型的预测值（样本不足时为NULL）
+--   pool:                  渲染使用的进程池（normal、heavy）
+-- 可重复执行
+-- ==================================================
+
+IF OBJECT_ID('drawing_profile') IS NULL
+    CREATE TABLE drawing_profile (
+        id INT IDENTITY(1, 1) PRIMARY KEY,
+        file_name NVARCHAR(260) NULL,
+        original_path NVARCHAR(1000) NULL,
+        source_sha256 CHAR(64) NULL,
+        file_size BIGINT NULL,
+        entity_count INT NULL,
+        expanded_entity_count BIGINT NULL,
+        block_count INT NULL,
+        block_depth INT NULL,
+        hatch_count BIGINT NULL,
+        text_count BIGINT NULL,
+        vertex_count BIGINT NULL,
+        extent_min_x FLOAT NULL,
+        extent_min_y FLOAT NULL,
+        extent_max_x FLOAT NULL,
+        extent_max_y FLOAT NULL,
+        entity_counts NVARCHAR(MAX) NULL,
+        render_seconds FLOAT NULL,
+        peak_memory_bytes BIGINT NULL,
+        predicted_seconds FLOAT NULL,
+        predicted_memory_bytes BIGINT NULL,
+        pool NVARCHAR(16) NULL,
+        profile_time DATETIME NOT NULL DEFAULT GETDATE()
+    );
+GO
+
+-- 按内容查找同一张图纸的历史记录
+IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'IX_drawing_profile_sha256' AND object_id = OBJECT_ID('drawing_profile'))
+    CREATE INDEX IX_drawing_profile_sha256 ON drawing_profile (source_sha256);
+GO
@@ -0,0 +1,557 @@
+import os
+import time
+import shutil
+import asyncio
+import hashlib
+import tempfile
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logger_config import logger
+from dwg2jpg.converter import convert_dwg_to_dxf
+from worker_pool import CONVERT_WORKERS, HEAVY_WORKERS, run_render
+from prefetch import prefetcher
+from publisher import publisher, PublishError
+from batch_writer import queue_drawing_profile
+import complexity
+import image_store
+import metrics
+import progress
+import tracing
+
+# 转换流水线配置
+# 一个文件的转换拆分为多个阶段，阶段之间用有界队列连接，每个阶段有自己的并发数，
+# 文件N在渲染时文件N+1可以同时进行ODA转换，文件N+2可以同时从共享目录读取
+# 从共享目录复制DWG到本地工作目录的并发数
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv("PIPELINE_FETCH_CONCURRENCY", "4"))
+# 同时运行的ODA转换进程数（ODA主要等待磁盘，可以比CPU核数多）
+PIPELINE_ODA_CONCURRENCY = int(os.getenv("PIPELINE_ODA_CONCURRENCY", str(CONVERT_WORKERS)))
+# 单个文件渲染的超时时间（秒，从工作进程开始渲染时计算，不含排队），0表示不限制。
+# 超时后终止并重建该进程池（同一进程池中被中断的其他文件按pool_recycled稍后重试），
+# 超时的文件按worker_crashed同类处理：计入CrashCount，达到RETRY_QUARANTINE_ATTEMPTS次后隔离
+PIPELINE_RENDER_TIMEOUT = float(os.getenv("PIPELINE_RENDER_TIMEOUT", "600"))
+# 成本模型有预测耗时时，超时时间至少为预测耗时的倍数，预测耗时长的复杂图纸不会因为固定的超时被判为超时
+PIPELINE_RENDER_TIMEOUT_FACTOR = float(os.getenv("PIPELINE_RENDER_TIMEOUT_FACTOR", "3"))
+# 阶段之间每个队列最多缓存的文件数
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "2"))
+# 统计各阶段利用率的间隔（秒）
+PIPELINE_SAMPLE_INTERVAL = float(os.getenv("PIPELINE_SAMPLE_INTERVAL", "10"))
+# 本地工作目录的上级目录，留空则使用系统临时目录
+PIPELINE_WORK_DIR = os.getenv("PIPELINE_WORK_DIR") or None
+# 启动时删除超过该时间（小时）的遗留工作目录（进程异常退出时未能清理），0表示不清理
+PIPELINE_STALE_WORKSPACE_HOURS = float(os.getenv("PIPELINE_STALE_WORKSPACE_HOURS", "24"))
+
+_WORKSPACE_PREFIX = "dwg2jpg_pipeline_"
+
+
+class StageFailed(Exception):
+    """阶段处理失败（例如文件不存在、ODA转换失败），reason用于按原因统计失败"""
+
+    def __init__(self, message, reason):
+        super().__init__(message)
+        self.reason = reason
+
+
+class DuplicateSource(Exception):
+    """源文件内容与正在转换（或已经渲染过）的文件相同，不需要再次转换
+
+    rendered为图像存储中渲染结果的路径；pending为正在进行的那次转换完成时的future（结果为是否成功），
+    渲染结果已经存在时为None
+    """
+
+    # 不是错误，阶段的span不标记为失败
+    trace_error = False
+
+    def __init__(self, rendered, pending=None):
+        super().__init__(f"相同内容的源文件: {rendered}")
+        self.rendered = rendered
+        self.pending = pending
+
+
+class Stage:
+    """流水线中的一个阶段
+
+    handler为异步函数，接收上一阶段的输出并返回本阶段的输出，抛出异常时该文件不再进入后续阶段；
+    record_duration为True时把每个文件在本阶段的耗时记录到dwg2jpg_stage_duration_seconds
+    """
+
+    def __init__(self, name, handler, concurrency, record_duration=True):
+        self.name = name
+        self.handler = handler
+        self.concurrency = max(concurrency, 1)
+        self.record_duration = record_duration
+        # 正在处理的文件的开始时间和累计的处理时间（秒），用于计算利用率
+        self._running = {}
+        self.busy_seconds = 0.0
+
+    @property
+    def busy(self):
+        return len(self._running)
+
+    def busy_seconds_now(self, now):
+        """截至now的累计处理时间，包含正在处理中的文件已经花费的时间"""
+        return self.busy_seconds + sum(now - started for started in self._running.values())
+
+
+class Pipeline:
+    """由多个阶段组成的异步流水线
+
+    每个阶段启动concurrency个工作协程，从自己的输入队列取出文件处理后放入下一阶段的队列；
+    队列有界，下游阶段处理不过来时上游阶段等待（背压）。
+    每个文件在每个阶段的处理记录为一个span，上级为提交该文件时的当前span。
+    """
+
+    def __init__(self, stages, queue_size=PIPELINE_QUEUE_SIZE, sample_interval=PIPELINE_SAMPLE_INTERVAL):
+        self.stages = stages
+        self.queue_size = max(queue_size, 1)
+        self.sample_interval = sample_interval
+        self._queues = None
+        self._tasks = []
+        # 各工作协程正在处理的文件对应的future
+        self._current = {}
+        # 利用率统计: 阶段名称 -> (上次统计时间, 上次统计时的累计处理时间)
+        self._samples = {}
+        self._utilization = {stage.name: 0.0 for stage in stages}
+
+    @property
+    def max_in_flight(self):
+        """流水线中同时容纳的文件数上限（各阶段并发数与队列容量之和）"""
+        return sum(stage.concurrency for stage in self.stages) + self.queue_size * len(self.stages)
+
+    def start(self):
+        """在当前事件循环中启动各阶段的工作协程（重复调用无影响）"""
+        if self._queues is not None:
+            return
+        self._queues = [asyncio.Queue(self.queue_size) for _ in self.stages]
+        for index, stage in enumerate(self.stages):
+            metrics.PIPELINE_CONCURRENCY.set(stage.concurrency, stage=stage.name)
+            for _ in range(stage.concurrency):
+                self._tasks.append(asyncio.ensure_future(self._worker(index)))
+        # 以启动时间作为第一次统计利用率的起点
+        self.sample_utilization()
+        if self.sample_interval > 0:
+            self._tasks.append(asyncio.ensure_future(self._sample_periodically()))
+        logger.info("转换流水线已启动: " + " -> ".join(f"{stage.name}({stage.concurrency})" for stage in self.stages))
+
+    async def submit(self, item):
+        """把一个文件放入流水线并等待它离开最后一个阶段
+
+        返回:
+        - 最后一个阶段的输出；任一阶段出错时抛出该异常
+        """
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        await self._put(0, item, future, tracing.current_span())
+        return await future
+
+    async def _put(self, index, item, future, parent):
+        queue = self._queues[index]
+        await queue.put((item, future, parent, time.perf_counter()))
+        metrics.PIPELINE_QUEUE.set(queue.qsize(), stage=self.stages[index].name)
+
+    async def _worker(self, index):
+        try:
+            await self._work(index)
+        finally:
+            # 流水线停止时，正在处理的文件以CancelledError结束，避免调用方一直等待
+            future = self._current.pop(asyncio.current_task(), None)
+            if future is not None and not future.done():
+                future.cancel()
+
+    async def _work(self, index):
+        stage = self.stages[index]
+        queue = self._queues[index]
+        task = asyncio.current_task()
+        while True:
+            self._current.pop(task, None)
+            item, future, parent, queued_at = await queue.get()
+            self._current[task] = future
+            metrics.PIPELINE_QUEUE.set(queue.qsize(), stage=stage.name)
+            if future.done():
+                # 调用方已经取消等待（例如应用关闭），不再继续处理
+                continue
+
+            token = object()
+            started = time.perf_counter()
+            stage._running[token] = started
+            metrics.PIPELINE_BUSY.set(stage.busy, stage=stage.name)
+            try:
+                # 工作协程处理不同的文件，span的上级是提交该文件时的当前span，而不是工作协程的上下文
+                with tracing.span(stage.name, parent=parent, queue_wait_seconds=round(started - queued_at, 3)):
+                    item = await stage.handler(item)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            finally:
+                elapsed = time.perf_counter() - started
+                del stage._running[token]
+                stage.busy_seconds += elapsed
+                metrics.PIPELINE_BUSY.set(stage.busy, stage=stage.name)
+                metrics.PIPELINE_BUSY_SECONDS.inc(elapsed, stage=stage.name)
+                if stage.record_duration:
+                    metrics.STAGE_DURATION.observe(elapsed, stage=stage.name)
+
+            if future.done():
+                continue
+            if index + 1 == len(self.stages):
+                future.set_result(item)
+            else:
+                await self._put(index + 1, item, future, parent)
+
+    def sample_utilization(self):
+        """计算自上次统计以来各阶段的利用率（处理时间 / (并发数 × 经过时间)）
+
+        返回:
+        - 字典: 阶段名称 -> 利用率（0~1），利用率最高的阶段即为瓶颈
+        """
+        now = time.perf_counter()
+        for stage in self.stages:
+            busy_seconds = stage.busy_seconds_now(now)
+            last_time, last_busy = self._samples.get(stage.name, (now, busy_seconds))
+            self._samples[stage.name] = (now, busy_seconds)
+            elapsed = now - last_time
+            if elapsed > 0:
+                utilization = min((busy_seconds - last_busy) / (stage.concurrency * elapsed), 1.0)
+                self._utilization[stage.name] = utilization
+                metrics.PIPELINE_UTILIZATION.set(round(utilization, 4), stage=stage.name)
+        return dict(self._utilization)
+
+    async def _sample_periodically(self):
+        while True:
+            await asyncio.sleep(self.sample_interval)
+            utilization = self.sample_utilization()
+            if any(utilization.values()):
+                bottleneck = max(utilization, key=utilization.get)
+                logger.info("转换流水线各阶段利用率: " +
+                            ", ".join(f"{name} {value:.0%}" for name, value in utilization.items()) +
+                            f"，瓶颈: {bottleneck}")
+
+    async def stop(self):
+        """停止各阶段的工作协程，尚未完成的文件以CancelledError结束"""
+        for task in self._tasks:
+            task.cancel()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._queues is not None:
+            for queue in self._queues:
+                while not queue.empty():
+                    _, future, _, _ = queue.get_nowait()
+                    if not future.done():
+                        future.cancel()
+        self._queues = None
+
+
+# 读取共享目录和运行ODA的线程池（ODA在子进程中运行，线程只是等待它结束），写回JPG使用publisher的写入线程池
+_io_executor = None
+
+
+def _get_io_executor():
+    global _io_executor
+    if _io_executor is None:
+        _io_executor = ThreadPoolExecutor(
+            max_workers=PIPELINE_FETCH_CONCURRENCY + PIPELINE_ODA_CONCURRENCY,
+            thread_name_prefix="pipeline-io"
+        )
+    return _io_executor
+
+
+async def _run_io(func, *args):
+    # 在当前上下文中执行，线程中输出的日志（例如ODA转换）带有当前文件的trace_id
+    return await asyncio.get_running_loop().run_in_executor(_get_io_executor(), tracing.run_in_context(func, *args))
+
+
+# 当前进程正在使用的工作目录
+_workspaces = set()
+
+
+def remove_workspaces():
+    """删除当前进程仍未清理的工作目录（应用关闭时调用）"""
+    for workspace in list(_workspaces):
+        shutil.rmtree(workspace, ignore_errors=True)
+        _workspaces.discard(workspace)
+
+
+def remove_stale_workspaces(max_age_hours=PIPELINE_STALE_WORKSPACE_HOURS):
+    """删除修改时间超过max_age_hours的遗留工作目录
+
+    多个工作进程共用同一个上级目录时，其他进程正在使用的工作目录不会这么旧，不受影响
+
+    返回:
+    - 删除的目录数
+    """
+    if max_age_hours <= 0:
+        return 0
+    parent = Path(PIPELINE_WORK_DIR or tempfile.gettempdir())
+    cutoff = time.time() - max_age_hours * 3600
+    removed = 0
+    try:
+        for workspace in parent.glob(f"{_WORKSPACE_PREFIX}*"):
+            try:
+                if workspace.is_dir() and workspace.stat().st_mtime < cutoff:
+                    shutil.rmtree(workspace, ignore_errors=True)
+                    removed += 1
+            except OSError:
+                continue
+    except OSError as e:
+        logger.error(f"清理遗留的工作目录失败: {str(e)}")
+    if removed:
+        logger.info(f"已删除 {removed} 个遗留的流水线工作目录: {parent}")
+    return removed
+
+
+# 正在转换的源文件内容: (SHA256, size, dpi, image_format) -> 转换完成时的future（结果为是否成功）
+_inflight_contents = {}
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+def _copy_with_sha256(source, target):
+    """复制文件并在同一次读取中计算内容的SHA256"""
+    digest = hashlib.sha256()
+    with open(source, "rb") as src, open(target, "wb") as dst:
+        for chunk in iter(lambda: src.read(_COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+            dst.write(chunk)
+    return digest.hexdigest()
+
+
+def _content_key(sha256, options):
+    return (sha256, options.get("size", 3200), options.get("dpi", 600), options.get("image_format", "jpg"))
+
+
+def _publish(job, stage, **data):
+    """发布一个文件的进度事件，事件带有文件名和附件ID（数据库转换时）"""
+    progress.publish(job["job_id"], stage, file=job["file_label"], attachment_id=job["attachment_id"], **data)
+
+
+async def _fetch_stage(job):
+    """从共享目录复制DWG文件到本地工作目录，后续阶段只访问本地磁盘
+
+    已经预取到本地暂存目录的文件直接移动过来；否则复制时计算内容的SHA256。
+    相同内容的文件正在转换或已有渲染结果时，抛出DuplicateSource离开流水线
+    """
+    _publish(job, "fetching")
+    source = Path(job["dwg_path"])
+    # ODA按目录转换，输入文件单独放在一个子目录中，输出DXF放在工作目录
+    input_dir = Path(job["workspace"]) / "input"
+    input_dir.mkdir(exist_ok=True)
+    job["local_dwg"] = str(input_dir / source.name)
+
+    staged = await prefetcher.take(source)
+    if staged is not None:
+        await _run_io(shutil.move, staged.path, job["local_dwg"])
+        sha256 = staged.sha256
+    else:
+        if not await _run_io(source.exists):
+            raise StageFailed(f"DWG文件不存在: {source}", "file_not_found")
+        try:
+            sha256 = await _run_io(_copy_with_sha256, str(source), job["local_dwg"])
+        except OSError as e:
+            raise StageFailed(f"读取DWG文件失败: {str(e)}", "share_unavailable")
+
+    key = _content_key(sha256, job["options"])
+    rendered = image_store.rendered_path(*key)
+    pending = _inflight_contents.get(key)
+    if pending is not None:
+        raise DuplicateSource(rendered, pending)
+    # 先登记再检查图像存储，检查期间认领到的相同内容的文件会等待这一次的结果
+    _inflight_contents[key] = asyncio.get_running_loop().create_future()
+    job["content_key"] = key
+    # 复用渲染结果时更新其最近使用时间，存储清理时最后删除
+    if await _run_io(image_store.touch, rendered):
+        raise DuplicateSource(rendered)
+    return job
+
+
+async def _oda_stage(job):
+    """调用ODA把本地DWG转换为DXF"""
+    _publish(job, "oda")
+    dxf_path = str(Path(job["workspace"]) / f"{Path(job['local_dwg']).stem}.dxf")
+    if not await _run_io(convert_dwg_to_dxf, job["local_dwg"], dxf_path) or not os.path.exists(dxf_path):
+        raise StageFailed("DWG到DXF转换失败", "dxf_failed")
+    job["dxf_path"] = dxf_path
+    if complexity.COMPLEXITY_PROFILE:
+        # 渲染前快速扫描DXF，用于预测渲染开销并选择进程池
+        job["profile"] = await _run_io(complexity.profile_dxf, dxf_path)
+    return job
+
+
+def _route_render(job):
+    """按成本模型的预测选择渲染使用的进程池，预测值记录到当前span和job中"""
+    profile = job.get("profile")
+    if profile is None:
+        return "normal"
+    seconds, memory = complexity.cost_model.predict(profile)
+    job["predicted_seconds"], job["predicted_memory_bytes"] = seconds, memory
+    pool = "heavy" if complexity.is_heavy(profile, seconds, memory) else "normal"
+    span = tracing.current_span()
+    if span is not None:
+        span.set_attribute("expanded_entity_count", profile["expanded_entity_count"])
+        span.set_attribute("pool", pool)
+        if seconds is not None:
+            span.set_attribute("predicted_seconds", round(seconds, 3))
+        if memory is not None:
+            span.set_attribute("predicted_memory_bytes", int(memory))
+    if pool == "heavy":
+        predicted = "未知" if seconds is None else f"{seconds:.1f}秒"
+        logger.info(f"复杂图纸交给专用进程池渲染: {job['file_label']}（展开后实体数 "
+                    f"{profile['expanded_entity_count']}，预测耗时 {predicted}）")
+    return pool
+
+
+def _record_profile(job, pool, result):
+    """渲染成功后用实际耗时和峰值内存更新成本模型，并把复杂度指标写入drawing_profile表"""
+    profile = job.get("profile")
+    if profile is None:
+        return
+    complexity.cost_model.observe(profile, result["seconds"], result.get("peak_memory_bytes"))
+    error = complexity.relative_error(job.get("predicted_seconds"), result["seconds"])
+    if error is not None:
+        metrics.COST_PREDICTION_ERROR.observe(error)
+    queue_drawing_profile(Path(job["dwg_path"]).name, job["dwg_path"], job["content_key"][0], profile,
+                          render_seconds=result["seconds"], peak_memory_bytes=result.get("peak_memory_bytes"),
+                          predicted_seconds=job.get("predicted_seconds"),
+                          predicted_memory_bytes=job.get("predicted_memory_bytes"), pool=pool)
+
+
+def _render_timeout(job):
+    """渲染超时时间：PIPELINE_RENDER_TIMEOUT，有预测耗时时不少于预测耗时的PIPELINE_RENDER_TIMEOUT_FACTOR倍"""
+    if not PIPELINE_RENDER_TIMEOUT:
+        return None
+    predicted = job.get("predicted_seconds")
+    if predicted is None:
+        return PIPELINE_RENDER_TIMEOUT
+    return max(PIPELINE_RENDER_TIMEOUT, predicted * PIPELINE_RENDER_TIMEOUT_FACTOR)
+
+
+async def _render_stage(job):
+    """在转换进程池中解析DXF、渲染并编码为本地JPG"""
+    local_jpg = str(Path(job["workspace"]) / Path(job["jpg_path"]).name)
+    pool = _route_render(job)
+    # 超时后run_render终止并重建进程池，不会让超时的图纸继续占用工作进程
+    result = await run_render(job["dxf_path"], local_jpg, job_id=job["job_id"], file_label=job["file_label"],
+                              pool=pool, timeout=_render_timeout(job),
+                              attachment_id=job["attachment_id"], **job["options"])
+    job["timings"].update(result["timings"])
+    if not result["success"]:
+        raise StageFailed(result["error"] or "DXF到JPG转换失败", result["reason"] or "render_failed")
+    _record_profile(job, pool, result)
+    job["local_jpg"] = local_jpg
+    # 按内容保存到图像存储，相同内容的其他文件（包括以后认领到的）直接复制渲染结果
+    sha256, size, dpi, image_format = job["content_key"]
+    await _run_io(image_store.store_rendered, sha256, local_jpg, size, dpi, image_format)
+    return job
+
+
+async def _write_stage(job):
+    """把本地生成的JPG发布到目标位置（通常是DWG所在的共享目录），先写临时文件再原子重命名"""
+    _publish(job, "writing")
+    try:
+        await publisher.publish(job["local_jpg"], job["jpg_path"], move=True)
+    except (OSError, PublishError) as e:
+        raise StageFailed(str(e), "write_failed")
+    return job
+
+
+def build_conversion_pipeline():
+    """创建DWG到JPG的转换流水线: fetch -> oda（含复杂度分析） -> render（解析、渲染、编码） -> write
+
+    解析、渲染和编码在同一个工作进程中完成：ezdxf文档和matplotlib图形无法在进程之间传递；
+    这三个阶段的耗时由工作进程分别记录。渲染阶段的并发数包含复杂图纸专用进程池的工作进程数
+    """
+    return Pipeline([
+        Stage("fetch", _fetch_stage, PIPELINE_FETCH_CONCURRENCY),
+        Stage("oda", _oda_stage, PIPELINE_ODA_CONCURRENCY),
+        Stage("render", _render_stage, CONVERT_WORKERS + HEAVY_WORKERS, record_duration=False),
+        Stage("write", _write_stage, publisher.concurrency),
+    ])
+
+
+# 全局转换流水线（首次提交时在事件循环中启动）
+conversion_pipeline = build_conversion_pipeline()
+
+
+async def _publish_duplicate(duplicate, job):
+    """相同内容的文件已经（或正在）转换时，把图像存储中的渲染结果复制到目标位置
+
+    返回:
+    - (是否成功, 错误信息, 失败原因)
+    """
+    if duplicate.pending is not None:
+        metrics.CONVERSIONS_DEDUPLICATED.inc(kind="content")
+        logger.info(f"相同内容的DWG文件正在转换，等待并共享结果: {job['file_label']}")
+        # shield防止当前文件被取消时影响正在进行的那次转换
+        if not await asyncio.shield(duplicate.pending):
+            return False, "相同内容的DWG文件转换失败", "duplicate_failed"
+    else:
+        metrics.CONVERSIONS_DEDUPLICATED.inc(kind="cached")
+        logger.info(f"图像存储中已有相同内容的渲染结果: {job['file_label']}")
+    try:
+        await publisher.publish(duplicate.rendered, job["jpg_path"])
+    except (OSError, PublishError) as e:
+        return False, str(e), "write_failed"
+    return True, "", ""
+
+
+async def convert_with_pipeline(dwg_path, jpg_path, job_id=None, file_label=None, attachment_id=None, **options):
+    """通过转换流水线把DWG文件转换为JPG，返回值与run_conversion相同
+
+    参数:
+    - job_id: 可选的任务ID，提供时发布queued、各阶段和file_done事件
+    - file_label: 进度事件中标识文件的名称，默认为DWG文件名
+    - attachment_id: 数据库转换的附件ID，随进度事件发布，用于区分文件名相同的文件
+    - options: 传给渲染函数的参数（size、bg_color、line_color、dpi、image_format）
+
+    返回:
+    - 字典，包含success、error、reason、timings（各阶段耗时）和total_seconds（含排队的总耗时）
+    """
+    progress.bind_loop(asyncio.get_running_loop())
+    file_label = file_label or Path(str(dwg_path)).name
+    progress.publish(job_id, "queued", file=file_label, attachment_id=attachment_id)
+    submitted = time.perf_counter()
+    workspace = await _run_io(lambda: tempfile.mkdtemp(prefix=_WORKSPACE_PREFIX, dir=PIPELINE_WORK_DIR))
+    _workspaces.add(workspace)
+    job = {
+        "dwg_path": str(dwg_path),
+        "jpg_path": str(jpg_path),
+        "workspace": workspace,
+        "job_id": job_id,
+        "file_label": file_label,
+        "attachment_id": attachment_id,
+        "options": options,
+        "timings": {},
+    }
+    success, error, reason = False, "", ""
+    try:
+        await conversion_pipeline.submit(job)
+        success = True
+    except DuplicateSource as e:
+        success, error, reason = await _publish_duplicate(e, job)
+    except StageFailed as e:
+        error, reason = str(e), e.reason
+    except Exception as e:
+        error, reason = str(e), "exception"
+    finally:
+        # 通知等待相同内容的其他文件
+        pending = _inflight_contents.pop(job.get("content_key"), None)
+        if pending is not None and not pending.done():
+            pending.set_result(success)
+        await _run_io(shutil.rmtree, workspace, True)
+        _workspaces.discard(workspace)
+
+    total_seconds = time.perf_counter() - submitted
+    metrics.CONVERSION_DURATION.observe(total_seconds)
+    metrics.record_conversion(success, reason)
+    if not success:
+        logger.error(f"流水线转换失败: {file_label}: {error}")
+    progress.publish(job_id, "file_done", file=file_label, attachment_id=attachment_id, success=success,
+                     error=error or None, seconds=round(total_seconds, 3))
+    return {
+        "success": success,
+        "error": error,
+        "reason": reason,
+        "timings": job["timings"],
+        "total_seconds": total_seconds
+    }
@@ -0,0 +1,229 @@
+import os
+import time
+import uuid
+import shutil
+import asyncio
+import hashlib
+import tempfile
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logger_config import logger
+from scheduler import source_key
+import metrics
+
+# 预取配置
+# 定期任务在转换前面的文件时，把候选窗口中接下来要转换的K个DWG文件从共享目录复制到本地暂存目录，
+# 流水线的fetch阶段直接使用暂存的副本，不再在关键路径上通过SMB读取
+# 预取的文件数（K），0表示不预取
+PREFETCH_AHEAD = int(os.getenv("PREFETCH_AHEAD", "8"))
+# 同时复制的文件数
+PREFETCH_CONCURRENCY = int(os.getenv("PREFETCH_CONCURRENCY", "2"))
+# 预取的总带宽上限（MB/s），0表示不限制，避免预取占满共享目录的带宽
+PREFETCH_BANDWIDTH_MBPS = float(os.getenv("PREFETCH_BANDWIDTH_MBPS", "0"))
+# 修改时间距今不足该秒数的文件视为仍在写入，暂不预取
+PREFETCH_STABLE_SECONDS = float(os.getenv("PREFETCH_STABLE_SECONDS", "5"))
+# 本地暂存目录，留空则在系统临时目录中创建
+PREFETCH_DIR = os.getenv("PREFETCH_DIR") or None
+
+_COPY_CHUNK_SIZE = 1024 * 1024
+
+
+class _Throttle:
+    """多个线程共享的带宽限制：每读取一块数据预约一段传输时间，超出带宽时等待"""
+
+    def __init__(self, bytes_per_second):
+        self.bytes_per_second = bytes_per_second
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self, nbytes):
+        if not self.bytes_per_second:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(self._next, now)
+            self._next = start + nbytes / self.bytes_per_second
+        if start > now:
+            time.sleep(start - now)
+
+
+class StagedFile:
+    """预取到本地的DWG副本，size和mtime为复制时源文件的大小和修改时间"""
+
+    def __init__(self, path, sha256, size, mtime):
+        self.path = path
+        self.sha256 = sha256
+        self.size = size
+        self.mtime = mtime
+
+
+def _file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(_COPY_CHUNK_SIZE), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class Prefetcher:
+    """把即将转换的DWG文件预先复制到本地暂存目录
+
+    - 最多同时暂存ahead个文件，由concurrency个线程复制，总带宽不超过bandwidth_mbps
+    - 修改时间太近（仍在写入）的文件跳过；复制期间源文件的大小或修改时间发生变化时丢弃副本
+    - 复制时计算源数据的SHA256，复制完成后重新计算本地副本的SHA256校验
+    """
+
+    def __init__(self, ahead=PREFETCH_AHEAD, concurrency=PREFETCH_CONCURRENCY,
+                 bandwidth_mbps=PREFETCH_BANDWIDTH_MBPS, stable_seconds=PREFETCH_STABLE_SECONDS,
+                 staging_dir=PREFETCH_DIR):
+        self.ahead = ahead
+        self.concurrency = max(concurrency, 1)
+        self.stable_seconds = stable_seconds
+        self._throttle = _Throttle(bandwidth_mbps * 1024 * 1024)
+        self._staging_root = staging_dir
+        self._staging_dir = None
+        self._executor = None
+        # 规范化的源文件路径 -> 复制任务（结果为StagedFile，跳过或失败时为None）
+        self._staged = {}
+
+    def _get_staging_dir(self):
+        if self._staging_dir is None:
+            if self._staging_root:
+                Path(self._staging_root).mkdir(parents=True, exist_ok=True)
+            self._staging_dir = tempfile.mkdtemp(prefix="dwg2jpg_prefetch_", dir=self._staging_root)
+        return self._staging_dir
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="prefetch")
+        return self._executor
+
+    def _copy(self, source):
+        """在线程中复制一个文件到暂存目录，返回StagedFile；文件仍在写入或复制期间发生变化时返回None"""
+        before = os.stat(source)
+        if time.time() - before.st_mtime < self.stable_seconds:
+            metrics.PREFETCH_RESULTS.inc(result="unstable")
+            logger.info(f"DWG文件可能仍在写入，暂不预取: {source}")
+            return None
+
+        target = os.path.join(self._get_staging_dir(), f"{uuid.uuid4().hex}_{os.path.basename(source)}")
+        digest = hashlib.sha256()
+        try:
+            with open(source, "rb") as src, open(target, "wb") as dst:
+                while True:
+                    chunk = src.read(_COPY_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    self._throttle.wait(len(chunk))
+                    digest.update(chunk)
+                    dst.write(chunk)
+                    metrics.PREFETCH_BYTES.inc(len(chunk))
+
+            after = os.stat(source)
+            if (after.st_size, after.st_mtime) != (before.st_size, before.st_mtime):
+                metrics.PREFETCH_RESULTS.inc(result="changed")
+                logger.warning(f"预取期间DWG文件发生变化，丢弃副本: {source}")
+                os.remove(target)
+                return None
+            sha256 = digest.hexdigest()
+            if _file_sha256(target) != sha256:
+                metrics.PREFETCH_RESULTS.inc(result="checksum_mismatch")
+                logger.error(f"预取的副本校验失败，丢弃副本: {source}")
+                os.remove(target)
+                return None
+        except Exception:
+            if os.path.exists(target):
+                os.remove(target)
+            raise
+        return StagedFile(target, sha256, before.st_size, before.st_mtime)
+
+    async def _prefetch(self, source):
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._get_executor(), self._copy, source)
+        except Exception as e:
+            metrics.PREFETCH_RESULTS.inc(result="error")
+            logger.error(f"预取DWG文件失败: {source}: {str(e)}")
+            return None
+
+    def prefetch(self, paths):
+        """按转换顺序提示接下来要转换的文件，尚未暂存的文件开始预取（最多同时暂存ahead个）"""
+        if self.ahead <= 0:
+            return
+        for path in paths:
+            if len(self._staged) >= self.ahead:
+                break
+            if not path:
+                continue
+            key = source_key(path)
+            if key not in self._staged:
+                self._staged[key] = asyncio.ensure_future(self._prefetch(str(path)))
+        metrics.PREFETCH_STAGED.set(len(self._staged))
+
+    async def take(self, path):
+        """取出已预取的副本；正在预取时等待其完成
+
+        返回:
+        - StagedFile，调用方负责移动或删除副本；没有预取、预取失败或源文件在预取之后发生变化时返回None
+        """
+        task = self._staged.pop(source_key(path), None)
+        metrics.PREFETCH_STAGED.set(len(self._staged))
+        if task is None:
+            metrics.PREFETCH_RESULTS.inc(result="miss")
+            return None
+        staged = await task
+        if staged is None:
+            return None
+        loop = asyncio.get_running_loop()
+        try:
+            current = await loop.run_in_executor(self._get_executor(), os.stat, str(path))
+            unchanged = (current.st_size, current.st_mtime) == (staged.size, staged.mtime)
+        except OSError:
+            unchanged = False
+        if not unchanged:
+            metrics.PREFETCH_RESULTS.inc(result="changed")
+            await loop.run_in_executor(self._get_executor(), self._remove, staged.path)
+            return None
+        metrics.PREFETCH_RESULTS.inc(result="hit")
+        return staged
+
+    def discard(self, paths):
+        """不再需要的预取（例如认领已释放、文件不存在），删除副本并腾出预取名额"""
+        for path in paths:
+            task = self._staged.pop(source_key(path), None)
+            if task is not None:
+                task.add_done_callback(self._remove_result)
+        metrics.PREFETCH_STAGED.set(len(self._staged))
+
+    def _remove_result(self, task):
+        if task.cancelled() or task.result() is None:
+            return
+        self._get_executor().submit(self._remove, task.result().path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    async def stop(self):
+        """取消尚未完成的预取并删除暂存目录"""
+        tasks = list(self._staged.values())
+        self._staged.clear()
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if self._executor is not None:
+            # 不等待正在复制的线程，暂存目录删除后它们写入的内容随之丢弃
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+        if self._staging_dir is not None:
+            shutil.rmtree(self._staging_dir, ignore_errors=True)
+            self._staging_dir = None
+        metrics.PREFETCH_STAGED.set(0)
+
+
+# 全局预取器
+prefetcher = Prefetcher()
@@ -0,0 +1,198 @@
+import os
+import re
+import time
+import asyncio
+import uuid
+import collections
+from logger_config import logger
+
+# 转换任务的阶段：queued → oda → parsing → rendering → encoding → file_done → done/failed
+TERMINAL_STAGES = {"done", "failed"}
+
+# 已结束任务的事件保留时间（秒），便于客户端断线重连后补齐事件
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", "3600"))
+# 每个任务保留的最近事件数，超过时丢弃最早的事件（文件数和成功、失败数另外汇总，不受影响）
+JOB_MAX_EVENTS = int(os.getenv("JOB_MAX_EVENTS", "1000"))
+
+_JOB_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+_jobs = {}
+_loop = None
+
+
+class Job:
+    """一个转换任务（单文件或批量）的事件记录
+
+    只保留最近JOB_MAX_EVENTS个事件（(序号, 事件)，序号即SSE的事件ID，丢弃早期事件后不变），
+    任务结束时保存一份汇总（snapshot），早期事件被丢弃后仍能得到完整的结果统计
+    """
+
+    def __init__(self, job_id, kind):
+        self.job_id = job_id
+        self.kind = kind
+        self.created_at = time.time()
+        self.finished_at = None
+        self.events = collections.deque(maxlen=JOB_MAX_EVENTS)
+        self.next_seq = 0
+        # 已结束的文件，按附件ID区分（没有附件ID时按文件名），用于丢弃晚到的阶段事件
+        self.done_files = set()
+        self.total_files = None
+        self.succeeded_files = 0
+        self.failed_files = 0
+        self.snapshot = None
+        self._last_activity = self.created_at
+        self._waiters = []
+
+    @property
+    def finished(self):
+        return self.finished_at is not None
+
+    @property
+    def last_activity(self):
+        return self._last_activity
+
+    @property
+    def first_seq(self):
+        """保留的最早事件的序号"""
+        return self.next_seq - len(self.events)
+
+    def summary(self):
+        """任务的汇总状态；任务结束后返回结束时保存的汇总"""
+        if self.snapshot is not None:
+            return self.snapshot
+        return {
+            "job_id": self.job_id,
+            "kind": self.kind,
+            "finished": self.finished,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "total_files": self.total_files,
+            "succeeded_files": self.succeeded_files,
+            "failed_files": self.failed_files,
+            "last_event": self.events[-1][1] if self.events else None,
+        }
+
+    def append(self, event):
+        self.events.append((self.next_seq, event))
+        self.next_seq += 1
+        self._last_activity = event["time"]
+        if event["stage"] in TERMINAL_STAGES:
+            self.finished_at = time.time()
+            self.snapshot = self.summary()
+        # 唤醒所有等待新事件的订阅者
+        for waiter in self._waiters:
+            waiter.set()
+        self._waiters.clear()
+
+    async def wait_for_event(self, timeout):
+        waiter = asyncio.Event()
+        self._waiters.append(waiter)
+        try:
+            await asyncio.wait_for(waiter.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+
+
+def is_valid_job_id(job_id):
+    """检查客户端提供的任务ID是否合法"""
+    return bool(job_id) and bool(_JOB_ID_PATTERN.match(job_id))
+
+
+def bind_loop(loop):
+    """绑定事件循环，供其他线程通过publish_threadsafe发布事件"""
+    global _loop
+    _loop = loop
+
+
+def _prune_jobs():
+    """清理已结束或长时间没有新事件、且超过保留时间的任务"""
+    now = time.time()
+    expired = [
+        job_id for job_id, job in _jobs.items()
+        if now - (job.finished_at or job.last_activity) > JOB_RETENTION_SECONDS
+    ]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def create_job(kind, job_id=None):
+    """创建任务，job_id可由客户端提供，以便在发起请求前先订阅事件
+
+    返回:
+    - 任务ID
+    """
+    _prune_jobs()
+    job_id = job_id or uuid.uuid4().hex
+    job = _jobs.get(job_id)
+    if job is None:
+        _jobs[job_id] = Job(job_id, kind)
+    else:
+        # 客户端先订阅了事件，此时补充任务类型
+        job.kind = kind
+    return job_id
+
+
+def get_job(job_id):
+    """获取任务，不存在（或已被清理）时返回None"""
+    return _jobs.get(job_id)
+
+
+def _file_key(data):
+    attachment_id = data.get("attachment_id")
+    return ("attachment", attachment_id) if attachment_id is not None else ("file", data.get("file"))
+
+
+def publish(job_id, stage, **data):
+    """发布任务事件，必须在事件循环线程中调用；任务不存在（已被清理）时丢弃"""
+    if not job_id:
+        return
+    job = get_job(job_id)
+    # 工作进程的阶段事件经由队列和线程转发，可能晚于file_done或终止事件到达，此时直接丢弃
+    if job is None or job.finished or (stage != "file_done" and _file_key(data) in job.done_files):
+        return
+    if stage == "started":
+        job.total_files = data.get("total_files")
+    elif stage == "file_done":
+        job.done_files.add(_file_key(data))
+        if data.get("success"):
+            job.succeeded_files += 1
+        else:
+            job.failed_files += 1
+    event = {"job_id": job_id, "stage": stage, "time": time.time()}
+    event.update({key: value for key, value in data.items() if value is not None})
+    job.append(event)
+
+
+def publish_threadsafe(job_id, stage, **data):
+    """从其他线程发布任务事件"""
+    if _loop is None or _loop.is_closed():
+        logger.warning(f"事件循环未绑定，丢弃任务事件: {job_id} {stage}")
+        return
+    _loop.call_soon_threadsafe(lambda: publish(job_id, stage, **data))
+
+
+async def iter_events(job_id, last_event_id=-1, keepalive_seconds=15):
+    """按顺序产出任务事件，任务结束或被清理后停止；任务不存在时不产出任何事件
+
+    断线续传时已经被丢弃的早期事件无法补齐，从保留的最早事件继续
+
+    产出:
+    - (事件序号, 事件字典)；长时间没有新事件时产出(None, None)用于发送心跳
+    """
+    job = get_job(job_id)
+    if job is None:
+        return
+    seq = last_event_id + 1
+    while True:
+        while seq < job.next_seq:
+            seq = max(seq, job.first_seq)
+            yield job.events[seq - job.first_seq]
+            seq += 1
+        if job.finished or _jobs.get(job_id) is not job:
+            return
+        if not await job.wait_for_event(keepalive_seconds):
+            yield None, None
@@ -0,0 +1,123 @@
+import os
+import time
+import uuid
+import errno
+import shutil
+import asyncio
+import threading
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+from logger_config import logger
+import metrics
+import tracing
+
+# 结果写回配置
+# 渲染结果先写到本地暂存目录，再由专用的写入线程池发布到目标位置（通常是共享目录）：
+# 先写入同目录下的临时文件名，写完后原子重命名，读者不会看到不完整的文件
+# 同时写入的文件数
+PUBLISH_CONCURRENCY = int(os.getenv("PUBLISH_CONCURRENCY", "4"))
+# 写入失败（例如共享目录暂时不可用）时的重试次数
+PUBLISH_RETRIES = int(os.getenv("PUBLISH_RETRIES", "3"))
+# 第一次重试前的等待时间（秒），之后每次翻倍
+PUBLISH_RETRY_BACKOFF = float(os.getenv("PUBLISH_RETRY_BACKOFF", "0.5"))
+
+_COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class PublishError(Exception):
+    """重试后仍无法写入目标位置"""
+
+
+class Publisher:
+    """把本地生成的文件发布到目标位置的写入线程池"""
+
+    def __init__(self, concurrency=PUBLISH_CONCURRENCY, retries=PUBLISH_RETRIES,
+                 retry_backoff=PUBLISH_RETRY_BACKOFF):
+        self.concurrency = max(concurrency, 1)
+        self.retries = max(retries, 0)
+        self.retry_backoff = retry_backoff
+        self._executor = None
+        self._lock = threading.Lock()
+        # 最近写入吞吐量的指数加权移动平均（字节/秒）
+        self._throughput = None
+
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="publisher")
+        return self._executor
+
+    @staticmethod
+    def _write_once(source, target, move):
+        """写入一次：move为True时先尝试直接重命名（同一文件系统），否则复制到临时文件后原子重命名"""
+        target.parent.mkdir(parents=True, exist_ok=True)
+        if move:
+            try:
+                os.replace(source, target)
+                return
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+        temp_target = target.with_name(f".{target.name}.{uuid.uuid4().hex}.tmp")
+        try:
+            with open(source, "rb") as src, open(temp_target, "wb") as dst:
+                shutil.copyfileobj(src, dst, _COPY_BUFFER_SIZE)
+            os.replace(temp_target, target)
+        finally:
+            if temp_target.exists():
+                temp_target.unlink()
+        if move:
+            os.remove(source)
+
+    def _publish(self, source, target, move):
+        source, target = Path(source), Path(target)
+        size = source.stat().st_size
+        delay = self.retry_backoff
+        for attempt in range(self.retries + 1):
+            started = time.perf_counter()
+            try:
+                self._write_once(source, target, move)
+            except OSError as e:
+                if attempt >= self.retries:
+                    metrics.PUBLISH_RESULTS.inc(result="failed")
+                    raise PublishError(f"写入文件失败: {target}: {str(e)}") from e
+                metrics.PUBLISH_RESULTS.inc(result="retry")
+                logger.warning(f"写入文件失败（第{attempt + 1}次），{delay}秒后重试: {target}: {str(e)}")
+                time.sleep(delay)
+                delay *= 2
+                continue
+            self._record(size, time.perf_counter() - started)
+            metrics.PUBLISH_RESULTS.inc(result="success")
+            return size
+
+    def _record(self, size, seconds):
+        metrics.PUBLISH_BYTES.inc(size)
+        metrics.PUBLISH_SECONDS.inc(seconds)
+        if seconds <= 0:
+            return
+        with self._lock:
+            rate = size / seconds
+            self._throughput = rate if self._throughput is None else self._throughput + 0.2 * (rate - self._throughput)
+            metrics.PUBLISH_THROUGHPUT.set(round(self._throughput))
+
+    async def publish(self, source, target, move=False):
+        """在写入线程池中把source发布到target
+
+        参数:
+        - move: 为True时发布后不再保留source（同一文件系统内直接原子重命名）
+
+        返回:
+        - 写入的字节数；重试后仍失败时抛出PublishError
+        """
+        return await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), tracing.run_in_context(self._publish, source, target, move)
+        )
+
+    def shutdown(self, wait=True):
+        """关闭写入线程池，wait为True时等待正在写入的文件完成"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+
+
+# 全局写入线程池
+publisher = Publisher()
@@ -0,0 +1,604 @@
+import os
+import sqlite3
+import datetime
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from contextlib import contextmanager
+import metrics
+from logger_config import logger
+from database import (db, build_conversion_status, build_conversion_record, build_jpg_attachment,
+                      build_conversion_failure, build_drawing_profile,
+                      ATTACHMENT_FAILURE_UPDATE, CONVERSION_FAILURE_UPDATE,
+                      claim_dwg_files, renew_claims, release_claims, count_pending_dwg_files, get_pending_watermark,
+                      get_recent_drawing_profiles, resolve_dwg_path,
+                      _pyodbc, _is_connection_error, JPG_ATTACHMENT_INSERT,
+                      WORKER_ID, CLAIM_LEASE_SECONDS, CLAIM_BATCH_SIZE, DB_FETCH_SIZE)
+from scheduler import claim_priority_sql
+
+# 数据库后端：sqlserver（默认，生产环境）或sqlite（本地开发和测试，不需要SQL Server）
+DB_BACKEND = os.getenv("DB_BACKEND", "sqlserver").lower()
+# SQLite数据库文件路径（DB_BACKEND=sqlite时使用）
+SQLITE_PATH = os.getenv("SQLITE_PATH", "dwg2jpg.sqlite3")
+# SQL Server批量写入时是否使用pyodbc的fast_executemany（以参数数组方式一次发送整批参数）
+DB_FAST_EXECUTEMANY = os.getenv("DB_FAST_EXECUTEMANY", "true").lower() == "true"
+
+# 批量写入失败时的错误分类
+ERROR_DEADLOCK = "deadlock"          # 死锁或锁冲突，可以立即重试整个事务
+ERROR_UNAVAILABLE = "unavailable"    # 数据库暂时不可用，稍后重试
+
+
+class ConversionRepository(ABC):
+    """待转换DWG和转换结果的存储接口
+
+    写入操作同时提供两种形式：*_statement方法只生成(query, params)，供BatchWriter批量写入；
+    record_history、insert_attachment、update_status立即写入。
+    """
+
+    @abstractmethod
+    def poll_pending(self, limit=None):
+        """查询待转换的DWG文件（只读，不认领）"""
+
+    @abstractmethod
+    def count_pending(self):
+        """统计待转换的DWG文件数"""
+
+    @abstractmethod
+    def pending_watermark(self):
+        """返回待转换DWG文件的(数量, 最大附件ID)，用于轻量地检测是否有变化；查询失败时返回None"""
+
+    @abstractmethod
+    def claim(self, limit=CLAIM_BATCH_SIZE, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS, after_id=None):
+        """原子地认领待转换的DWG文件，认领顺序（按优先级、订单轮转）和返回的记录格式与claim_dwg_files一致"""
+
+    @abstractmethod
+    def renew_claims(self, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS):
+        """为仍在处理的认领续约，返回续约的行数"""
+
+    @abstractmethod
+    def release_claims(self, owner=WORKER_ID, attachment_ids=None):
+        """释放尚未完成的认领，返回释放的行数"""
+
+    @abstractmethod
+    def recent_profiles(self, limit):
+        """查询最近的图纸复杂度记录（按时间倒序），用于恢复成本模型的样本"""
+
+    @abstractmethod
+    def count_history(self, status=None):
+        """统计转换历史的行数，返回(总数, 是否为估算值)"""
+
+    @abstractmethod
+    def history_page(self, status=None, after=None, limit=None, offset=0):
+        """按(conversion_time, id)倒序查询转换历史，出错时记录日志并返回[]
+
+        参数:
+        - after: 上一页最后一行的(conversion_time, id)，conversion_time为datetime；提供时只返回其后的行（键集分页）
+        - limit: 最多返回的行数，None表示全部
+        - offset: 跳过的行数（按页码分页）
+        """
+
+    @abstractmethod
+    def iter_history(self, status=None, after=None):
+        """按与history_page相同的顺序逐行产出全部匹配的转换历史（流式导出），出错时抛出异常"""
+
+    @abstractmethod
+    def execute(self, statement):
+        """立即执行一条(query, params)语句，出错时记录日志并返回0"""
+
+    @abstractmethod
+    def execute_batch(self, statements):
+        """在一个事务中执行多条语句，同一条SQL的参数合并为一次executemany；出错时抛出异常"""
+
+    def classify_error(self, error):
+        """对execute_batch抛出的异常分类：ERROR_DEADLOCK、ERROR_UNAVAILABLE，或None表示数据错误"""
+        return None
+
+    @staticmethod
+    def _history_select(status, after, time_param="?"):
+        """生成按(conversion_time, id)倒序查询转换历史的语句（不含分页子句）和参数"""
+        query = ("SELECT id, file_name, original_path, jpg_path, conversion_time, status, file_size, error_message "
+                 "FROM conversion_history WHERE 1=1")
+        params = []
+        if status:
+            query += " AND status = ?"
+            params.append(status)
+        # 从游标位置继续，不需要像OFFSET那样扫描并丢弃前面的行
+        if after:
+            query += f" AND (conversion_time < {time_param} OR (conversion_time = {time_param} AND id < ?))"
+            params.extend([after[0], after[0], after[1]])
+        # 以id作为相同时间的次要排序键，保证翻页稳定
+        return query + " ORDER BY conversion_time DESC, id DESC", params
+
+    def status_statement(self, order_id, file_path, status, attachment_id=None):
+        return build_conversion_status(order_id, file_path, status, attachment_id)
+
+    def failure_statement(self, order_id, file_path, outcome, attempts, crashes, delay_seconds, error_message,
+                          attachment_id=None):
+        return build_conversion_failure(order_id, file_path, outcome, attempts, crashes, delay_seconds,
+                                        error_message, attachment_id)
+
+    def history_statement(self, file_name, original_path, jpg_path, status, file_size=0, error_message=""):
+        return build_conversion_record(file_name, original_path, jpg_path, status, file_size, error_message)
+
+    def attachment_statement(self, order_id, jpg_path, original_dwg_path, source_record=None):
+        return build_jpg_attachment(order_id, jpg_path, original_dwg_path, source_record)
+
+    def profile_statement(self, file_name, original_path, source_sha256, profile, **measurements):
+        return build_drawing_profile(file_name, original_path, source_sha256, profile, **measurements)
+
+    def record_history(self, file_name, original_path, jpg_path, status, file_size=0, error_message=""):
+        """记录转换信息到conversion_history表"""
+        statement = self.history_statement(file_name, original_path, jpg_path, status, file_size, error_message)
+        if statement is not None:
+            self.execute(statement)
+
+    def insert_attachment(self, order_id, jpg_path, original_dwg_path, source_record=None):
+        """将生成的JPG文件插入到C_Attachment表中，JPG文件无效时返回False"""
+        statement = self.attachment_statement(order_id, jpg_path, original_dwg_path, source_record)
+        if statement is None:
+            return False
+        return self.execute(statement) > 0
+
+    def update_status(self, order_id, file_path, status, attachment_id=None):
+        """更新C_Attachment表中的转换状态并释放认领"""
+        statement = self.status_statement(order_id, file_path, status, attachment_id)
+        if statement is not None:
+            self.execute(statement)
+
+
+class SQLServerRepository(ConversionRepository):
+    """基于SQL Server（pyodbc连接池）的实现"""
+
+    def poll_pending(self, limit=None):
+        query = """
+            SELECT TOP (?)
+               c.Id AS AttachmentId, o.id, c.FilePath,
+               c.AttachmentType, c.GroupGuid, c.Tag, c.Version, c.CreatedBy,
+               o.OrderStatus, c.FileSize, c.CreatedDateTime, c.RetryCount, c.CrashCount
+            FROM
+               c_order o
+            INNER JOIN C_Attachment c on c.RefId = o.id
+            WHERE
+               OrderStatus BETWEEN 60 and 160 and c.istojpg is null AND c.FilePath LIKE '%.dwg'
+            ORDER BY c.Id
+        """
+        return db.execute_query(query, (limit if limit is not None else 2147483647,))
+
+    def count_pending(self):
+        return count_pending_dwg_files()
+
+    def pending_watermark(self):
+        return get_pending_watermark()
+
+    def claim(self, limit=CLAIM_BATCH_SIZE, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS, after_id=None):
+        return claim_dwg_files(limit, owner, lease_seconds, after_id)
+
+    def renew_claims(self, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS):
+        return renew_claims(owner, lease_seconds)
+
+    def release_claims(self, owner=WORKER_ID, attachment_ids=None):
+        return release_claims(owner, attachment_ids)
+
+    def recent_profiles(self, limit):
+        return get_recent_drawing_profiles(limit)
+
+    def count_history(self, status=None):
+        if not status:
+            # 从sys.dm_db_partition_stats读取表的行数（估算值，不扫描表，需要VIEW DATABASE STATE权限）
+            result = db.execute_query("""
+                SELECT SUM(row_count) AS total FROM sys.dm_db_partition_stats
+                WHERE object_id = OBJECT_ID('conversion_history') AND index_id IN (0, 1)
+            """)
+            if result and result[0]['total'] is not None:
+                return result[0]['total'], True
+        # 按状态过滤（或没有权限）时执行COUNT(*)，由IX_conversion_history_status_time覆盖
+        query = "SELECT COUNT(*) AS total FROM conversion_history WHERE 1=1"
+        if status:
+            query += " AND status = ?"
+        result = db.execute_query(query, (status,) if status else None)
+        return (result[0]['total'] if result else 0), False
+
+    def _history_query(self, status, after, limit=None, offset=0):
+        # conversion_time是DATETIME（精度约3毫秒），游标中的时间转换为DATETIME后再比较，
+        # 否则按DATETIME2比较时与列中的值不相等，会漏掉同一时间的其他行
+        query, params = self._history_select(status, after, "CAST(? AS DATETIME)")
+        if limit is not None or offset:
+            query += " OFFSET ? ROWS"
+            params.append(offset)
+            if limit is not None:
+                query += " FETCH NEXT ? ROWS ONLY"
+                params.append(limit)
+        return query, tuple(params)
+
+    def history_page(self, status=None, after=None, limit=None, offset=0):
+        return db.execute_query(*self._history_query(status, after, limit, offset))
+
+    def iter_history(self, status=None, after=None):
+        yield from db.iter_query(*self._history_query(status, after))
+
+    def execute(self, statement):
+        return db.execute_query(*statement)
+
+    def execute_batch(self, statements):
+        groups = OrderedDict()
+        for query, params in statements:
+            groups.setdefault(query, []).append(params)
+        with db.transaction() as conn:
+            cursor = conn.cursor()
+            try:
+                cursor.fast_executemany = DB_FAST_EXECUTEMANY
+                for query, rows in groups.items():
+                    cursor.executemany(query, rows)
+            finally:
+                cursor.close()
+
+    def classify_error(self, error):
+        if isinstance(error, _pyodbc().Error):
+            state = error.args[0] if error.args else ""
+            # 死锁（错误1205）或序列化失败
+            if state == "40001" or "1205" in str(error):
+                return ERROR_DEADLOCK
+            # 连接断开，或语句执行超时（HYT00/HYT01，数据库繁忙）
+            if _is_connection_error(error) or state in ("HYT00", "HYT01"):
+                return ERROR_UNAVAILABLE
+            return None
+        # 连接池耗尽或无法建立连接
+        return ERROR_UNAVAILABLE
+
+
+# SQLite中与SQL Server相同的表结构（只包含本服务用到的列）
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS c_order (
+        id INTEGER PRIMARY KEY,
+        OrderStatus INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS C_Attachment (
+        Id INTEGER PRIMARY KEY AUTOINCREMENT,
+        RefId INTEGER,
+        AttachmentType INTEGER,
+        FileName TEXT,
+        FilePath TEXT,
+        FileSize INTEGER,
+        CreatedBy TEXT,
+        CreatedDateTime TEXT,
+        GroupGuid TEXT,
+        Tag TEXT,
+        Version INTEGER,
+        isdeleted INTEGER,
+        istojpg INTEGER,
+        ClaimOwner TEXT,
+        ClaimExpiresAt TEXT,
+        RetryCount INTEGER,
+        NextAttemptAt TEXT,
+        LastError TEXT,
+        CrashCount INTEGER
+    );
+    CREATE TABLE IF NOT EXISTS conversion_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT,
+        original_path TEXT,
+        jpg_path TEXT,
+        conversion_time TEXT DEFAULT CURRENT_TIMESTAMP,
+        status TEXT,
+        file_size INTEGER,
+        error_message TEXT
+    );
+    CREATE TABLE IF NOT EXISTS drawing_profile (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_name TEXT,
+        original_path TEXT,
+        source_sha256 TEXT,
+        file_size INTEGER,
+        entity_count INTEGER,
+        expanded_entity_count INTEGER,
+        block_count INTEGER,
+        block_depth INTEGER,
+        hatch_count INTEGER,
+        text_count INTEGER,
+        vertex_count INTEGER,
+        extent_min_x REAL,
+        extent_min_y REAL,
+        extent_max_x REAL,
+        extent_max_y REAL,
+        entity_counts TEXT,
+        render_seconds REAL,
+        peak_memory_bytes INTEGER,
+        predicted_seconds REAL,
+        predicted_memory_bytes INTEGER,
+        pool TEXT,
+        profile_time TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE INDEX IF NOT EXISTS IX_C_Attachment_PendingDwg ON C_Attachment (istojpg, RefId, Id) WHERE istojpg IS NULL;
+    CREATE INDEX IF NOT EXISTS IX_C_Attachment_ClaimOwner ON C_Attachment (ClaimOwner) WHERE ClaimOwner IS NOT NULL;
+    CREATE INDEX IF NOT EXISTS IX_conversion_history_status_time ON conversion_history (status, conversion_time DESC, id DESC);
+"""
+
+# SQLite没有OUTER APPLY和N''字面量，参数顺序与JPG_ATTACHMENT_INSERT相同
+SQLITE_JPG_ATTACHMENT_INSERT = """
+    INSERT INTO C_Attachment (
+        RefId, AttachmentType, FileName, FilePath, CreatedBy, CreatedDateTime, GroupGuid, Tag, Version, istojpg
+    )
+    SELECT
+        ?,
+        CASE WHEN src.Id IS NULL THEN 1 ELSE src.AttachmentType END,
+        ?,
+        CASE WHEN src.Id IS NULL THEN ? ELSE ? END,
+        CASE WHEN src.Id IS NULL THEN 'DWG2JPG API' ELSE src.CreatedBy END,
+        ?,
+        src.GroupGuid,
+        CASE WHEN src.Id IS NULL THEN 'DWG转JPG' ELSE src.Tag END,
+        CASE WHEN src.Id IS NULL THEN 1 ELSE src.Version END,
+        1
+    FROM (SELECT 1 AS one) AS d
+    LEFT JOIN (
+        SELECT Id, AttachmentType, CreatedBy, GroupGuid, Tag, Version
+        FROM C_Attachment
+        WHERE RefId = ? AND FilePath = ?
+        ORDER BY Id DESC
+        LIMIT 1
+    ) AS src ON 1 = 1
+"""
+
+# SQLite没有DATEADD和SYSUTCDATETIME，延迟为NULL时datetime()同样返回NULL
+_SQLITE_FAILURE_SET = """
+    SET istojpg = ?, RetryCount = ?, CrashCount = ?, NextAttemptAt = datetime('now', '+' || ? || ' seconds'),
+        LastError = ?, ClaimOwner = NULL, ClaimExpiresAt = NULL
+"""
+
+_SQLITE_QUERIES = {
+    JPG_ATTACHMENT_INSERT: SQLITE_JPG_ATTACHMENT_INSERT,
+    ATTACHMENT_FAILURE_UPDATE: "UPDATE C_Attachment" + _SQLITE_FAILURE_SET + "WHERE Id = ?",
+    CONVERSION_FAILURE_UPDATE: "UPDATE C_Attachment" + _SQLITE_FAILURE_SET + "WHERE RefId = ? AND FilePath = ?",
+}
+
+# 在已有的SQLite数据库上补充后来增加的列（与migrations目录中的脚本对应）
+_SQLITE_ADDED_COLUMNS = [
+    ("C_Attachment", "RetryCount", "INTEGER"),
+    ("C_Attachment", "NextAttemptAt", "TEXT"),
+    ("C_Attachment", "LastError", "TEXT"),
+    ("C_Attachment", "CrashCount", "INTEGER"),
+]
+
+_SQLITE_PENDING = """
+    FROM C_Attachment c
+    INNER JOIN c_order o ON c.RefId = o.id
+    WHERE o.OrderStatus BETWEEN 60 AND 160 AND c.istojpg IS NULL AND c.FilePath LIKE '%.dwg'
+"""
+
+# 统一以ISO格式字符串保存时间，便于在SQLite中直接比较
+sqlite3.register_adapter(datetime.datetime, lambda value: value.isoformat(" "))
+
+
+def _utc_now(offset_seconds=0):
+    return (datetime.datetime.utcnow() + datetime.timedelta(seconds=offset_seconds)).isoformat(" ")
+
+
+class SQLiteRepository(ConversionRepository):
+    """基于SQLite的实现，表结构与SQL Server相同，首次使用时自动建表
+
+    每次操作使用独立的连接（SQLite连接的建立开销很小），认领使用BEGIN IMMEDIATE串行化。
+    """
+
+    def __init__(self, path=SQLITE_PATH):
+        self.path = path
+        self._schema_ready = False
+        self._schema_lock = threading.Lock()
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        try:
+            if not self._schema_ready:
+                with self._schema_lock:
+                    if not self._schema_ready:
+                        conn.execute("PRAGMA journal_mode=WAL")
+                        conn.executescript(SQLITE_SCHEMA)
+                        self._add_missing_columns(conn)
+                        self._schema_ready = True
+            yield conn
+        finally:
+            conn.close()
+
+    @staticmethod
+    def _add_missing_columns(conn):
+        for table, column, column_type in _SQLITE_ADDED_COLUMNS:
+            columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+            if column not in columns:
+                conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {column_type}")
+
+    @contextmanager
+    def _transaction(self):
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+    @staticmethod
+    def _translate(query):
+        return _SQLITE_QUERIES.get(query, query)
+
+    def poll_pending(self, limit=None):
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT c.Id AS AttachmentId, o.id, c.FilePath, c.AttachmentType, c.GroupGuid, c.Tag, "
+                    "c.Version, c.CreatedBy, o.OrderStatus, c.FileSize, c.CreatedDateTime, c.RetryCount, c.CrashCount" +
+                    _SQLITE_PENDING +
+                    "ORDER BY c.Id LIMIT ?",
+                    (limit if limit is not None else -1,)
+                ).fetchall()
+            return [dict(row) for row in rows]
+        except sqlite3.Error as e:
+            logger.error(f"查询待转换的DWG文件失败: {str(e)}")
+            return []
+
+    def count_pending(self):
+        try:
+            with self._connect() as conn:
+                total = conn.execute("SELECT COUNT(*)" + _SQLITE_PENDING).fetchone()[0]
+            metrics.DB_PENDING_FILES.set(total)
+            return total
+        except sqlite3.Error as e:
+            logger.error(f"统计待转换的DWG文件数失败: {str(e)}")
+            return 0
+
+    def pending_watermark(self):
+        try:
+            with self._connect() as conn:
+                row = conn.execute("SELECT COUNT(*), MAX(c.Id)" + _SQLITE_PENDING).fetchone()
+            metrics.DB_PENDING_FILES.set(row[0])
+            return row[0], row[1]
+        except sqlite3.Error as e:
+            logger.error(f"查询待转换的DWG文件变化失败: {str(e)}")
+            return None
+
+    def claim(self, limit=CLAIM_BATCH_SIZE, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS, after_id=None):
+        # 与SQL Server相同：先按优先级，同一优先级内按订单轮转
+        priority, priority_params = claim_priority_sql()
+        try:
+            with self._transaction() as conn:
+                rows = [dict(row) for row in conn.execute(
+                    "SELECT AttachmentId, id, FilePath, AttachmentType, GroupGuid, Tag, Version, CreatedBy, "
+                    "OrderStatus, FileSize, CreatedDateTime, RetryCount, CrashCount FROM ("
+                    "SELECT c.Id AS AttachmentId, o.id, c.FilePath, c.AttachmentType, c.GroupGuid, c.Tag, "
+                    "c.Version, c.CreatedBy, o.OrderStatus, c.FileSize, c.CreatedDateTime, c.RetryCount, c.CrashCount, "
+                    f"{priority} AS Priority, ROW_NUMBER() OVER (PARTITION BY c.RefId ORDER BY c.Id) AS OrderRank" +
+                    _SQLITE_PENDING +
+                    "AND (c.ClaimExpiresAt IS NULL OR c.ClaimExpiresAt < ?) "
+                    "AND (c.NextAttemptAt IS NULL OR c.NextAttemptAt <= ?) AND c.Id > ?"
+                    ") ORDER BY Priority, OrderRank, AttachmentId LIMIT ?",
+                    tuple(priority_params) + (_utc_now(), _utc_now(), after_id if after_id is not None else -1,
+                                              limit if limit is not None else -1)
+                ).fetchall()]
+                if rows:
+                    ids = [row["AttachmentId"] for row in rows]
+                    conn.execute(
+                        f"UPDATE C_Attachment SET ClaimOwner = ?, ClaimExpiresAt = ? "
+                        f"WHERE Id IN ({', '.join('?' for _ in ids)})",
+                        [owner, _utc_now(lease_seconds)] + ids
+                    )
+            for row in rows:
+                if row.get("FilePath"):
+                    row["FullPath"] = resolve_dwg_path(row["FilePath"])
+            if rows:
+                logger.info(f"已认领 {len(rows)} 个需要转换的DWG文件，认领者: {owner}")
+            return rows
+        except sqlite3.Error as e:
+            logger.error(f"认领需要转换的DWG文件失败: {str(e)}")
+            return []
+
+    def renew_claims(self, owner=WORKER_ID, lease_seconds=CLAIM_LEASE_SECONDS):
+        return self.execute((
+            "UPDATE C_Attachment SET ClaimExpiresAt = ? WHERE ClaimOwner = ? AND istojpg IS NULL",
+            (_utc_now(lease_seconds), owner)
+        ))
+
+    def release_claims(self, owner=WORKER_ID, attachment_ids=None):
+        query = "UPDATE C_Attachment SET ClaimOwner = NULL, ClaimExpiresAt = NULL WHERE ClaimOwner = ? AND istojpg IS NULL"
+        params = (owner,)
+        if attachment_ids is not None:
+            if not attachment_ids:
+                return 0
+            query += f" AND Id IN ({', '.join('?' for _ in attachment_ids)})"
+            params += tuple(attachment_ids)
+        released = self.execute((query, params))
+        if released:
+            logger.info(f"已释放 {released} 个未完成的认领，认领者: {owner}")
+        return released
+
+    def recent_profiles(self, limit):
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(
+                    "SELECT file_size, entity_count, expanded_entity_count, block_count, block_depth, hatch_count, "
+                    "text_count, vertex_count, render_seconds, peak_memory_bytes FROM drawing_profile "
+                    "WHERE render_seconds IS NOT NULL ORDER BY id DESC LIMIT ?",
+                    (limit,)
+                ).fetchall()
+            return [dict(row) for row in rows]
+        except sqlite3.Error as e:
+            logger.error(f"查询图纸复杂度记录失败: {str(e)}")
+            return []
+
+    def count_history(self, status=None):
+        query = "SELECT COUNT(*) FROM conversion_history"
+        try:
+            with self._connect() as conn:
+                if status:
+                    return conn.execute(query + " WHERE status = ?", (status,)).fetchone()[0], False
+                return conn.execute(query).fetchone()[0], False
+        except sqlite3.Error as e:
+            logger.error(f"统计转换历史记录失败: {str(e)}")
+            return 0, False
+
+    def history_page(self, status=None, after=None, limit=None, offset=0):
+        query, params = self._history_select(status, after)
+        try:
+            with self._connect() as conn:
+                rows = conn.execute(query + " LIMIT ? OFFSET ?",
+                                    params + [limit if limit is not None else -1, offset]).fetchall()
+            return [dict(row) for row in rows]
+        except sqlite3.Error as e:
+            logger.error(f"查询转换历史记录失败: {str(e)}")
+            return []
+
+    def iter_history(self, status=None, after=None):
+        # 流式响应在线程池中迭代，每次取下一行的线程可能不同，而SQLite连接只能在创建它的线程中使用，
+        # 因此按键集分批查询，每批使用独立的连接
+        query, params = self._history_select(status, after)
+        while True:
+            with self._connect() as conn:
+                rows = [dict(row) for row in conn.execute(query + " LIMIT ?", params + [DB_FETCH_SIZE]).fetchall()]
+            yield from rows
+            if len(rows) < DB_FETCH_SIZE:
+                return
+            query, params = self._history_select(status, (rows[-1]["conversion_time"], rows[-1]["id"]))
+
+    def execute(self, statement):
+        query, params = statement
+        try:
+            with self._connect() as conn:
+                return conn.execute(self._translate(query), params or ()).rowcount
+        except sqlite3.Error as e:
+            logger.error(f"执行SQL查询失败: {str(e)}")
+            logger.error(f"查询: {query}")
+            logger.error(f"参数: {params}")
+            return 0
+
+    def execute_batch(self, statements):
+        groups = OrderedDict()
+        for query, params in statements:
+            groups.setdefault(self._translate(query), []).append(params)
+        with self._transaction() as conn:
+            for query, rows in groups.items():
+                conn.executemany(query, rows)
+
+    def classify_error(self, error):
+        # 其他连接持有写锁时（database is locked）稍后重试即可
+        if isinstance(error, sqlite3.OperationalError) and "locked" in str(error):
+            return ERROR_DEADLOCK
+        return None
+
+
+_repository = None
+_repository_lock = threading.Lock()
+
+
+def get_repository():
+    """获取按DB_BACKEND配置的全局存储实例（首次调用时创建，不会在导入时连接数据库）"""
+    global _repository
+    with _repository_lock:
+        if _repository is None:
+            if DB_BACKEND == "sqlite":
+                _repository = SQLiteRepository()
+                logger.info(f"使用SQLite数据库: {SQLITE_PATH}")
+            elif DB_BACKEND == "sqlserver":
+                _repository = SQLServerRepository()
+            else:
+                raise ValueError(f"不支持的DB_BACKEND: {DB_BACKEND}（可选: sqlserver、sqlite）")
+        return _repository
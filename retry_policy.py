@@ -0,0 +1,101 @@
+import os
+import random
+from logger_config import logger
+import metrics
+
+# 转换失败重试配置
+# 转换失败时按失败原因分类：暂时性错误（共享目录不可用、写入失败、ODA异常退出等）稍后重试，
+# 永久性错误（文件不存在、图纸无法渲染）直接标记失败，反复导致工作进程崩溃或超时的图纸被隔离，不再占用转换进程。
+# 需要先执行 migrations/004_c_attachment_retry.sql
+# 暂时性错误最多尝试的次数（含第一次），用尽后标记为失败
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "5"))
+# 第一次重试前的等待时间（秒），之后每次翻倍
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "60"))
+# 重试等待时间的上限（秒）
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "21600"))
+# 工作进程崩溃或超时达到该次数的图纸被隔离
+RETRY_QUARANTINE_ATTEMPTS = int(os.getenv("RETRY_QUARANTINE_ATTEMPTS", "3"))
+
+# 失败原因的分类
+FAILURE_TRANSIENT = "transient"   # 暂时性错误，稍后重试
+FAILURE_PERMANENT = "permanent"   # 永久性错误，重试也不会成功
+FAILURE_POISON = "poison"         # 图纸导致工作进程崩溃或超时
+
+# 处理结果
+OUTCOME_RETRY = "retry"               # 保持未转换，NextAttemptAt之后重新认领
+OUTCOME_FAILED = "failed"             # istojpg = -1
+OUTCOME_QUARANTINED = "quarantined"   # istojpg = -2
+
+# 按失败原因分类，未列出的原因按暂时性错误处理（重试次数有上限）
+FAILURE_KINDS = {
+    "file_not_found": FAILURE_PERMANENT,
+    "render_failed": FAILURE_PERMANENT,
+    "output_missing": FAILURE_PERMANENT,
+    "empty_output": FAILURE_PERMANENT,
+    "share_unavailable": FAILURE_TRANSIENT,
+    "write_failed": FAILURE_TRANSIENT,
+    "dxf_failed": FAILURE_TRANSIENT,
+    "duplicate_failed": FAILURE_TRANSIENT,
+    "exception": FAILURE_TRANSIENT,
+    "pool_recycled": FAILURE_TRANSIENT,
+    "queue_timeout": FAILURE_TRANSIENT,
+    "worker_crashed": FAILURE_POISON,
+    "timeout": FAILURE_POISON,
+}
+
+
+def classify_failure(reason):
+    """失败原因的分类：FAILURE_TRANSIENT、FAILURE_PERMANENT或FAILURE_POISON"""
+    return FAILURE_KINDS.get(reason, FAILURE_TRANSIENT)
+
+
+class RetryPolicy:
+    """根据失败原因和已失败次数决定如何处理一次失败的转换"""
+
+    def __init__(self, max_attempts=RETRY_MAX_ATTEMPTS, base_delay=RETRY_BASE_DELAY, max_delay=RETRY_MAX_DELAY,
+                 quarantine_attempts=RETRY_QUARANTINE_ATTEMPTS):
+        self.max_attempts = max(max_attempts, 1)
+        self.base_delay = base_delay
+        self.max_delay = max(max_delay, base_delay)
+        self.quarantine_attempts = max(quarantine_attempts, 1)
+
+    def backoff(self, attempts):
+        """第attempts次失败后的等待时间（秒）：指数退避，加上±10%的随机抖动避免大量文件同时到期"""
+        delay = min(self.base_delay * 2 ** (attempts - 1), self.max_delay)
+        return round(delay * random.uniform(0.9, 1.1))
+
+    def decide(self, reason, previous_attempts=0, previous_crashes=0):
+        """决定如何处理一次失败
+
+        参数:
+        - reason: 失败原因（与dwg2jpg_conversions_total的reason一致）
+        - previous_attempts: 本次之前已经失败的次数（C_Attachment.RetryCount）
+        - previous_crashes: 本次之前导致工作进程崩溃或超时的次数（C_Attachment.CrashCount），
+          是否隔离只看这个次数，暂时性错误不会让图纸被隔离
+
+        返回:
+        - (处理结果, 累计失败次数, 累计崩溃或超时次数, 重试前的等待时间（秒），不重试时为None)
+        """
+        attempts = (previous_attempts or 0) + 1
+        crashes = previous_crashes or 0
+        kind = classify_failure(reason)
+        if kind == FAILURE_POISON:
+            crashes += 1
+        if kind == FAILURE_PERMANENT:
+            outcome = OUTCOME_FAILED
+        elif kind == FAILURE_POISON and crashes >= self.quarantine_attempts:
+            outcome = OUTCOME_QUARANTINED
+        elif kind == FAILURE_TRANSIENT and attempts >= self.max_attempts:
+            outcome = OUTCOME_FAILED
+        else:
+            outcome = OUTCOME_RETRY
+        metrics.RETRY_DECISIONS.inc(kind=kind, outcome=outcome)
+        if outcome != OUTCOME_RETRY:
+            return outcome, attempts, crashes, None
+        delay = self.backoff(attempts)
+        logger.info(f"转换失败（{reason}，第{attempts}次），{delay}秒后重试")
+        return outcome, attempts, crashes, delay
+
+
+# 全局重试策略
+retry_policy = RetryPolicy()
@@ -0,0 +1,327 @@
+import os
+import time
+import asyncio
+import datetime
+import threading
+from collections import OrderedDict, deque
+from logger_config import logger
+import metrics
+
+# 自适应轮询配置
+# 一轮认领到文件后立即再次轮询，直到没有待转换的文件；空闲时轮询间隔从最小值开始按指数退避到最大值
+# 空闲时的最小轮询间隔（秒）
+POLL_MIN_INTERVAL = float(os.getenv("POLL_MIN_INTERVAL", "1"))
+# 空闲时的最大轮询间隔（秒），默认沿用CHECK_INTERVAL
+POLL_MAX_INTERVAL = float(os.getenv("POLL_MAX_INTERVAL", os.getenv("CHECK_INTERVAL", "60")))
+# 空闲等待期间检测待转换文件变化的间隔（秒），检测到变化时提前开始下一轮轮询；0表示不检测
+POLL_CHANGE_CHECK_INTERVAL = float(os.getenv("POLL_CHANGE_CHECK_INTERVAL", "5"))
+
+# 优先级调度配置
+# 认领到的文件先进入本地的候选窗口，按优先级从高到低派发，同一优先级内在订单之间轮转，
+# 一个订单的大量图纸不会阻塞其他订单，大图纸也不会阻塞小图纸
+# 候选窗口的最大文件数（窗口越大排序越充分，但认领后等待的文件也越多）
+PRIORITY_WINDOW = int(os.getenv("PRIORITY_WINDOW", "100"))
+# 这些订单状态（逗号分隔）的文件为高优先级
+PRIORITY_HIGH_ORDER_STATUSES = {
+    int(status) for status in os.getenv("PRIORITY_HIGH_ORDER_STATUSES", "").split(",") if status.strip()
+}
+# 超过该大小（MB）的文件降低一级优先级
+PRIORITY_LARGE_FILE_MB = float(os.getenv("PRIORITY_LARGE_FILE_MB", "20"))
+# 按以往转换耗时估算超过该时间（秒）的文件降低一级优先级
+PRIORITY_SLOW_SECONDS = float(os.getenv("PRIORITY_SLOW_SECONDS", "60"))
+# 附件创建超过该时间（小时）仍未转换的文件提高一级优先级，避免低优先级文件一直得不到处理；0表示不提升
+PRIORITY_AGE_BOOST_HOURS = float(os.getenv("PRIORITY_AGE_BOOST_HOURS", "24"))
+
+# 优先级从高到低的名称，下标即优先级
+PRIORITY_NAMES = ("high", "normal", "low")
+PRIORITY_NORMAL = 1
+
+
+class CostEstimator:
+    """根据以往的转换耗时估算文件的转换时间
+
+    用指数加权移动平均记录每MB的转换耗时，没有样本时不做估算
+    """
+
+    def __init__(self, smoothing=0.2):
+        self.smoothing = smoothing
+        self.seconds_per_mb = None
+        self._lock = threading.Lock()
+
+    def observe(self, file_size, seconds):
+        """记录一次转换的文件大小（字节）和耗时（秒）"""
+        if not file_size or file_size <= 0 or seconds < 0:
+            return
+        rate = seconds / (file_size / 1024 / 1024)
+        with self._lock:
+            if self.seconds_per_mb is None:
+                self.seconds_per_mb = rate
+            else:
+                self.seconds_per_mb += self.smoothing * (rate - self.seconds_per_mb)
+
+    def estimate(self, file_size):
+        """估算转换时间（秒），无法估算时返回None"""
+        if not file_size or self.seconds_per_mb is None:
+            return None
+        return file_size / 1024 / 1024 * self.seconds_per_mb
+
+
+def _age_hours(created):
+    """附件创建至今的小时数，创建时间未知时返回None"""
+    if created is None:
+        return None
+    if isinstance(created, str):
+        try:
+            created = datetime.datetime.fromisoformat(created)
+        except ValueError:
+            return None
+    if created.tzinfo is not None:
+        created = created.astimezone().replace(tzinfo=None)
+    return (datetime.datetime.now() - created).total_seconds() / 3600
+
+
+def priority_of(dwg_file, estimator=None):
+    """按配置的规则计算认领记录的优先级（0最高）
+
+    - OrderStatus属于PRIORITY_HIGH_ORDER_STATUSES：高优先级，否则为普通优先级
+    - FileSize超过PRIORITY_LARGE_FILE_MB，或按以往耗时估算超过PRIORITY_SLOW_SECONDS：降低一级
+    - 附件创建超过PRIORITY_AGE_BOOST_HOURS：提高一级
+    """
+    level = 0 if dwg_file.get('OrderStatus') in PRIORITY_HIGH_ORDER_STATUSES else PRIORITY_NORMAL
+
+    file_size = dwg_file.get('FileSize') or 0
+    estimated = estimator.estimate(file_size) if estimator is not None else None
+    if (PRIORITY_LARGE_FILE_MB and file_size > PRIORITY_LARGE_FILE_MB * 1024 * 1024) or \
+            (estimated is not None and estimated > PRIORITY_SLOW_SECONDS):
+        level += 1
+
+    age = _age_hours(dwg_file.get('CreatedDateTime'))
+    if PRIORITY_AGE_BOOST_HOURS and age is not None and age > PRIORITY_AGE_BOOST_HOURS:
+        level -= 1
+
+    return min(max(level, 0), len(PRIORITY_NAMES) - 1)
+
+
+def claim_priority_sql():
+    """认领时在数据库中排序用的优先级表达式（值越小越优先）及其参数
+
+    规则与priority_of相同（不含按以往耗时的估算，认领时还没有估算器），表达式中C_Attachment的别名为c、
+    c_order的别名为o，SQL Server和SQLite通用。这样整个待转换集合中的高优先级文件都能先被认领，
+    而不是只在本地候选窗口中排序
+
+    返回:
+    - (SQL表达式, 参数列表)
+    """
+    terms, params = [], []
+    if PRIORITY_HIGH_ORDER_STATUSES:
+        statuses = sorted(PRIORITY_HIGH_ORDER_STATUSES)
+        terms.append(f"CASE WHEN o.OrderStatus IN ({', '.join('?' for _ in statuses)}) THEN 0 ELSE 1 END")
+        params.extend(statuses)
+    if PRIORITY_LARGE_FILE_MB:
+        terms.append("CASE WHEN c.FileSize > ? THEN 1 ELSE 0 END")
+        params.append(int(PRIORITY_LARGE_FILE_MB * 1024 * 1024))
+    if PRIORITY_AGE_BOOST_HOURS:
+        terms.append("CASE WHEN c.CreatedDateTime < ? THEN -1 ELSE 0 END")
+        params.append(datetime.datetime.now() - datetime.timedelta(hours=PRIORITY_AGE_BOOST_HOURS))
+    return " + ".join(terms) or "0", params
+
+
+def source_key(path):
+    """规范化的源文件路径，用于判断多条附件记录是否指向同一个物理文件（Windows路径不区分大小写）"""
+    if not path:
+        return None
+    return os.path.normcase(os.path.normpath(str(path)))
+
+
+class FairShareQueue:
+    """按优先级和订单公平派发认领到的文件
+
+    先派发优先级最高的文件；同一优先级内每次从下一个订单取一个文件（轮转），订单内按认领顺序。
+    解析到同一个源文件（FullPath相同）的记录合并为一个转换任务，不论它们属于哪个订单
+    """
+
+    def __init__(self, estimator=None):
+        self.estimator = estimator
+        # 每个优先级一个有序字典: 订单ID -> 该订单待派发的(记录列表, 入队时间)
+        self._levels = [OrderedDict() for _ in PRIORITY_NAMES]
+        # 尚未派发的任务: 源文件路径 -> 记录列表
+        self._by_source = {}
+        self._size = 0
+
+    def __len__(self):
+        """尚未派发的转换任务数（合并后的）"""
+        return self._size
+
+    def push(self, dwg_file):
+        key = source_key(dwg_file.get('FullPath'))
+        rows = self._by_source.get(key) if key else None
+        if rows is not None:
+            # 同一个源文件已经在窗口中，只转换一次，结果写入每一条记录
+            rows.append(dwg_file)
+            metrics.CONVERSIONS_DEDUPLICATED.inc(kind="queue")
+            return
+        rows = [dwg_file]
+        if key:
+            self._by_source[key] = rows
+        level = priority_of(dwg_file, self.estimator)
+        self._levels[level].setdefault(dwg_file.get('id'), deque()).append((rows, time.monotonic()))
+        self._size += 1
+        metrics.SCHEDULE_QUEUE.inc(priority=PRIORITY_NAMES[level])
+
+    def extend(self, dwg_files):
+        for dwg_file in dwg_files:
+            self.push(dwg_file)
+
+    def pop(self):
+        """取出下一个转换任务
+
+        返回:
+        - (指向同一个源文件的记录列表, 优先级名称, 入队时间)；队列为空时返回None
+        """
+        for level, orders in enumerate(self._levels):
+            if not orders:
+                continue
+            order_id, files = next(iter(orders.items()))
+            rows, queued_at = files.popleft()
+            if files:
+                # 该订单还有文件，排到同一优先级的末尾
+                orders.move_to_end(order_id)
+            else:
+                del orders[order_id]
+            self._by_source.pop(source_key(rows[0].get('FullPath')), None)
+            self._size -= 1
+            metrics.SCHEDULE_QUEUE.dec(priority=PRIORITY_NAMES[level])
+            return rows, PRIORITY_NAMES[level], queued_at
+        return None
+
+    def peek(self, count):
+        """按派发顺序查看接下来的count个转换任务（不取出），用于预取
+
+        返回:
+        - 记录列表的列表，每个元素是指向同一个源文件的记录
+        """
+        upcoming = []
+        for orders in self._levels:
+            # 模拟同一优先级内的订单轮转：第i轮依次取每个订单的第i个任务
+            queues = [list(files) for files in orders.values()]
+            round_index = 0
+            while len(upcoming) < count and any(round_index < len(files) for files in queues):
+                for files in queues:
+                    if round_index < len(files) and len(upcoming) < count:
+                        upcoming.append(files[round_index][0])
+                round_index += 1
+            if len(upcoming) >= count:
+                break
+        return upcoming
+
+    def drain(self):
+        """取出全部尚未派发的记录（例如提前结束时释放认领）"""
+        remaining = []
+        while self._size:
+            remaining.extend(self.pop()[0])
+        return remaining
+
+
+class PollScheduler:
+    """决定定期任务何时再次轮询数据库
+
+    - 上一轮认领到文件：立即再次轮询
+    - 上一轮没有文件：等待时间从min_interval开始每次翻倍，最多max_interval
+    - 等待期间可以被wake()唤醒（例如HTTP接口），或由watermark函数检测到待转换文件变化时提前结束
+    """
+
+    def __init__(self, min_interval=POLL_MIN_INTERVAL, max_interval=POLL_MAX_INTERVAL,
+                 change_check_interval=POLL_CHANGE_CHECK_INTERVAL):
+        self.min_interval = max(min_interval, 0)
+        self.max_interval = max(max_interval, self.min_interval)
+        self.change_check_interval = change_check_interval
+        self.idle_rounds = 0
+        # 在事件循环中首次使用时创建
+        self._wakeup = None
+        # 上一次空闲等待结束时的watermark；之后一轮没有认领到文件时作为下一次等待的基准，不再重新查询
+        self._last_watermark = None
+
+    def _event(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        return self._wakeup
+
+    def wake(self, reason="wake"):
+        """唤醒正在等待的轮询，立即开始下一轮（必须在事件循环线程中调用）"""
+        logger.info(f"收到轮询唤醒请求: {reason}")
+        self.idle_rounds = 0
+        self._last_watermark = None
+        self._event().set()
+
+    def next_delay(self, found_work):
+        """根据上一轮是否认领到文件计算下一次轮询前的等待时间（秒）"""
+        if found_work:
+            self.idle_rounds = 0
+            self._last_watermark = None
+            delay = 0
+        else:
+            delay = min(self.min_interval * 2 ** self.idle_rounds, self.max_interval)
+            if delay < self.max_interval:
+                self.idle_rounds += 1
+        metrics.POLL_INTERVAL.set(delay)
+        return delay
+
+    async def sleep(self, delay, watermark=None):
+        """等待delay秒后返回触发下一轮轮询的原因
+
+        参数:
+        - delay: 等待时间（秒）
+        - watermark: 可选的异步函数，返回待转换文件的特征值（例如(数量, 最大附件ID)），
+          每隔change_check_interval秒调用一次，与等待开始时的值不同则提前返回；
+          上一轮没有认领到文件时沿用上一次等待最后得到的值作为基准，不在等待开始时重新查询
+
+        返回:
+        - "work"（delay为0）、"wake"（被唤醒）、"changed"（检测到变化）或"timeout"
+        """
+        event = self._event()
+        if delay <= 0:
+            event.clear()
+            return "work"
+        if event.is_set():
+            event.clear()
+            return "wake"
+
+        check_changes = watermark is not None and self.change_check_interval > 0
+        baseline = self._last_watermark
+        if check_changes and baseline is None:
+            try:
+                baseline = self._last_watermark = await watermark()
+            except Exception as e:
+                logger.error(f"检测待转换文件变化失败: {str(e)}")
+                check_changes = False
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + delay
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return "timeout"
+            step = min(remaining, self.change_check_interval) if check_changes else remaining
+            try:
+                await asyncio.wait_for(event.wait(), step)
+                event.clear()
+                return "wake"
+            except asyncio.TimeoutError:
+                pass
+            if check_changes and deadline - loop.time() > 0:
+                try:
+                    current = await watermark()
+                except Exception as e:
+                    logger.error(f"检测待转换文件变化失败: {str(e)}")
+                    continue
+                if current is not None:
+                    self._last_watermark = current
+                if current is not None and current != baseline:
+                    logger.info(f"检测到待转换文件变化: {baseline} -> {current}")
+                    return "changed"
+
+
+# 定期任务使用的全局调度器
+poll_scheduler = PollScheduler()
+# 根据定期任务的转换耗时估算后续文件的转换时间
+cost_estimator = CostEstimator()
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+
+"""测试公共配置：从仓库根目录导入服务模块，并使用SQLite存储后端"""
+
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+os.environ.setdefault("DB_BACKEND", "sqlite")
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+"""批量写入测试：数据库不可用时队列溢出的语句暂存到磁盘，恢复后按顺序全部写入"""
+
+import datetime
+
+import metrics
+from batch_writer import BatchWriter
+from repository import ERROR_UNAVAILABLE
+
+
+class FlakyRepository:
+    """记录写入的语句，available为False时模拟数据库不可用"""
+
+    def __init__(self):
+        self.available = True
+        self.written = []
+
+    def execute_batch(self, batch):
+        if not self.available:
+            raise ConnectionError("数据库不可用")
+        self.written.extend(batch)
+
+    def classify_error(self, error):
+        return ERROR_UNAVAILABLE
+
+
+def _statement(index):
+    return ("INSERT INTO t VALUES (?, ?)", (index, datetime.datetime(2024, 1, 1)))
+
+
+def test_overflow_spills_to_disk_and_keeps_order(tmp_path):
+    repository = FlakyRepository()
+    writer = BatchWriter(batch_size=1000, queue_limit=5, repository=repository, spill_dir=str(tmp_path))
+    writer.start = lambda: None
+
+    repository.available = False
+    for index in range(3):
+        writer.submit(_statement(index))
+    assert writer.flush() == 0
+    for index in range(3, 12):
+        writer.submit(_statement(index))
+    assert writer.pending_count() == 12
+    assert metrics.DB_WRITE_SPILLED.get() == 7
+    # 数据库仍不可用时读回的暂存语句放回内存队列，不超过上限
+    assert writer.flush() == 0
+    assert len(writer._pending) == 5 and writer.pending_count() == 12
+
+    repository.available = True
+    writer._stopping.set()
+    assert writer.stop() == 12
+    assert [params[0] for _, params in repository.written] == list(range(12))
+    assert writer.pending_count() == 0
+    assert list(tmp_path.iterdir()) == []
+
+
+class RejectingRepository(FlakyRepository):
+    """参数为负数的语句违反约束（数据错误），其余按available模拟"""
+
+    def execute_batch(self, batch):
+        if any(params[0] < 0 for _, params in batch):
+            raise ValueError("违反约束")
+        super().execute_batch(batch)
+
+    def classify_error(self, error):
+        return None if isinstance(error, ValueError) else ERROR_UNAVAILABLE
+
+
+def test_row_by_row_rejects_bad_statements_and_requeues_on_outage(tmp_path):
+    repository = RejectingRepository()
+    writer = BatchWriter(batch_size=1000, repository=repository, spill_dir=str(tmp_path))
+    writer.start = lambda: None
+
+    for index in (0, -1, 1):
+        writer.submit(_statement(index))
+    assert writer.flush() == 2
+    assert [params[0] for _, params in repository.written] == [0, 1]
+    assert [path.name.startswith("dwg2jpg_db_write_rejected_") for path in tmp_path.iterdir()] == [True]
+
+    # 逐条写入过程中数据库不可用，剩余的语句放回队列而不是丢弃
+    writer.submit(_statement(-2))
+    writer.submit(_statement(2))
+    repository.available = False
+    assert writer.flush() == 0
+    assert writer.pending_count() == 1
+    repository.available = True
+    assert writer.flush() == 1
+    assert [params[0] for _, params in repository.written] == [0, 1, 2]
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+"""图纸复杂度测试：DXF扫描的计数、块引用展开和循环引用保护，以及成本模型的拟合和预测"""
+
+import pytest
+
+import complexity
+from complexity import CostModel, profile_dxf, is_heavy
+
+# 模型空间引用两次A、一次C；A引用两次B；C引用自身（循环引用按空块处理）；图纸空间的直线不计入
+_DXF = [
+    ("0", "SECTION"), ("2", "HEADER"),
+    ("9", "$EXTMIN"), ("10", "0.0"), ("20", "0.0"),
+    ("9", "$EXTMAX"), ("10", "100.0"), ("20", "50.0"),
+    ("0", "ENDSEC"),
+    ("0", "SECTION"), ("2", "BLOCKS"),
+    ("0", "BLOCK"), ("2", "B"), ("10", "0.0"),
+    ("0", "HATCH"), ("10", "1.0"),
+    ("0", "LINE"), ("10", "0.0"), ("11", "1.0"),
+    ("0", "ENDBLK"),
+    ("0", "BLOCK"), ("2", "A"), ("10", "0.0"),
+    ("0", "LINE"), ("10", "0.0"), ("11", "1.0"),
+    ("0", "TEXT"), ("10", "0.0"),
+    ("0", "INSERT"), ("2", "B"), ("10", "0.0"),
+    ("0", "INSERT"), ("2", "B"), ("10", "5.0"),
+    ("0", "ENDBLK"),
+    ("0", "BLOCK"), ("2", "C"), ("10", "0.0"),
+    ("0", "INSERT"), ("2", "C"), ("10", "0.0"),
+    ("0", "LINE"), ("10", "0.0"), ("11", "1.0"),
+    ("0", "ENDBLK"),
+    ("0", "ENDSEC"),
+    ("0", "SECTION"), ("2", "ENTITIES"),
+    ("0", "INSERT"), ("2", "A"), ("10", "0.0"),
+    ("0", "INSERT"), ("2", "A"), ("10", "10.0"),
+    ("0", "LINE"), ("10", "0.0"), ("11", "1.0"),
+    ("0", "LINE"), ("67", "1"), ("10", "0.0"), ("11", "1.0"),
+    ("0", "INSERT"), ("2", "C"), ("10", "20.0"),
+    ("0", "ENDSEC"),
+    ("0", "EOF"),
+]
+
+
+def _profile(**values):
+    profile = dict(expanded_entity_count=0, vertex_count=0, hatch_count=0, text_count=0, block_depth=0,
+                   file_size=0)
+    profile.update(values)
+    return profile
+
+
+def test_profile_dxf_counts_and_expands_blocks(tmp_path):
+    dxf_path = tmp_path / "drawing.dxf"
+    dxf_path.write_text("".join(f"{code}\n{value}\n" for code, value in _DXF), encoding="utf-8")
+
+    profile = profile_dxf(str(dxf_path))
+
+    assert profile["entity_count"] == 4
+    assert profile["entity_counts"] == {"INSERT": 3, "LINE": 1}
+    assert profile["block_count"] == 3
+    # 模型空间4个实体，A展开为8个（自身4个加两次B），C展开为2个
+    assert profile["expanded_entity_count"] == 4 + 2 * 8 + 2
+    assert profile["hatch_count"] == 4
+    assert profile["text_count"] == 2
+    assert profile["vertex_count"] == 5 + 2 * 11 + 3
+    assert profile["block_depth"] == 2
+    assert (profile["extent_min_x"], profile["extent_min_y"]) == (0.0, 0.0)
+    assert (profile["extent_max_x"], profile["extent_max_y"]) == (100.0, 50.0)
+
+
+def test_profile_dxf_skips_binary_dxf(tmp_path):
+    dxf_path = tmp_path / "binary.dxf"
+    dxf_path.write_bytes(b"AutoCAD Binary DXF\r\n\x1a\x00" + b"\x00" * 16)
+    assert profile_dxf(str(dxf_path)) is None
+
+
+def test_cost_model_fits_and_predicts():
+    model = CostModel(min_samples=5, ridge=1e-6)
+    assert model.predict(_profile(expanded_entity_count=1e4)) == (None, None)
+
+    for entities, vertices in [(1e4, 1e5), (2e4, 5e4), (5e4, 3e5), (8e4, 2e5), (1e5, 6e5), (3e4, 4e5)]:
+        seconds = 1 + 0.3 * entities / 1e4 + 0.2 * vertices / 1e5
+        memory = (100 + 20 * entities / 1e4) * 1024 * 1024
+        model.observe(_profile(expanded_entity_count=entities, vertex_count=vertices), seconds, memory)
+
+    seconds, memory = model.predict(_profile(expanded_entity_count=6e4, vertex_count=1e5))
+    assert seconds == pytest.approx(1 + 0.3 * 6 + 0.2, rel=1e-3)
+    assert memory == pytest.approx((100 + 20 * 6) * 1024 * 1024, rel=1e-3)
+
+
+def test_is_heavy(monkeypatch):
+    monkeypatch.setattr(complexity, "COMPLEXITY_HEAVY_SECONDS", 60)
+    monkeypatch.setattr(complexity, "COMPLEXITY_HEAVY_MEMORY_MB", 1024)
+    monkeypatch.setattr(complexity, "COMPLEXITY_HEAVY_ENTITIES", 1000)
+
+    assert not is_heavy(None)
+    assert is_heavy(_profile(expanded_entity_count=5000))
+    assert not is_heavy(_profile(expanded_entity_count=5000), predicted_seconds=10)
+    assert is_heavy(_profile(), predicted_seconds=61)
+    assert is_heavy(_profile(), predicted_seconds=10, predicted_memory_bytes=2048 * 1024 * 1024)
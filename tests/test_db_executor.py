@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+
+"""DBExecutor测试：超时的调用在线程中结束前一直占用名额，线程池不会接受超出上限的调用"""
+
+import asyncio
+import threading
+
+import pytest
+
+from database import DBExecutor
+
+
+def test_timed_out_call_keeps_its_slot_until_the_thread_finishes():
+    executor = DBExecutor(workers=1, queue_limit=0)
+    release = threading.Event()
+    second_started = threading.Event()
+
+    async def main():
+        with pytest.raises(asyncio.TimeoutError):
+            await executor.run(release.wait, timeout=0.01)
+        # 第一次调用仍在线程中执行，名额没有释放，第二次调用要等待名额，不会被提交到线程池
+        assert executor._slots.locked()
+        second = asyncio.ensure_future(executor.run(second_started.set, timeout=None))
+        await asyncio.sleep(0.1)
+        assert not second.done() and not second_started.is_set()
+        release.set()
+        await asyncio.wait_for(second, 5)
+        assert second_started.is_set()
+        await asyncio.sleep(0.05)
+        assert not executor._slots.locked()
+
+    try:
+        asyncio.run(main())
+    finally:
+        release.set()
+        executor.shutdown()
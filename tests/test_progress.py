@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+
+"""任务进度测试：订阅不创建任务，事件有上限，结束后保留汇总，已结束文件按附件ID区分"""
+
+import asyncio
+
+import progress
+
+
+def _collect(job_id, last_event_id=-1):
+    async def collect():
+        return [seq async for seq, _ in progress.iter_events(job_id, last_event_id, keepalive_seconds=0.01)]
+    return asyncio.run(collect())
+
+
+def test_unknown_job_is_not_created():
+    assert progress.get_job("missing-job") is None
+    assert _collect("missing-job") == []
+    assert progress.get_job("missing-job") is None
+
+    progress.publish("missing-job", "started", total_files=1)
+    assert progress.get_job("missing-job") is None
+
+
+def test_events_are_bounded_and_summary_survives(monkeypatch):
+    monkeypatch.setattr(progress, "JOB_MAX_EVENTS", 5)
+    job_id = progress.create_job("database")
+    progress.publish(job_id, "started", total_files=10)
+    for index in range(10):
+        progress.publish(job_id, "file_done", file="a.dwg", attachment_id=index, success=index != 3)
+    progress.publish(job_id, "done")
+
+    job = progress.get_job(job_id)
+    assert len(job.events) == 5
+    assert job.first_seq == 7
+    # 断线续传时从保留的最早事件继续
+    assert _collect(job_id, last_event_id=2) == [7, 8, 9, 10, 11]
+    summary = job.summary()
+    assert (summary["total_files"], summary["succeeded_files"], summary["failed_files"]) == (10, 9, 1)
+    assert summary["finished"] and summary["last_event"]["stage"] == "done"
+
+
+def test_done_files_are_keyed_by_attachment_id():
+    job_id = progress.create_job("database")
+    progress.publish(job_id, "file_done", file="图纸/a.dwg", attachment_id=1, success=True)
+    # 同名文件的另一个附件仍然发布阶段事件，已结束附件的晚到事件被丢弃
+    progress.publish(job_id, "rendering", file="图纸/a.dwg", attachment_id=2)
+    progress.publish(job_id, "rendering", file="图纸/a.dwg", attachment_id=1)
+
+    stages = [(event["stage"], event.get("attachment_id")) for _, event in progress.get_job(job_id).events]
+    assert stages == [("file_done", 1), ("rendering", 2)]
@@ -0,0 +1,43 @@
+# -*- coding: utf-8 -*-
+
+"""重试策略测试：隔离只看崩溃或超时的次数，暂时性错误不计入"""
+
+from repository import SQLiteRepository
+from retry_policy import RetryPolicy, OUTCOME_RETRY, OUTCOME_FAILED, OUTCOME_QUARANTINED
+
+
+def test_transient_failures_do_not_count_towards_quarantine():
+    policy = RetryPolicy(max_attempts=10, quarantine_attempts=3)
+
+    outcome, attempts, crashes, delay = policy.decide("timeout", previous_attempts=4, previous_crashes=0)
+    assert (outcome, attempts, crashes) == (OUTCOME_RETRY, 5, 1)
+    assert delay is not None
+
+    outcome, attempts, crashes, _ = policy.decide("write_failed", previous_attempts=5, previous_crashes=2)
+    assert (outcome, attempts, crashes) == (OUTCOME_RETRY, 6, 2)
+
+    outcome, attempts, crashes, delay = policy.decide("worker_crashed", previous_attempts=6, previous_crashes=2)
+    assert (outcome, attempts, crashes, delay) == (OUTCOME_QUARANTINED, 7, 3, None)
+
+
+def test_transient_and_permanent_failures():
+    policy = RetryPolicy(max_attempts=3, quarantine_attempts=3)
+
+    assert policy.decide("file_not_found")[0] == OUTCOME_FAILED
+    assert policy.decide("pool_recycled", previous_attempts=1)[0] == OUTCOME_RETRY
+    assert policy.decide("share_unavailable", previous_attempts=2, previous_crashes=2)[:3] == (OUTCOME_FAILED, 3, 2)
+
+
+def test_failure_statement_records_crash_count(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "dwg2jpg.sqlite3"))
+    with repository._connect() as conn:
+        conn.execute("INSERT INTO c_order (id, OrderStatus) VALUES (1, 100)")
+        conn.execute("INSERT INTO C_Attachment (RefId, FilePath) VALUES (1, 'a.dwg')")
+    [row] = repository.claim(limit=None, owner="a")
+    assert row["CrashCount"] is None
+
+    repository.execute(repository.failure_statement(1, "a.dwg", "retry", 1, 1, None, "timeout: 渲染超时",
+                                                    row["AttachmentId"]))
+
+    [row] = repository.poll_pending()
+    assert (row["RetryCount"], row["CrashCount"]) == (1, 1)
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+
+"""轮询调度测试：空闲等待沿用上一次的watermark，认领到文件后重新查询"""
+
+import asyncio
+
+from scheduler import PollScheduler
+
+
+def test_idle_sleep_reuses_last_watermark():
+    scheduler = PollScheduler(min_interval=0.05, max_interval=0.05, change_check_interval=0.02)
+    state = {"value": (1, 10)}
+
+    async def watermark():
+        return state["value"]
+
+    async def run():
+        first = await scheduler.sleep(scheduler.next_delay(False), watermark)
+        # 两次等待之间待转换文件发生变化：沿用上一次的值作为基准，第一次检查就能发现
+        state["value"] = (2, 11)
+        second = await scheduler.sleep(scheduler.next_delay(False), watermark)
+        return first, second
+
+    assert asyncio.run(run()) == ("timeout", "changed")
+    assert scheduler._last_watermark == (2, 11)
+
+    # 认领到文件后下一次等待重新查询基准
+    scheduler.next_delay(True)
+    assert scheduler._last_watermark is None
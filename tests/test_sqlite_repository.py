@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+"""SQLiteRepository的认领、续约和释放测试（与SQL Server实现的认领协议相同）"""
+
+import datetime
+import multiprocessing
+import threading
+
+import pytest
+
+import repository as repository_module
+import scheduler
+from repository import SQLiteRepository
+
+
+def _seed(repository, count, order_status=100):
+    """插入一个订单和count个待转换的DWG附件，返回附件ID列表"""
+    with repository._connect() as conn:
+        conn.execute("INSERT INTO c_order (id, OrderStatus) VALUES (1, ?)", (order_status,))
+        for i in range(count):
+            conn.execute(
+                "INSERT INTO C_Attachment (RefId, AttachmentType, FileName, FilePath, FileSize, CreatedDateTime) "
+                "VALUES (1, 1, ?, ?, ?, '2024-01-01 00:00:00')",
+                (f"{i}.dwg", f"files/{i}.dwg", 1024 * (i + 1))
+            )
+        return [row[0] for row in conn.execute("SELECT Id FROM C_Attachment ORDER BY Id")]
+
+
+def _claim_all(path, owner, limit=3):
+    """一个工作进程的认领循环：反复认领直到没有可认领的行，返回认领到的附件ID"""
+    repository = SQLiteRepository(path)
+    claimed = []
+    while True:
+        rows = repository.claim(limit=limit, owner=owner)
+        if not rows:
+            return claimed
+        claimed.extend(row["AttachmentId"] for row in rows)
+
+
+@pytest.fixture
+def repository(tmp_path):
+    return SQLiteRepository(str(tmp_path / "dwg2jpg.sqlite3"))
+
+
+def test_claim_marks_rows_and_skips_claimed(repository):
+    ids = _seed(repository, 5)
+
+    first = repository.claim(limit=3, owner="a")
+    assert [row["AttachmentId"] for row in first] == ids[:3]
+    assert {"OrderStatus", "FileSize", "CreatedDateTime", "RetryCount", "FullPath"} <= set(first[0])
+
+    # 已被其他认领者持有的行会被跳过
+    second = repository.claim(limit=None, owner="b")
+    assert [row["AttachmentId"] for row in second] == ids[3:]
+    assert repository.claim(limit=None, owner="c") == []
+
+
+def test_claim_after_id_pages_by_attachment_id(repository):
+    ids = _seed(repository, 5)
+
+    rows = repository.claim(limit=2, owner="a", after_id=ids[1])
+    assert [row["AttachmentId"] for row in rows] == ids[2:4]
+
+
+def _seed_orders(repository, orders):
+    """按顺序插入订单及其DWG附件，orders为[(订单ID, 订单状态, 附件数)]，返回 订单ID -> 附件ID列表"""
+    ids = {}
+    with repository._connect() as conn:
+        for order_id, order_status, count in orders:
+            conn.execute("INSERT INTO c_order (id, OrderStatus) VALUES (?, ?)", (order_id, order_status))
+            ids[order_id] = [
+                conn.execute(
+                    "INSERT INTO C_Attachment (RefId, FilePath, FileSize, CreatedDateTime) "
+                    "VALUES (?, ?, 1024, datetime('now'))",
+                    (order_id, f"{order_id}/{i}.dwg")
+                ).lastrowid
+                for i in range(count)
+            ]
+    return ids
+
+
+def test_claim_rotates_between_orders(repository):
+    ids = _seed_orders(repository, [(1, 100, 50), (2, 100, 2), (3, 100, 1)])
+
+    # 订单1的大量图纸排在前面，也不会占满一次认领
+    rows = repository.claim(limit=5, owner="a")
+    assert [row["AttachmentId"] for row in rows] == [ids[1][0], ids[2][0], ids[3][0], ids[1][1], ids[2][1]]
+    rows = repository.claim(limit=2, owner="a")
+    assert [row["AttachmentId"] for row in rows] == ids[1][2:4]
+
+
+def test_claim_takes_high_priority_orders_first(repository, monkeypatch):
+    monkeypatch.setattr(scheduler, "PRIORITY_HIGH_ORDER_STATUSES", {150})
+    ids = _seed_orders(repository, [(1, 100, 200), (2, 150, 2)])
+
+    rows = repository.claim(limit=3, owner="a")
+    assert [row["AttachmentId"] for row in rows] == ids[2] + ids[1][:1]
+
+
+def test_claim_skips_rows_waiting_for_retry(repository):
+    ids = _seed(repository, 2)
+    repository.execute(("UPDATE C_Attachment SET NextAttemptAt = datetime('now', '+1 hour') WHERE Id = ?", (ids[0],)))
+
+    rows = repository.claim(limit=None, owner="a")
+    assert [row["AttachmentId"] for row in rows] == ids[1:]
+
+
+def test_expired_lease_is_reclaimed(repository):
+    ids = _seed(repository, 2)
+
+    # 认领者崩溃后租约过期，其他认领者可以重新认领
+    assert len(repository.claim(limit=None, owner="crashed", lease_seconds=-1)) == 2
+    rows = repository.claim(limit=None, owner="b")
+    assert [row["AttachmentId"] for row in rows] == ids
+
+
+def test_renew_keeps_lease_alive(repository):
+    _seed(repository, 2)
+    repository.claim(limit=None, owner="a", lease_seconds=-1)
+
+    assert repository.renew_claims(owner="a", lease_seconds=60) == 2
+    assert repository.claim(limit=None, owner="b") == []
+    # 只续约自己的认领
+    assert repository.renew_claims(owner="b", lease_seconds=60) == 0
+
+
+def test_release_makes_rows_claimable(repository):
+    ids = _seed(repository, 3)
+    repository.claim(limit=None, owner="a")
+
+    assert repository.release_claims(owner="b") == 0
+    assert repository.release_claims(owner="a", attachment_ids=[]) == 0
+    assert repository.release_claims(owner="a", attachment_ids=[ids[0]]) == 1
+    assert [row["AttachmentId"] for row in repository.claim(limit=None, owner="b")] == ids[:1]
+
+    assert repository.release_claims(owner="a") == 2
+    assert [row["AttachmentId"] for row in repository.claim(limit=None, owner="b")] == ids[1:]
+
+
+def test_release_skips_converted_rows(repository):
+    ids = _seed(repository, 2)
+    repository.claim(limit=None, owner="a")
+    repository.execute(("UPDATE C_Attachment SET istojpg = 1 WHERE Id = ?", (ids[0],)))
+
+    assert repository.release_claims(owner="a") == 1
+
+
+def test_concurrent_claimers_get_disjoint_rows(repository):
+    ids = _seed(repository, 60)
+    results = {}
+    barrier = threading.Barrier(2)
+
+    def claimer(owner):
+        barrier.wait()
+        results[owner] = _claim_all(repository.path, owner)
+
+    threads = [threading.Thread(target=claimer, args=(owner,)) for owner in ("a", "b")]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert not set(results["a"]) & set(results["b"])
+    assert sorted(results["a"] + results["b"]) == ids
+
+
+def test_multi_worker_processes_claim_each_row_once(repository):
+    ids = _seed(repository, 120)
+    owners = [f"worker-{i}" for i in range(4)]
+
+    with multiprocessing.Pool(len(owners)) as pool:
+        claimed = pool.starmap(_claim_all, [(repository.path, owner) for owner in owners])
+
+    all_claimed = [attachment_id for rows in claimed for attachment_id in rows]
+    assert len(all_claimed) == len(set(all_claimed))
+    assert sorted(all_claimed) == ids
+    with repository._connect() as conn:
+        owner_by_id = dict(conn.execute("SELECT Id, ClaimOwner FROM C_Attachment").fetchall())
+    for owner, rows in zip(owners, claimed):
+        assert all(owner_by_id[attachment_id] == owner for attachment_id in rows)
+
+
+def _seed_history(repository, count):
+    """插入count条转换历史，每两条的conversion_time相同，返回按(conversion_time, id)倒序的id列表"""
+    with repository._connect() as conn:
+        for i in range(count):
+            conn.execute(
+                "INSERT INTO conversion_history (file_name, conversion_time, status) VALUES (?, ?, ?)",
+                (f"{i}.dwg", f"2024-01-01 00:00:{i // 2:02d}", "成功" if i % 3 else "失败")
+            )
+        return [row[0] for row in conn.execute("SELECT id FROM conversion_history ORDER BY conversion_time DESC, id DESC")]
+
+
+def test_history_pages_by_offset_and_cursor(repository):
+    ids = _seed_history(repository, 9)
+
+    assert repository.count_history() == (9, False)
+    assert repository.count_history("失败") == (3, False)
+    assert [row["id"] for row in repository.history_page(limit=4, offset=4)] == ids[4:8]
+
+    # 游标中的时间是datetime，与同一时间的其他行按id继续
+    first = repository.history_page(limit=3)
+    last = first[-1]
+    after = (datetime.datetime.fromisoformat(last["conversion_time"]), last["id"])
+    assert [row["id"] for row in repository.history_page(after=after, limit=3)] == ids[3:6]
+    assert [row["id"] for row in repository.history_page("失败")] == [
+        row["id"] for row in repository.history_page() if row["status"] == "失败"]
+
+
+def test_iter_history_streams_all_rows_in_batches(repository, monkeypatch):
+    ids = _seed_history(repository, 11)
+    monkeypatch.setattr(repository_module, "DB_FETCH_SIZE", 4)
+
+    assert [row["id"] for row in repository.iter_history()] == ids
+    assert [row["id"] for row in repository.iter_history(after=(datetime.datetime(2024, 1, 1, 0, 0, 3), ids[4]))] == ids[5:]
@@ -0,0 +1,399 @@
+import os
+import json
+import time
+import asyncio
+import logging
+import threading
+import contextvars
+import urllib.request
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from logger_config import logger
+import metrics
+
+# 转换任务追踪配置
+# 每个文件的转换是一条trace，各阶段（流水线的fetch、oda、render、write，工作进程中的parsing、rendering、encoding）
+# 记录为带耗时的span；span中的任务ID、订单ID、附件ID和文件名同时附加到期间输出的每一条日志上
+# span的导出方式：留空不导出（日志中仍带有trace_id等字段），file写入本地JSON Lines文件，otlp以OTLP/HTTP JSON发送到采集器
+TRACE_EXPORT = os.getenv("TRACE_EXPORT", "").lower()
+# TRACE_EXPORT=file时的输出文件，每行一个span
+TRACE_FILE = os.getenv("TRACE_FILE", os.path.join("logs", "traces.jsonl"))
+# TRACE_EXPORT=otlp时的采集器地址（OTLP/HTTP）
+TRACE_OTLP_ENDPOINT = os.getenv("TRACE_OTLP_ENDPOINT", "http://localhost:4318/v1/traces")
+# 导出的服务名称（OTLP资源属性service.name）
+TRACE_SERVICE_NAME = os.getenv("TRACE_SERVICE_NAME", "dwg2jpg")
+# 后台导出线程每批最多导出的span数，以及导出间隔（秒）
+TRACE_EXPORT_BATCH_SIZE = int(os.getenv("TRACE_EXPORT_BATCH_SIZE", "256"))
+TRACE_EXPORT_INTERVAL = float(os.getenv("TRACE_EXPORT_INTERVAL", "5"))
+# 等待导出的span数上限，超过后丢弃新的span
+TRACE_QUEUE_LIMIT = int(os.getenv("TRACE_QUEUE_LIMIT", "10000"))
+# 总耗时超过该值（秒）的转换在日志中输出耗时最长的阶段，0表示不输出
+TRACE_SLOW_SECONDS = float(os.getenv("TRACE_SLOW_SECONDS", "300"))
+
+# 沿着调用链传递、并附加到日志上的关联字段
+CORRELATION_KEYS = ("job_id", "order_id", "attachment_id", "file")
+
+# 跨进程传递的span标识（可序列化）
+SpanContext = namedtuple("SpanContext", ["trace_id", "span_id", "context"])
+
+# 当前span；asyncio任务和asyncio.to_thread会复制上下文，run_in_executor需要显式复制
+_current_span = contextvars.ContextVar("dwg2jpg_current_span", default=None)
+# 工作进程中结束的span先收集起来，随转换结果返回主进程导出
+_collector = contextvars.ContextVar("dwg2jpg_span_collector", default=None)
+# 未指定parent时使用当前span
+_CURRENT = object()
+
+
+def _new_id(size):
+    return os.urandom(size).hex()
+
+
+class Span:
+    """一个带耗时的操作，属于某个trace"""
+
+    def __init__(self, name, parent=None, links=None, **attributes):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent.span_id if parent is not None else None
+        # 关联字段从上级span继承
+        self.context = dict(parent.context) if parent is not None else {}
+        self.attributes = {}
+        self.links = list(links or [])
+        self.status = "ok"
+        self.error = None
+        self.start_ns = time.time_ns()
+        self.end_ns = None
+        for key, value in attributes.items():
+            self.set_attribute(key, value)
+
+    def set_attribute(self, key, value):
+        if value is None:
+            return
+        if key in CORRELATION_KEYS:
+            self.context[key] = value
+        else:
+            self.attributes[key] = value
+
+    def set_error(self, message):
+        self.status = "error"
+        self.error = str(message)
+
+    def span_context(self):
+        return SpanContext(self.trace_id, self.span_id, dict(self.context))
+
+    def end(self):
+        """结束span并交给导出线程（重复调用无影响）"""
+        if self.end_ns is not None:
+            return
+        self.end_ns = time.time_ns()
+        record = self.to_dict()
+        collected = _collector.get()
+        if collected is not None:
+            collected.append(record)
+        else:
+            _finish(record)
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": round((self.end_ns - self.start_ns) / 1e6, 3) if self.end_ns else None,
+            "status": self.status,
+            "error": self.error,
+            "attributes": dict(self.context, **self.attributes),
+            "links": [{"trace_id": trace_id, "span_id": span_id} for trace_id, span_id in self.links],
+        }
+
+
+def current_span():
+    return _current_span.get()
+
+
+def current_context():
+    """当前span的SpanContext，用于传给转换工作进程；没有当前span时返回None"""
+    span = _current_span.get()
+    return span.span_context() if span is not None else None
+
+
+def start_span(name, parent=_CURRENT, links=None, **attributes):
+    """创建一个span（不设为当前span），需要调用end结束
+
+    参数:
+    - parent: 上级Span或SpanContext，默认为当前span，为None时开始一条新的trace
+    - links: 关联的其他span的 (trace_id, span_id) 列表
+    """
+    if parent is _CURRENT:
+        parent = _current_span.get()
+    return Span(name, parent, links, **attributes)
+
+
+@contextmanager
+def span(name, parent=_CURRENT, links=None, **attributes):
+    """在with块中把新的span设为当前span，块中抛出的异常记录为span的错误"""
+    current = start_span(name, parent, links, **attributes)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except asyncio.CancelledError:
+        current.set_error("cancelled")
+        raise
+    except Exception as e:
+        # trace_error为False的异常用于控制流程（例如相同内容的文件离开流水线），不标记为失败
+        if getattr(e, "trace_error", True):
+            current.set_error(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        current.end()
+
+
+@contextmanager
+def collect():
+    """在工作进程中使用：with块中结束的span不直接导出，而是放入返回的列表，由主进程调用export_spans导出"""
+    spans = []
+    token = _collector.set(spans)
+    try:
+        yield spans
+    finally:
+        _collector.reset(token)
+
+
+def export_spans(records):
+    """导出工作进程返回的span"""
+    for record in records or ():
+        _finish(record)
+
+
+def run_in_context(func, *args):
+    """返回一个在当前上下文（包括当前span）中调用func的函数，用于run_in_executor"""
+    context = contextvars.copy_context()
+    return lambda: context.run(func, *args)
+
+
+class StageSpans:
+    """把转换函数的进度回调（进入oda、parsing、rendering、encoding阶段时调用）记录为当前span的子span
+
+    同时转发给原来的进度回调；同一阶段的重复回调（例如渲染百分比）不会创建新的span
+    """
+
+    def __init__(self, progress=None):
+        self._progress = progress
+        self._stage = None
+        self._span = None
+
+    def __call__(self, stage, percent=None):
+        if stage != self._stage:
+            self.close()
+            self._stage = stage
+            self._span = start_span(stage)
+        if self._progress is not None:
+            self._progress(stage, percent)
+
+    def close(self):
+        if self._span is not None:
+            self._span.end()
+            self._span = None
+
+
+class _SlowTraceDetector:
+    """记录每条trace中各个span的耗时，根span结束时如果总耗时超过阈值，输出耗时最长的最底层阶段"""
+
+    # 最多同时记录的trace数（根span未结束的trace，例如被取消的转换，超过后丢弃最早的）
+    MAX_TRACES = 10000
+
+    def __init__(self, threshold_seconds):
+        self.threshold_seconds = threshold_seconds
+        self._spans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def observe(self, record):
+        if self.threshold_seconds <= 0:
+            return
+        seconds = (record["end_ns"] - record["start_ns"]) / 1e9
+        with self._lock:
+            if record["parent_id"] is not None:
+                spans = self._spans.setdefault(record["trace_id"], [])
+                spans.append((record["name"], seconds, record["span_id"], record["parent_id"]))
+                # 在流水线队列中等待的时间也作为一个阶段参与比较
+                queue_wait = record["attributes"].get("queue_wait_seconds")
+                if queue_wait:
+                    spans.append((f"等待{record['name']}", queue_wait, None, None))
+                if len(self._spans) > self.MAX_TRACES:
+                    self._spans.popitem(last=False)
+                return
+            spans = self._spans.pop(record["trace_id"], [])
+        if seconds < self.threshold_seconds or not spans:
+            return
+        # 只比较没有子span的阶段，例如render阶段中的rendering，而不是包含它的render
+        parents = {parent_id for _, _, _, parent_id in spans if parent_id is not None}
+        leaves = [item for item in spans if item[2] is None or item[2] not in parents]
+        name, stage_seconds, _, _ = max(leaves or spans, key=lambda item: item[1])
+        logger.warning(
+            "转换耗时 %.1f 秒，耗时最长的阶段: %s（%.1f 秒），文件: %s，trace_id: %s",
+            seconds, name, stage_seconds, record["attributes"].get("file"), record["trace_id"]
+        )
+
+
+def _otlp_value(value):
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+def _otlp_span(record):
+    span = {
+        "traceId": record["trace_id"],
+        "spanId": record["span_id"],
+        "name": record["name"],
+        "kind": 1,
+        "startTimeUnixNano": str(record["start_ns"]),
+        "endTimeUnixNano": str(record["end_ns"]),
+        "attributes": [{"key": key, "value": _otlp_value(value)} for key, value in record["attributes"].items()],
+        "links": [{"traceId": link["trace_id"], "spanId": link["span_id"]} for link in record["links"]],
+        "status": {"code": 2, "message": record["error"] or ""} if record["status"] == "error" else {"code": 1},
+    }
+    if record["parent_id"]:
+        span["parentSpanId"] = record["parent_id"]
+    return span
+
+
+class SpanExporter:
+    """后台线程批量导出span，导出失败时丢弃该批span，不影响转换"""
+
+    def __init__(self, mode=TRACE_EXPORT, batch_size=TRACE_EXPORT_BATCH_SIZE, interval=TRACE_EXPORT_INTERVAL,
+                 queue_limit=TRACE_QUEUE_LIMIT):
+        self.mode = mode
+        self.batch_size = max(batch_size, 1)
+        self.interval = interval
+        self.queue_limit = queue_limit
+        self._pending = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopping = threading.Event()
+        self._thread = None
+
+    @property
+    def enabled(self):
+        return self.mode in ("file", "otlp")
+
+    def start(self):
+        """启动后台导出线程（重复调用无影响）"""
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="trace-exporter", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._stopping.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def export(self, record):
+        if not self.enabled:
+            return
+        self.start()
+        with self._lock:
+            if len(self._pending) >= self.queue_limit:
+                metrics.TRACE_SPANS.inc(result="dropped")
+                return
+            self._pending.append(record)
+            pending = len(self._pending)
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """导出队列中的全部span，返回导出的span数"""
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+            exported = 0
+            for start in range(0, len(batch), self.batch_size):
+                chunk = batch[start:start + self.batch_size]
+                try:
+                    if self.mode == "otlp":
+                        self._export_otlp(chunk)
+                    else:
+                        self._export_file(chunk)
+                except Exception as e:
+                    metrics.TRACE_SPANS.inc(len(chunk), result="dropped")
+                    logger.warning(f"导出追踪数据失败，丢弃 {len(chunk)} 个span: {str(e)}")
+                    continue
+                metrics.TRACE_SPANS.inc(len(chunk), result="exported")
+                exported += len(chunk)
+            return exported
+
+    @staticmethod
+    def _export_file(records):
+        directory = os.path.dirname(TRACE_FILE)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, default=str) + "\n")
+
+    @staticmethod
+    def _export_otlp(records):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": {"stringValue": TRACE_SERVICE_NAME}}]},
+                "scopeSpans": [{"scope": {"name": "dwg2jpg"}, "spans": [_otlp_span(record) for record in records]}],
+            }]
+        }
+        request = urllib.request.Request(
+            TRACE_OTLP_ENDPOINT,
+            data=json.dumps(payload, default=str).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+            method="POST"
+        )
+        with urllib.request.urlopen(request, timeout=10) as response:
+            response.read()
+
+    def stop(self, timeout=None):
+        """停止后台线程并导出剩余的span（关闭服务时调用）"""
+        self._stopping.set()
+        self._wakeup.set()
+        thread = self._thread
+        if thread is not None:
+            thread.join(timeout)
+        return self.flush()
+
+
+# 全局导出实例
+exporter = SpanExporter()
+slow_traces = _SlowTraceDetector(TRACE_SLOW_SECONDS)
+
+
+def _finish(record):
+    slow_traces.observe(record)
+    exporter.export(record)
+
+
+# 日志记录带上当前span的trace_id、span_id和关联字段（JSON日志中作为独立的键）
+_previous_record_factory = logging.getLogRecordFactory()
+
+
+def _record_factory(*args, **kwargs):
+    record = _previous_record_factory(*args, **kwargs)
+    current = _current_span.get()
+    if current is not None:
+        record.trace_id = current.trace_id
+        record.span_id = current.span_id
+        for key, value in current.context.items():
+            setattr(record, key, value)
+    return record
+
+
+logging.setLogRecordFactory(_record_factory)
@@ -0,0 +1,465 @@
+import os
+import time
+import asyncio
+import functools
+import itertools
+import threading
+import weakref
+import multiprocessing
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from logger_config import logger, create_worker_log_queue, configure_worker_logging
+from converter import converter_dwg_to_jpg, converter_dxf_to_jpg
+import metrics
+import progress
+import tracing
+
+# 转换进程池大小，默认与CPU核数一致
+# 注意：matplotlib的pyplot不是线程安全的，因此使用进程池而不是线程池
+CONVERT_WORKERS = int(os.getenv("CONVERT_WORKERS", str(os.cpu_count() or 2)))
+# 复杂图纸专用进程池的工作进程数（按complexity中的成本模型判断），复杂图纸不占用普通进程池；0表示不单独处理
+HEAVY_WORKERS = int(os.getenv("HEAVY_WORKERS", "1"))
+# 渲染时采样工作进程内存的间隔（秒），用于记录每个任务的峰值内存
+MEMORY_SAMPLE_INTERVAL = float(os.getenv("MEMORY_SAMPLE_INTERVAL", "0.2"))
+
+# 进程池名称 -> 工作进程数
+POOL_SIZES = {"normal": CONVERT_WORKERS, "heavy": HEAVY_WORKERS}
+
+# 进程池名称 -> 进程池
+_executors = {}
+# 因任务超时而终止工作进程的进程池，池中其他任务随之失败时不算作图纸导致的崩溃
+_recycled = weakref.WeakSet()
+# 进程池 -> 已上报内存的工作进程pid，丢弃或关闭进程池时删除这些pid的内存指标，避免指标随进程池重建无限增长
+_worker_pids = {}
+_progress_queue = None
+_progress_thread = None
+_log_queue = None
+# 工作进程开始执行任务时回传任务编号的队列，渲染超时从开始执行时计算，不包括排队等待
+_start_queue = None
+_start_thread = None
+# 任务编号 -> (事件循环, 开始执行时完成的future)
+_start_waiters = {}
+_task_ids = itertools.count()
+# 进程池名称 -> (事件循环, 信号量)，同时提交到进程池的渲染任务数不超过工作进程数
+_pool_slots = {}
+
+# 工作进程中用于回传进度事件和开始执行事件的队列（由进程池初始化函数设置）
+_worker_progress_queue = None
+_worker_start_queue = None
+
+
+def _init_worker(queue, log_queue, start_queue=None):
+    """工作进程初始化：保存进度事件队列和开始执行事件队列，日志改为交给主进程写出"""
+    global _worker_progress_queue, _worker_start_queue
+    _worker_progress_queue = queue
+    _worker_start_queue = start_queue
+    configure_worker_logging(log_queue)
+
+
+def _forward_progress_events(queue):
+    """后台线程：把工作进程回传的进度事件转发到事件循环"""
+    while True:
+        item = queue.get()
+        if item is None:
+            break
+        job_id, stage, data = item
+        progress.publish_threadsafe(job_id, stage, **data)
+
+
+def _forward_start_events(queue):
+    """后台线程：工作进程开始执行任务时，完成事件循环中等待该任务开始的future"""
+    while True:
+        task_id = queue.get()
+        if task_id is None:
+            break
+        waiter = _start_waiters.get(task_id)
+        if waiter is not None:
+            loop, started = waiter
+            try:
+                loop.call_soon_threadsafe(_set_started, started)
+            except RuntimeError:
+                # 事件循环已关闭
+                pass
+
+
+def _set_started(started):
+    if not started.done():
+        started.set_result(None)
+
+
+def get_executor(pool="normal"):
+    """获取全局转换进程池（首次调用时创建）
+
+    参数:
+    - pool: normal（普通进程池）或heavy（复杂图纸专用进程池，HEAVY_WORKERS为0时使用普通进程池）
+    """
+    global _progress_queue, _progress_thread, _log_queue, _start_queue, _start_thread
+    if not POOL_SIZES.get(pool):
+        pool = "normal"
+    executor = _executors.get(pool)
+    if executor is None:
+        context = multiprocessing.get_context()
+        # 工作进程崩溃后重建进程池时沿用原来的进度队列、日志队列和转发线程
+        if _progress_queue is None:
+            _progress_queue = context.Queue()
+            _progress_thread = threading.Thread(target=_forward_progress_events, args=(_progress_queue,),
+                                                name="progress-forwarder", daemon=True)
+            _progress_thread.start()
+        if _start_queue is None:
+            _start_queue = context.Queue()
+            _start_thread = threading.Thread(target=_forward_start_events, args=(_start_queue,),
+                                             name="start-forwarder", daemon=True)
+            _start_thread.start()
+        if _log_queue is None:
+            _log_queue = create_worker_log_queue(context)
+        executor = ProcessPoolExecutor(max_workers=POOL_SIZES[pool], mp_context=context, initializer=_init_worker,
+                                       initargs=(_progress_queue, _log_queue, _start_queue))
+        _executors[pool] = executor
+        logger.info(f"已创建转换进程池（{pool}），工作进程数: {POOL_SIZES[pool]}")
+    return executor
+
+
+def _worker_memory_bytes():
+    """获取当前工作进程的内存占用，无法获取时返回None"""
+    try:
+        import psutil
+        return psutil.Process().memory_info().rss
+    except ImportError:
+        pass
+    try:
+        import resource
+        # Linux上ru_maxrss的单位为KB（峰值内存）
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    except ImportError:
+        return None
+
+
+class _PeakMemorySampler:
+    """在工作进程的后台线程中定期采样内存占用，记录一个任务期间的峰值
+
+    没有psutil时无法采样，peak返回进程启动以来的峰值内存（ru_maxrss，是任务峰值的上界）
+    """
+
+    def __init__(self, interval=MEMORY_SAMPLE_INTERVAL):
+        self.interval = interval
+        self._peak = None
+        self._stop = threading.Event()
+        self._thread = None
+        try:
+            import psutil
+            self._process = psutil.Process()
+        except ImportError:
+            self._process = None
+
+    def _sample(self):
+        rss = self._process.memory_info().rss
+        if self._peak is None or rss > self._peak:
+            self._peak = rss
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self._sample()
+
+    def __enter__(self):
+        if self._process is not None and self.interval > 0:
+            self._sample()
+            self._thread = threading.Thread(target=self._run, name="memory-sampler", daemon=True)
+            self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._sample()
+        return False
+
+    @property
+    def peak(self):
+        if self._thread is not None:
+            return self._peak
+        return _worker_memory_bytes()
+
+
+def _failure_reason(timings):
+    """根据已完成的阶段推断转换失败的原因"""
+    if "parse" not in timings:
+        # ODA转换失败或生成的DXF无法读取
+        return "dxf_failed"
+    if "encode" not in timings:
+        return "render_failed"
+    return "output_missing"
+
+
+def _make_progress_callback(job_id, file_label, attachment_id=None):
+    """创建工作进程中的进度回调，把阶段事件放入进度队列"""
+    if not job_id or _worker_progress_queue is None:
+        return None
+
+    def report(stage, percent=None):
+        _worker_progress_queue.put((job_id, stage, {"file": file_label, "attachment_id": attachment_id,
+                                                    "percent": percent}))
+
+    return report
+
+
+def convert_job(dwg_path, jpg_path, options=None, job_id=None, file_label=None, trace=None):
+    """在工作进程中执行一次DWG到JPG转换，并返回结果和耗时
+
+    参数:
+    - job_id: 可选的任务ID，提供时通过进度队列报告各阶段事件
+    - file_label: 进度事件中标识文件的名称
+    - trace: 主进程中当前span的SpanContext，工作进程中的span作为它的子span
+
+    返回:
+    - 字典，包含success（是否成功）、seconds（工作进程内耗时）、timings（各阶段耗时）、
+      error和reason（失败信息和原因）、pid和memory_bytes（工作进程信息）、peak_memory_bytes（任务期间的峰值内存）、
+      spans（工作进程中记录的span）
+    """
+    return _run_job(converter_dwg_to_jpg, dwg_path, jpg_path, options, job_id, file_label, trace)
+
+
+def render_job(dxf_path, jpg_path, options=None, job_id=None, file_label=None, trace=None, attachment_id=None,
+               task_id=None):
+    """在工作进程中把ODA已生成的DXF文件解析、渲染并编码为JPG，返回值与convert_job相同
+
+    参数:
+    - attachment_id: 数据库转换的附件ID，随进度事件发布，用于区分文件名相同的文件
+    - task_id: 主进程分配的任务编号，开始执行时通过队列回传，主进程从此时开始计算超时
+    """
+    return _run_job(converter_dxf_to_jpg, dxf_path, jpg_path, options, job_id, file_label, trace, attachment_id,
+                    task_id)
+
+
+def _run_job(convert, source_path, jpg_path, options, job_id, file_label, trace=None, attachment_id=None,
+             task_id=None):
+    if task_id is not None and _worker_start_queue is not None:
+        _worker_start_queue.put(task_id)
+    started = time.perf_counter()
+    timings = {}
+    reason = ""
+    # 工作进程中的span随结果返回，由主进程导出；转换函数报告的各阶段记录为子span
+    with tracing.collect() as spans, tracing.span(convert.__name__, parent=trace, pid=os.getpid()) as job_span, \
+            _PeakMemorySampler() as memory:
+        stage_spans = tracing.StageSpans(_make_progress_callback(job_id, file_label, attachment_id))
+        try:
+            success = convert(source_path, jpg_path, timings=timings, progress=stage_spans, **(options or {}))
+            error = "" if success else "DWG到JPG转换失败"
+            if not success:
+                reason = _failure_reason(timings)
+        except Exception as e:
+            success = False
+            error = str(e)
+            reason = "exception"
+        finally:
+            stage_spans.close()
+        if not success:
+            job_span.set_error(error)
+            job_span.set_attribute("reason", reason)
+    return {
+        "success": success,
+        "seconds": time.perf_counter() - started,
+        "timings": timings,
+        "error": error,
+        "reason": reason,
+        "pid": os.getpid(),
+        "memory_bytes": _worker_memory_bytes(),
+        "peak_memory_bytes": memory.peak,
+        "spans": spans
+    }
+
+
+def _discard_executor(executor, cause, message, terminate=False):
+    """丢弃进程池，下次提交时重建；terminate为True时先终止仍在运行的工作进程
+
+    同一个进程池上的其他任务也会收到BrokenProcessPool，只由第一次调用丢弃，不影响已经重建的进程池
+    """
+    for pool, current in list(_executors.items()):
+        if current is executor:
+            logger.error(f"{message}，重建进程池（{pool}）")
+            del _executors[pool]
+            metrics.WORKER_POOL_RESTARTS.inc(pool=pool, cause=cause)
+            _forget_workers(executor)
+            if terminate:
+                _recycled.add(executor)
+                # 已经开始执行的任务无法取消，ProcessPoolExecutor也没有终止工作进程的公开接口
+                for process in list((executor._processes or {}).values()):
+                    process.terminate()
+            executor.shutdown(wait=False)
+
+
+def _forget_workers(executor):
+    """删除进程池中工作进程的内存指标"""
+    for pid in _worker_pids.pop(executor, ()):
+        metrics.WORKER_MEMORY.remove(pid=pid)
+
+
+def _failed_result(error, reason):
+    return {
+        "success": False,
+        "seconds": 0.0,
+        "timings": {},
+        "error": error,
+        "reason": reason,
+        "pid": None,
+        "memory_bytes": None,
+        "peak_memory_bytes": None,
+        "spans": []
+    }
+
+
+def _crashed_result(executor, error):
+    """工作进程异常退出（例如渲染时崩溃或被系统杀死）时的结果，进程池已无法使用，丢弃后下次提交时重建"""
+    if executor in _recycled:
+        # 进程池因其他任务超时被终止，这个任务本身没有问题，按暂时性错误稍后重试
+        return _failed_result("其他任务超时，进程池已被终止重建", "pool_recycled")
+    _discard_executor(executor, "crashed", f"转换进程异常退出: {str(error)}")
+    return _failed_result(f"转换进程异常退出: {str(error)}", "worker_crashed")
+
+
+def _timeout_result(executor, future, timeout):
+    """任务超时的结果
+
+    超时从工作进程开始执行时计算，一般已无法取消，终止进程池的工作进程（否则超时的任务会继续占用工作进程渲染），
+    下次提交时重建；任务还在排队时（开始执行的事件未及时到达）直接取消
+    """
+    if future.cancel():
+        return _failed_result(f"等待工作进程超过{timeout:g}秒", "queue_timeout")
+    _discard_executor(executor, "timeout", f"渲染超过{timeout:g}秒未完成，终止工作进程", terminate=True)
+    return _failed_result(f"渲染超过{timeout:g}秒未完成", "timeout")
+
+
+def _record_job_metrics(result, executor, conversion=True):
+    """在主进程中记录工作进程返回的指标；conversion为False时只是转换的一个阶段，不计入转换总数和总耗时
+
+    进程池已被丢弃时（例如同一进程池的其他任务超时）不再记录该工作进程的内存
+    """
+    for stage, seconds in result["timings"].items():
+        metrics.STAGE_DURATION.observe(seconds, stage=stage)
+    if conversion:
+        metrics.CONVERSION_DURATION.observe(result["total_seconds"])
+        metrics.record_conversion(result["success"], result["reason"])
+    if result["memory_bytes"] is not None and executor in _executors.values():
+        metrics.WORKER_MEMORY.set(result["memory_bytes"], pid=result["pid"])
+        _worker_pids.setdefault(executor, set()).add(result["pid"])
+    tracing.export_spans(result["spans"])
+
+
+def _update_queue_gauges(delta):
+    metrics.JOBS_IN_FLIGHT.inc(delta)
+    in_flight = metrics.JOBS_IN_FLIGHT.get()
+    metrics.QUEUE_DEPTH.set(max(in_flight - CONVERT_WORKERS - HEAVY_WORKERS, 0))
+
+
+async def run_conversion(dwg_path, jpg_path, job_id=None, file_label=None, **options):
+    """在进程池中异步执行转换，不阻塞事件循环
+
+    参数:
+    - job_id: 可选的任务ID，提供时发布queued、各转换阶段和file_done事件（终止事件由任务发起方发布）
+    - file_label: 进度事件中标识文件的名称，默认为DWG文件名
+
+    返回:
+    - convert_job的结果字典，额外包含total_seconds（含排队等待的总耗时）
+    """
+    loop = asyncio.get_running_loop()
+    progress.bind_loop(loop)
+    file_label = file_label or Path(str(dwg_path)).name
+    progress.publish(job_id, "queued", file=file_label)
+    submitted = time.perf_counter()
+    _update_queue_gauges(1)
+    executor = get_executor()
+    try:
+        result = await loop.run_in_executor(
+            executor,
+            functools.partial(convert_job, str(dwg_path), str(jpg_path), options, job_id, file_label,
+                              tracing.current_context())
+        )
+    except BrokenProcessPool as e:
+        result = _crashed_result(executor, e)
+    finally:
+        _update_queue_gauges(-1)
+    result["total_seconds"] = time.perf_counter() - submitted
+    _record_job_metrics(result, executor)
+    progress.publish(job_id, "file_done", file=file_label, success=result["success"],
+                     error=result["error"] or None, seconds=round(result["total_seconds"], 3))
+    return result
+
+
+def _pool_slot(pool):
+    """进程池的准入信号量（数量为工作进程数），按事件循环创建"""
+    loop = asyncio.get_running_loop()
+    slot = _pool_slots.get(pool)
+    if slot is None or slot[0] is not loop:
+        slot = (loop, asyncio.Semaphore(POOL_SIZES[pool]))
+        _pool_slots[pool] = slot
+    return slot[1]
+
+
+async def run_render(dxf_path, jpg_path, job_id=None, file_label=None, pool="normal", timeout=None,
+                     attachment_id=None, **options):
+    """在进程池中异步把DXF文件渲染为JPG（流水线的渲染阶段）
+
+    与run_conversion不同，这里不发布queued和file_done事件，也不计入转换总数，由流水线统一处理。
+    同时提交到一个进程池的任务数不超过其工作进程数，其余任务在主进程中等待，
+    不会因为排在耗时长的图纸后面而超时
+
+    参数:
+    - pool: 提交到的进程池，复杂图纸为heavy
+    - timeout: 超时时间（秒，从工作进程开始执行时计算），超时后终止并重建进程池，结果的reason为timeout；
+      None表示不限制
+    - attachment_id: 数据库转换的附件ID，随进度事件发布
+
+    返回:
+    - render_job的结果字典，额外包含total_seconds（含排队等待的耗时）
+    """
+    loop = asyncio.get_running_loop()
+    progress.bind_loop(loop)
+    file_label = file_label or Path(str(dxf_path)).name
+    if not POOL_SIZES.get(pool):
+        pool = "normal"
+    submitted = time.perf_counter()
+    _update_queue_gauges(1)
+    task_id = next(_task_ids)
+    started = loop.create_future()
+    try:
+        async with _pool_slot(pool):
+            executor = get_executor(pool)
+            metrics.RENDER_ROUTES.inc(pool=pool)
+            _start_waiters[task_id] = (loop, started)
+            try:
+                future = executor.submit(render_job, str(dxf_path), str(jpg_path), options, job_id, file_label,
+                                         tracing.current_context(), attachment_id, task_id)
+                done = asyncio.wrap_future(future)
+                if timeout is not None:
+                    # 等待工作进程开始执行（或任务结束，例如进程池已损坏）后再开始计时
+                    await asyncio.wait({done, started}, return_when=asyncio.FIRST_COMPLETED)
+                result = await asyncio.wait_for(done, timeout)
+            except asyncio.TimeoutError:
+                result = _timeout_result(executor, future, timeout)
+            except BrokenProcessPool as e:
+                result = _crashed_result(executor, e)
+            finally:
+                _start_waiters.pop(task_id, None)
+                started.cancel()
+    finally:
+        _update_queue_gauges(-1)
+    result["total_seconds"] = time.perf_counter() - submitted
+    _record_job_metrics(result, executor, conversion=False)
+    return result
+
+
+def shutdown_executor(wait=True):
+    """关闭转换进程池（包括复杂图纸专用进程池）"""
+    global _progress_queue, _start_queue
+    if _executors:
+        for executor in list(_executors.values()):
+            executor.shutdown(wait=wait)
+            _forget_workers(executor)
+        _executors.clear()
+        # 通知进度转发线程和开始执行事件转发线程退出
+        _progress_queue.put(None)
+        _progress_queue = None
+        _start_queue.put(None)
+        _start_queue = None
+        logger.info("转换进程池已关闭")